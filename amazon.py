@@ -1,5 +1,10 @@
 import utilities as u
+import amazon_service
+import ocr_workers
 import datetime
+import threading
+import shutil
+import queue
 import time
 import glob
 import sys
@@ -14,8 +19,9 @@ from watchdog.observers import Observer
 # in that folder, they will be processed and then forwarded to the physical printer.
 # The folder being watched is where the Amazon Virtual Printer (i.e. VipRiser) will be saving the documents.
 
-# First send the ps_pdf, and then you can send the sl_pdf under WAIT_TIME_FOR_2ND_PDF seconds, otherwise 
-# the ps_pdf will be discarded and you will need to send the ps_pdf again before sending the sl_pdf.
+# The 2 PDF's of a pair can be sent in any order, and pairs from different operators can be sent at the same 
+# time: every PDF is recognized as a ps_pdf or an sl_pdf and paired up by its order_IDs, see AmazonPairer. 
+# A PDF that hasn't been paired up within WAIT_TIME_FOR_2ND_PDF seconds of being identified is discarded and has to be sent again.
 
 # Unless otherwise mentioned, VP refers to a "Virtual Printer" in this file
 
@@ -25,8 +31,11 @@ from watchdog.observers import Observer
 USE_LOG_FILE                              = False # if False, print log to the the stdout which is the terminal usually
 LOG_FILE_PATH                             = os.getcwd() + os.sep + __file__ + ".log"
 AMAZON_VP_DESTINATION_FOLDER              = os.getcwd() + os.sep + "amazon_virtual_printer_target/"  # '/' at the end is important
-WAIT_TIME_FOR_2ND_PDF                     = 240 # in seconds
-WAIT_TIME_FOR_LETTING_FILES_TRANSER_FULLY = 10
+WAIT_TIME_FOR_2ND_PDF                     = 240 # in seconds, per pdf
+WAIT_TIME_FOR_LETTING_FILES_TRANSER_FULLY = 10 # at most, processing starts as soon as the pdf is fully written
+MIN_OID_OVERLAP_TO_PAIR                   = 0.5  # fraction of a ps_pdf's order_IDs an sl_pdf must have to be paired with it
+SERVICE_URL                               = None # e.g. amazon_service.SERVICE_URL to hand the pdfs to a running amazon_service.py instead of processing them here
+JOB_WORKERS                               = 2    # how many pdf-pairs can be processed at the same time
 ###############################################################################################
 
 if USE_LOG_FILE:
@@ -45,6 +54,11 @@ class AmazonWatcher:
             msg = "Set the folder where the amazon_system's Virtual Printer is saving the PDFs to: '" + AMAZON_VP_DESTINATION_FOLDER + "'"
             u.display_alert(msg, blocking=True)
             
+        coordinator = None
+        if not SERVICE_URL:
+            AmazonPDFHandler.pairer = AmazonPairer(AmazonJobQueue(JOB_WORKERS))
+            if u.OCR_COORDINATOR_ADDRESS:
+                coordinator = ocr_workers.start_coordinator()
         self.observer.schedule(AmazonPDFHandler(), AMAZON_VP_DESTINATION_FOLDER)
         self.observer.start()
         u.log("Ready to receive a new amazon pdf-pair.\n\n")
@@ -52,50 +66,210 @@ class AmazonWatcher:
         try:
             while True:
                 time.sleep(5)
+                if AmazonPDFHandler.pairer:
+                    AmazonPDFHandler.pairer.expire()
         except KeyboardInterrupt:
             u.log("Closing all threads, please wait...")
             self.observer.stop()
             self.observer.join()
+            if AmazonPDFHandler.pairer:
+                AmazonPDFHandler.pairer.stop()
+            if coordinator:
+                ocr_workers.stop_coordinator(coordinator)
             u.log("Done")
         except:
             u.log("An error occured while running: " + __file__)
             u.display_alert(r"An error occured while running: " + __file__, blocking=False)
             self.observer.stop()
             self.observer.join()
+            if AmazonPDFHandler.pairer:
+                AmazonPDFHandler.pairer.stop()
+            if coordinator:
+                ocr_workers.stop_coordinator(coordinator)
+
+
+class AmazonJobQueue:
+    # Runs u.do_amazon_print_job() for the submitted pdf-pairs on `workers` threads, each job in its own work_dir.
+
+    def __init__(self, workers):
+        self.jobs = queue.Queue()
+        self.workers = [ threading.Thread(target=self.work, name="job-worker-" + str(i), daemon=True) for i in range(workers) ]
+        for w in self.workers:
+            w.start()
+
+    def submit(self, ps_pdf_path, sl_pdf_path, speculative_job, sl_oids=None):
+        # moves the pair out of AMAZON_VP_DESTINATION_FOLDER into a new job dir, so the folder is free for the next pair. 
+        # sl_oids are the sl_pdf's order_IDs if its own speculative job already extracted them.
+
+        job_dir = u.make_job_dir()
+        ps_pdf_path = AmazonJobQueue.move(ps_pdf_path, job_dir)
+        sl_pdf_path = AmazonJobQueue.move(sl_pdf_path, job_dir)
+        u.speculative_job_pdf_moved(speculative_job, ps_pdf_path)
+
+        self.jobs.put((ps_pdf_path, sl_pdf_path, speculative_job, sl_oids, job_dir))
+        u.log("Queued amazon print job " + os.path.basename(job_dir.rstrip("/")) + ", " + str(self.jobs.qsize()) + " job(s) waiting")
+
+    @staticmethod
+    def move(path, job_dir):
+        return shutil.move(path, job_dir + os.path.basename(path))
+
+    def work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+
+            ps_pdf_path, sl_pdf_path, speculative_job, sl_oids, job_dir = job
+            try:
+                u.do_amazon_print_job(ps_pdf_path, sl_pdf_path, speculative_job, work_dir=job_dir, sl_oids=sl_oids)
+                u.log("Amazon print job completed: " + os.path.basename(job_dir.rstrip("/")))
+            except u.PartlyPrintedError as e:
+                u.log("Amazon print job failed: " + os.path.basename(job_dir.rstrip("/")) + ": " + str(e))
+                u.display_alert("Amazon print job failed after printing these orders: " + ", ".join(e.printed_order_ids) \
+                    + ". Don't send the pdf-pair again, that would print them twice, print the other orders by hand.", blocking=False)
+            except Exception as e:
+                u.log("Amazon print job failed: " + os.path.basename(job_dir.rstrip("/")) + ": " + repr(e))
+                u.display_alert("Amazon print job failed, please send the pdf-pair again.", blocking=False)
+            finally:
+                self.jobs.task_done()
+
+    def stop(self):
+        # lets the jobs already queued finish first
+
+        for _ in self.workers:
+            self.jobs.put(None)
+        for w in self.workers:
+            w.join()
+
+
+class AmazonPairer:
+    # Pairs up the pdfs arriving in AMAZON_VP_DESTINATION_FOLDER by what they are rather than by the order they 
+    # arrive in. Every pdf gets a speculative job (see u.start_speculative_job()) that tells whether it's a ps_pdf 
+    # or an sl_pdf and extracts its order_IDs, and as soon as a ps_pdf and an sl_pdf with enough order_IDs in 
+    # common are both pending they're submitted to the job queue as a pair. Any number of pdfs can be pending, 
+    # each is discarded on its own once it's been waiting for WAIT_TIME_FOR_2ND_PDF seconds since it was identified.
+
+    def __init__(self, job_queue):
+        self.job_queue = job_queue
+        self.pending = dict() # pdf path -> {"received": time.time(), "identified": time.time() or None, "job": speculative job}
+        self.lock = threading.Lock()
+
+    def add(self, path_to_pdf):
+        # only visible pdf files count, not the hidden temp files or the dirs the virtual printer may create too.
+        # A pdf that's sent again under the same name replaces the pending one.
+
+        name = os.path.basename(path_to_pdf)
+        if name.startswith(".") or not name.lower().endswith(".pdf") or not os.path.isfile(path_to_pdf):
+            u.log("Not a pdf, ignoring: '" + path_to_pdf + "'")
+            return
+
+        with self.lock:
+            replaced = self.pending.pop(path_to_pdf, None)
+        if replaced is not None:
+            # on a thread of its own, cancelling waits for the job to get to a point where it can stop
+            u.log("Received again, replacing the pending one: " + name)
+            threading.Thread(target=u.cancel_speculative_job, args=(replaced["job"],), daemon=True).start()
+
+        job = u.start_speculative_job(path_to_pdf, delay=WAIT_TIME_FOR_LETTING_FILES_TRANSER_FULLY)
+        with self.lock:
+            self.pending[path_to_pdf] = { "received": time.time(), "identified": None, "job": job }
+        
+        threading.Thread(target=self.identified, args=(path_to_pdf, job), daemon=True).start()
+
+    def identified(self, path_to_pdf, job):
+        # waits for the pdf's speculative job, then pairs it up if its other half is already pending
+
+        job["thread"].join()
+        if job["result"] is None:
+            if not job["cancelled"].is_set():
+                u.log("Couldn't tell what this pdf is, discarding it: " + os.path.basename(path_to_pdf))
+                u.display_alert("An Amazon pdf couldn't be read, please send it again.", blocking=False)
+                self.discard(path_to_pdf, job)
+            return
+
+        with self.lock:
+            doc = self.pending.get(path_to_pdf)
+            if doc is None or doc["job"] is not job:
+                return
+            doc["identified"] = time.time() # WAIT_TIME_FOR_2ND_PDF counts from here, not from when it arrived
+
+        kind = "ps_pdf" if job["result"]["is_ps"] else "sl_pdf"
+        oids = job["result"]["oids"] if job["result"]["is_ps"] else job["result"]["sl_oids"]
+        u.log("Received " + kind + " with " + str(len(oids or dict())) + " order_IDs: " + os.path.basename(path_to_pdf))
+        self.pair_up()
+
+    def pair_up(self):
+        with self.lock:
+            identified = { p: d["job"]["result"] for p, d in self.pending.items() if d["job"]["result"] is not None }
+            ps_pdfs = sorted( (p for p, r in identified.items() if r["is_ps"]), key=lambda p: self.pending[p]["received"] )
+            sl_pdfs = [ p for p, r in identified.items() if not r["is_ps"] ]
+
+            for ps_pdf_path in ps_pdfs:
+                overlaps = { sl: u.oids_overlap(identified[ps_pdf_path]["oids"], identified[sl]["sl_oids"]) for sl in sl_pdfs }
+                best = max(overlaps, key=overlaps.get) if overlaps else None
+                if best is None or overlaps[best] < MIN_OID_OVERLAP_TO_PAIR:
+                    continue
+
+                sl_pdf_path = best
+                sl_pdfs.remove(sl_pdf_path)
+                ps_job = self.pending.pop(ps_pdf_path)["job"]
+                sl_job = self.pending.pop(sl_pdf_path)["job"]
+                u.discard_speculative_job_files(sl_job) # it was only needed for its order_IDs
+
+                u.log("Paired " + os.path.basename(ps_pdf_path) + " with " + os.path.basename(sl_pdf_path) + " (" + str(int(100 * overlaps[best])) + "% of the order_IDs match)")
+                self.job_queue.submit(ps_pdf_path, sl_pdf_path, ps_job, identified[sl_pdf_path]["sl_oids"])
+                u.log("Ready to receive a new amazon pdf-pair.\n\n")
+
+    def expire(self):
+        # discards the pdfs that have been waiting for their other half for longer than WAIT_TIME_FOR_2ND_PDF since 
+        # they were identified, the ones still being identified aren't waiting for anything yet
+
+        now = time.time()
+        with self.lock:
+            expired = [ (p, d["job"]) for p, d in self.pending.items() if d["identified"] and now - d["identified"] > WAIT_TIME_FOR_2ND_PDF ]
+        
+        for path_to_pdf, job in expired:
+            u.log("No pdf to pair it with arrived in time, discarding: " + os.path.basename(path_to_pdf))
+            u.display_alert("No pdf to pair " + os.path.basename(path_to_pdf) + " with arrived in time, please send the pdf-pair again.", blocking=False)
+            self.discard(path_to_pdf, job)
+
+    def discard(self, path_to_pdf, job=None):
+        # job: only discard the pdf if it's still pending with this job, i.e. it hasn't been sent again since
+
+        with self.lock:
+            doc = self.pending.get(path_to_pdf)
+            if doc is None or (job is not None and doc["job"] is not job):
+                return
+            del self.pending[path_to_pdf]
+
+        u.cancel_speculative_job(doc["job"])
+        if os.path.exists(path_to_pdf):
+            os.remove(path_to_pdf)
+
+    def stop(self):
+        with self.lock:
+            pending = list(self.pending.keys())
+        for path_to_pdf in pending:
+            self.discard(path_to_pdf)
+        self.job_queue.stop()
 
 
 class AmazonPDFHandler(FileSystemEventHandler):
-    ps_pdf_receive_time = None 
-    ps_pdf_path = None
+    pairer = None
 
     @staticmethod
     def on_created(event):
         path_to_source_pdf = event.src_path
         u.log("Started receiving Amazon-PDF: '" + path_to_source_pdf + "'")
 
-        if u.dir_len(AMAZON_VP_DESTINATION_FOLDER) == 1:
-            AmazonPDFHandler.ps_pdf_receive_time = int(time.time())
-            AmazonPDFHandler.ps_pdf_path = path_to_source_pdf
-        elif u.dir_len(AMAZON_VP_DESTINATION_FOLDER) == 2:
-            seconds_since_epoch = int(time.time())
-
-            if seconds_since_epoch - AmazonPDFHandler.ps_pdf_receive_time <= WAIT_TIME_FOR_2ND_PDF: # the 2nd pdf came under time, treat it as the sl_pdf
-                time.sleep(WAIT_TIME_FOR_LETTING_FILES_TRANSER_FULLY)
-                
-                u.do_amazon_print_job(AmazonPDFHandler.ps_pdf_path, path_to_source_pdf)
-                
-                u.empty_or_make_new(AMAZON_VP_DESTINATION_FOLDER)
-                u.log("Amazon print job completed")
-                u.log("Ready to receive a new amazon pdf-pair.\n\n")
-            else: # the 2nd pdf did NOT come under time, treat the 2nd pdf as ps_pdf and delete everything else
-                u.empty_dir(AMAZON_VP_DESTINATION_FOLDER, path_to_source_pdf)
-                
-                AmazonPDFHandler.ps_pdf_path = path_to_source_pdf  # treat it as the first pdf of the complete pair
-                AmazonPDFHandler.ps_pdf_receive_time = time.time()
+        if SERVICE_URL:
+            try:
+                amazon_service.submit_pdf(path_to_source_pdf, url=SERVICE_URL)
+            except OSError as e:
+                u.log("Couldn't hand the pdf to the amazon service at " + SERVICE_URL + ": " + repr(e))
+                u.display_alert("The amazon service isn't running, please start it and send the pdf again.", blocking=False)
         else:
-            u.log("More than 2 files detected in " + AMAZON_VP_DESTINATION_FOLDER)
-            time.sleep(WAIT_TIME_FOR_LETTING_FILES_TRANSER_FULLY)
-            u.empty_dir(AMAZON_VP_DESTINATION_FOLDER)
+            AmazonPDFHandler.pairer.add(path_to_source_pdf)
 
         
 if __name__ == '__main__':
@@ -0,0 +1,261 @@
+import utilities as u
+import ocr_workers
+import http.server
+import urllib.request
+import threading
+import argparse
+import base64
+import shutil
+import json
+import time
+import sys
+import os
+
+# Purpose of this script: It runs the amazon system as a long-running local service, so that the
+# OCR engines, the OCR cache and the imports are already warm when a pdf-pair comes in. Anything
+# at the station can submit a pair over HTTP on localhost and get the orders back as they're
+# printed, amazon.py is just one client of it (see SERVICE_URL in amazon.py).
+#
+# Endpoints, all JSON, POSTs must be sent as application/json:
+#   POST /pairs  {"pdfs": [pdf, pdf], "print": true}
+#                each pdf either {"path": "..."} or {"base64": "..."}, in any order. The response
+#                is streamed, one JSON object per line: an {"type": "order", ...} per order as soon
+#                as it's been printed, then {"type": "done", ...} or {"type": "error", ...}, the latter with the
+#                "printed_order_ids" that were printed before it failed
+#   POST /pdfs   {"path": "..."}
+#                a single pdf in amazon.AMAZON_VP_DESTINATION_FOLDER, paired up with the other half of its pair when that arrives, see
+#                amazon.AmazonPairer. This is what the folder watcher sends.
+#   GET  /status
+#
+# Run it with `python amazon_service.py`, submit a pair with `python amazon_service.py submit a.pdf b.pdf`.
+
+###############################################################################################
+# Script Options:
+
+SERVICE_HOST                              = "127.0.0.1" # localhost only, there's no authentication
+SERVICE_PORT                              = 8710
+SERVICE_URL                               = "http://" + SERVICE_HOST + ":" + str(SERVICE_PORT)
+SERVICE_OUTPUT_TARGET                     = os.getcwd() + os.sep + "service_output/" # the printed files of every order are copied to <this>/<job>/
+SERVICE_JOB_WORKERS                       = 2    # how many pairs submitted to /pairs can be processed at the same time, the rest wait
+###############################################################################################
+
+
+class AmazonService(http.server.ThreadingHTTPServer):
+    # Every request is handled on its own thread, at most SERVICE_JOB_WORKERS of them run a job at a time.
+
+    daemon_threads = True
+
+    def __init__(self, address):
+        super().__init__(address, AmazonServiceRequestHandler)
+        self.job_slots = threading.BoundedSemaphore(SERVICE_JOB_WORKERS)
+        self.running_jobs = 0
+        self.lock = threading.Lock()
+        self.pairer = None # for /pdfs, made on the first one so that a service only used through /pairs doesn't import watchdog
+
+    def get_pairer(self):
+        with self.lock:
+            if self.pairer is None:
+                import amazon
+                self.pairer = amazon.AmazonPairer(amazon.AmazonJobQueue(SERVICE_JOB_WORKERS))
+                threading.Thread(target=self.expire_pending_pdfs, daemon=True).start()
+            return self.pairer
+
+    def expire_pending_pdfs(self):
+        while True:
+            time.sleep(5)
+            self.pairer.expire()
+
+    def shutdown_pairer(self):
+        if self.pairer is not None:
+            self.pairer.stop()
+
+
+class AmazonServiceRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/status":
+            return self.send_json(404, {"type": "error", "error": "no such endpoint: " + self.path})
+
+        pairer = self.server.pairer
+        self.send_json(200, {
+            "type": "status",
+            "running_jobs": self.server.running_jobs,
+            "pending_pdfs": sorted(os.path.basename(p) for p in pairer.pending) if pairer else [],
+            "ocr_cache": u.ocr_cache_summary() if u.USE_OCR_CACHE else None,
+        })
+
+    def do_POST(self):
+        # a browser can't send application/json cross-origin without asking first, so a web page can't post here
+        if self.headers.get_content_type() != "application/json":
+            return self.send_json(415, {"type": "error", "error": "the request must be application/json"})
+
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        except ValueError as e:
+            return self.send_json(400, {"type": "error", "error": "not json: " + str(e)})
+
+        if self.path == "/pairs":
+            self.run_pair(request)
+        elif self.path == "/pdfs":
+            self.queue_pdf(request)
+        else:
+            self.send_json(404, {"type": "error", "error": "no such endpoint: " + self.path})
+
+    def queue_pdf(self, request):
+        # the pairer moves and deletes the pdfs it's given, so only the ones in the folder it watches are taken
+        import amazon
+        folder = os.path.realpath(amazon.AMAZON_VP_DESTINATION_FOLDER)
+        path_to_pdf = request.get("path")
+        if not isinstance(path_to_pdf, str) or os.path.commonpath([folder, os.path.realpath(path_to_pdf)]) != folder:
+            return self.send_json(403, {"type": "error", "error": "not a pdf in " + folder + ": " + str(path_to_pdf)})
+
+        path_to_pdf = os.path.realpath(path_to_pdf)
+        if not os.path.isfile(path_to_pdf):
+            return self.send_json(400, {"type": "error", "error": "no such pdf: " + path_to_pdf})
+
+        self.server.get_pairer().add(path_to_pdf)
+        self.send_json(200, {"type": "queued", "pdf": os.path.basename(path_to_pdf)})
+
+    def run_pair(self, request):
+        pdfs = request.get("pdfs")
+        if not isinstance(pdfs, list) or len(pdfs) != 2:
+            return self.send_json(400, {"type": "error", "error": "\"pdfs\" must be a list of 2 pdfs"})
+
+        job_dir = u.make_job_dir()
+        try:
+            pdfA, pdfB = [ AmazonServiceRequestHandler.pdf_into(job_dir, pdf, name) for pdf, name in zip(pdfs, ("A.pdf", "B.pdf")) ]
+        except (KeyError, ValueError, OSError) as e:
+            shutil.rmtree(job_dir, ignore_errors=True)
+            return self.send_json(400, {"type": "error", "error": "bad pdf: " + repr(e)})
+
+        output_dir = u.append_slash_if_needed(SERVICE_OUTPUT_TARGET) + os.path.basename(job_dir.rstrip("/")) + "/"
+        os.makedirs(output_dir, exist_ok=True)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Connection", "close")
+        self.end_headers()
+
+        def on_order(order):
+            # the job deletes its work_dir when it's done, so the printed files are kept in output_dir
+            self.send_line({
+                "type": "order",
+                "order_id": order["order_id"],
+                "tracking_number": order["tracking_number"],
+                "match_confidence": order["match_confidence"],
+                "ps_path": shutil.copy(order["ps_path"], output_dir + "PP-" + os.path.basename(order["ps_path"])), # both are named after the PS page and the order_id
+                "combined_ps_and_sl_path": shutil.copy(order["combined_ps_and_sl_path"], output_dir + "LL-" + os.path.basename(order["combined_ps_and_sl_path"])),
+            })
+
+        start = time.time()
+        with self.server.job_slots:
+            with self.server.lock:
+                self.server.running_jobs += 1
+            try:
+                u.do_amazon_print_job(pdfA, pdfB, work_dir=job_dir, on_order=on_order, for_real=request.get("print", True) and u.PRINT_TO_PHYSICAL_PRINTER)
+                self.send_line({"type": "done", "seconds": round(time.time() - start, 3), "output_dir": output_dir})
+            except Exception as e:
+                u.log("Amazon print job failed: " + os.path.basename(job_dir.rstrip("/")) + ": " + repr(e))
+                self.send_line({"type": "error", "error": repr(e), "printed_order_ids": getattr(e, "printed_order_ids", [])})
+            finally:
+                with self.server.lock:
+                    self.server.running_jobs -= 1
+
+    @staticmethod
+    def pdf_into(job_dir, pdf, name):
+        # puts a pdf of a /pairs request into the job dir, the job deletes the dir and everything in it when it's done
+
+        if "path" in pdf:
+            return shutil.copy(pdf["path"], job_dir + name)
+
+        with open(job_dir + name, "wb") as f:
+            f.write(base64.b64decode(pdf["base64"], validate=True))
+        return job_dir + name
+
+    def send_json(self, status, obj):
+        body = (json.dumps(obj) + "\n").encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_line(self, obj):
+        try:
+            self.wfile.write((json.dumps(obj) + "\n").encode())
+            self.wfile.flush()
+        except OSError: # the client hung up, the job carries on regardless
+            pass
+
+    def log_message(self, format, *args):
+        u.log("service: " + (format % args))
+
+
+def warm_up():
+    # load what the first job would otherwise wait for: the OCR threads with their engines and the OCR cache
+
+    u.log("Warming up " + str(u.OCR_WORKERS) + " OCR worker(s) with the " + u.ocr_backend_name() + " backend")
+    blank = [ u.Image.new("L", (200, 50), 255) for _ in range(u.OCR_WORKERS) ]
+    ocr = u.ocr_backend()
+    list(u.ocr_map(lambda img: ocr(img, u.OCR_CONFIG), blank)) # not through str_from_img(), the cache would answer instead
+    if u.USE_OCR_CACHE:
+        u.log(u.ocr_cache_summary())
+
+def serve():
+    coordinator = ocr_workers.start_coordinator() if u.OCR_COORDINATOR_ADDRESS else None
+    warm_up()
+    server = AmazonService((SERVICE_HOST, SERVICE_PORT))
+    u.log("Amazon service listening on " + SERVICE_URL)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        u.log("Closing all threads, please wait...")
+    finally:
+        server.shutdown_pairer()
+        server.server_close()
+        if coordinator:
+            ocr_workers.stop_coordinator(coordinator)
+        u.log("Done")
+
+###############################################################################################
+# Client side, what amazon.py and other tools use to talk to a running service.
+
+def submit_pdf(path_to_pdf, url=SERVICE_URL, timeout=10):
+    # hands a single pdf to the service to be paired up and printed, see POST /pdfs
+
+    return post(url + "/pdfs", {"path": os.path.abspath(path_to_pdf)}, timeout).read()
+
+def submit_pair(pdfA, pdfB, print_them=True, url=SERVICE_URL, timeout=None):
+    '''
+    Has the service process a pdf-pair (paths or bytes, in any order) and yields its results as
+    they come in, see POST /pairs: a dict for every order and a last one for the whole job.
+    '''
+
+    def pdf(p):
+        return {"base64": base64.b64encode(p).decode()} if isinstance(p, bytes) else {"path": os.path.abspath(p)}
+
+    with post(url + "/pairs", {"pdfs": [pdf(pdfA), pdf(pdfB)], "print": print_them}, timeout) as response:
+        for line in response:
+            if line.strip():
+                yield json.loads(line)
+
+def post(url, obj, timeout):
+    request = urllib.request.Request(url, data=json.dumps(obj).encode(), headers={"Content-Type": "application/json"})
+    return urllib.request.urlopen(request, timeout=timeout)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the amazon service, or submit a pdf-pair to a running one.")
+    parser.add_argument("command", nargs="?", default="serve", choices=["serve", "submit"])
+    parser.add_argument("pdfs", nargs="*", help="with submit: the ps_pdf and the sl_pdf, in any order")
+    parser.add_argument("--no-print", action="store_true", help="with submit: don't print, only return the orders and their files")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        serve()
+    else:
+        if len(args.pdfs) != 2:
+            parser.error("submit takes 2 pdfs")
+        for result in submit_pair(args.pdfs[0], args.pdfs[1], print_them=not args.no_print):
+            print(json.dumps(result))
+            sys.stdout.flush()
@@ -0,0 +1,287 @@
+import utilities as u
+import collections
+import subprocess
+import argparse
+import datetime
+import resource
+import shutil
+import glob
+import json
+import time
+import sys
+import os
+import re
+
+# Purpose of this script: measure the amazon print pipeline against the pdf-pairs bundled in resources/,
+# stage by stage and end to end, without printing anything (the "fake" print backend is used).
+# Every run is appended to BENCH_RESULTS_PATH and compared with the previous run, so that
+# regressions show up.
+#
+# Usage:
+#   python benchmark.py                 # every pair and every lone SL
+#   python benchmark.py --pairs 1 4     # only resources/1ps.pdf + 1sl.pdf and 4ps.pdf + 4sl.pdf
+#   python benchmark.py --no-job        # only the individual stages
+
+###############################################################################################
+# Script Options:
+
+RESOURCES_DIR           = os.path.dirname(os.path.abspath(__file__)) + os.sep + "resources/"
+BENCH_WORKING_DIR       = os.getcwd() + os.sep + "benchmark_working_dir/"
+BENCH_RESULTS_PATH      = os.getcwd() + os.sep + "benchmark_results.jsonl"
+REGRESSION_THRESHOLD    = 1.2 # a stage that got slower than this many times its previous run's time is reported
+###############################################################################################
+
+
+def pairs_in_resources(only=None):
+    # [(name, ps_pdf_path, sl_pdf_path)] for every resources/<n>ps.pdf that has a resources/<n>sl.pdf
+
+
+    result = list()
+    for ps_pdf_path in sorted(glob.glob(RESOURCES_DIR + "*ps.pdf")):
+        n = os.path.basename(ps_pdf_path)[:-len("ps.pdf")]
+        sl_pdf_path = RESOURCES_DIR + n + "sl.pdf"
+        if os.path.exists(sl_pdf_path) and (not only or n in only):
+            result.append((n, ps_pdf_path, sl_pdf_path))
+    return result
+
+def lone_sls_in_resources():
+    # SLs without a PS to go with them, only their SL stages are benchmarked
+
+
+    paths = [RESOURCES_DIR + "brokensl.pdf"] + sorted(glob.glob(RESOURCES_DIR + "lone_sls/*.pdf"))
+    return [ (os.path.basename(p)[:-len(".pdf")], p) for p in paths if os.path.exists(p) ]
+
+def expected_oids(name):
+    '''
+    The order_IDs of resources/<name>ps.pdf, in page order, as recorded in
+    resources/ps_experiments/<name>ps_experiment/text_oids/<dpi>.txt: every line of those files
+    is an oid OCR'd at that dpi, the most common reading of each line is taken to be the right one.
+    Returns None if there is no such experiment.
+    '''
+
+    readings = list()
+    for path in glob.glob(RESOURCES_DIR + "ps_experiments/" + name + "ps_experiment/text_oids/*.txt"):
+        with open(path, "rt") as f:
+            lines = [ line.strip() for line in f.read().split("\n") if line.strip() != "" ]
+        readings.append(lines)
+
+    if not readings:
+        return None
+
+    result = list()
+    for i in range(max(len(r) for r in readings)):
+        frequencies = dict()
+        for r in readings:
+            if i < len(r):
+                m = re.search(u.OID_LOOKS_LIKE_THIS, r[i])
+                oid = "".join(m.group().split()) if m else r[i]
+                frequencies[oid] = frequencies.get(oid, 0) + 1
+        result.append(u.k_from_v(frequencies, max(frequencies.values())))
+    return result
+
+def peak_rss_mb():
+    # the peak resident set size of this process and of its biggest child (pdftoppm, tesseract, ...) so far
+
+
+    scale = 1 if sys.platform == "darwin" else 1024 # ru_maxrss is in bytes on macOS and in KiB on Linux
+    own      = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+    return round(own / 2**20, 1), round(children / 2**20, 1)
+
+def timed(results, pair, stage, pages, fn, *args, **kwargs):
+    # run fn(*args, **kwargs), append a result for it to `results` and return what fn returned (None if it raised)
+
+
+    u.log("Benchmarking " + stage + " on " + pair)
+
+    start = time.time()
+    error = None
+    try:
+        value = fn(*args, **kwargs)
+    except Exception as e:
+        value, error = None, repr(e)
+    wall_time = time.time() - start
+
+    own_rss, children_rss = peak_rss_mb()
+    results.append({
+        "pair": pair,
+        "stage": stage,
+        "wall_time": round(wall_time, 3),
+        "pages": pages,
+        "pages_per_sec": round(pages / wall_time, 2) if pages and wall_time > 0 else None,
+        "peak_rss_mb": own_rss,
+        "peak_children_rss_mb": children_rss,
+        "error": error,
+    })
+    return value
+
+def accuracy(found, expected):
+    # the fraction of `expected` (a list, in page order) that `found` (a dict from page number) got right
+
+
+    if not expected or found is None:
+        return None
+    right = sum( 1 for i in range(len(expected)) if found.get(i + 1) == expected[i] )
+    return round(right / len(expected), 4)
+
+def unordered_accuracy(found, expected):
+    # accuracy() for when `found` isn't in the order of `expected`, like the SL oids, which aren't in PS page order
+
+
+    if not expected or found is None:
+        return None
+    right = sum( (collections.Counter(found.values()) & collections.Counter(expected)).values() )
+    return round(right / len(expected), 4)
+
+def bench_pair(results, name, ps_pdf_path, sl_pdf_path, run_job):
+    pair = name + "ps+" + name + "sl"
+    pair_dir = u.append_slash_if_needed(BENCH_WORKING_DIR) + pair + "/"
+    for d in ("ps", "sl", "out", "out_pdf_ps", "out_pdf_combined", "oids_from_sl"):
+        os.makedirs(pair_dir + d, exist_ok=True)
+
+    ps_pages_count = u.pdf_page_count(ps_pdf_path)
+    sl_pages_count = u.pdf_page_count(sl_pdf_path)
+
+    ps_pages = timed(results, pair, "pdf_to_images2(ps)", ps_pages_count, u.pdf_to_images2, ps_pdf_path, pair_dir + "ps")
+    sl_pages = timed(results, pair, "pdf_to_images2(sl)", sl_pages_count, u.pdf_to_images2, sl_pdf_path, pair_dir + "sl")
+    if not ps_pages or not sl_pages:
+        return
+
+    expected = expected_oids(name)
+    ps_oids = timed(results, pair, "oids_from_ps", ps_pages_count, u.oids_from_ps, ps_pages, ps_pdf_path)
+    results[-1]["accuracy"] = accuracy(ps_oids, expected)
+
+    timed(results, pair, "page_kinds(sl)", sl_pages_count, u.page_kinds, sl_pdf_path)
+    sl_oids = timed(results, pair, "oids_from_sl", sl_pages_count, u.oids_from_sl, sl_pdf_path, pair_dir + "oids_from_sl")
+    results[-1]["accuracy"] = unordered_accuracy(sl_oids, expected)
+
+    sl_tnos = timed(results, pair, "tnos_from_sl", sl_pages_count, u.tnos_from_sl, sl_pages, sl_pdf_path)
+    if sl_tnos is not None:
+        results[-1]["extracted"] = len(sl_tnos)
+
+    if ps_oids and sl_oids and sl_tnos:
+        orders = list()
+        for pnum, oid in sorted(ps_oids.items()):
+            try:
+                sl_pnum = u.k_from_v(sl_oids, oid)
+            except ValueError:
+                continue
+            if sl_pnum in sl_tnos:
+                orders.append((oid, sl_tnos[sl_pnum], ps_pages[pnum], sl_pages[sl_pnum], pnum, sl_pnum))
+
+        def paste_all():
+            for oid, tno, ps_page, sl_page, _, _ in orders:
+                u.paste_barcodes_on_ps(oid, tno, ps_page, result=pair_dir + "out/" + oid + "-ps.png")
+
+        def combine_all():
+            for oid, tno, ps_page, sl_page, _, _ in orders:
+                u.combine_ps_and_sl(pair_dir + "out/" + oid + "-ps.png", sl_page, pair_dir + "out/" + oid + ".png")
+
+        def compose_all_pdfs():
+            try:
+                for oid, tno, _, _, pnum, sl_pnum in orders:
+                    order = { "order_id": oid, "tracking_number": tno, "ps_source": (ps_pdf_path, pnum), "sl_source": (sl_pdf_path, sl_pnum) }
+                    u.compose_order_pdf(order, pair_dir + "out_pdf_ps", pair_dir + "out_pdf_combined")
+            finally:
+                u.forget_pdf_readers(ps_pdf_path, sl_pdf_path)
+
+        timed(results, pair, "paste_barcodes_on_ps", len(orders), paste_all)
+        timed(results, pair, "combine_ps_and_sl", len(orders), combine_all)
+        results[-1]["matched_orders"] = len(orders)
+        timed(results, pair, "compose_order_pdf", len(orders), compose_all_pdfs)
+
+    if run_job:
+        # copies, the job deletes its work_dir and with it the pdfs
+        job_dir = u.make_job_dir()
+        ps_copy = shutil.copy(ps_pdf_path, job_dir + "ps.pdf")
+        sl_copy = shutil.copy(sl_pdf_path, job_dir + "sl.pdf")
+        timed(results, pair, "do_amazon_print_job", ps_pages_count + sl_pages_count, u.do_amazon_print_job, ps_copy, sl_copy, work_dir=job_dir)
+
+def bench_lone_sl(results, name, sl_pdf_path):
+    sl_dir = u.append_slash_if_needed(BENCH_WORKING_DIR) + name + "/"
+    os.makedirs(sl_dir + "sl", exist_ok=True)
+    os.makedirs(sl_dir + "oids_from_sl", exist_ok=True)
+
+    sl_pages_count = u.pdf_page_count(sl_pdf_path)
+    sl_pages = timed(results, name, "pdf_to_images2(sl)", sl_pages_count, u.pdf_to_images2, sl_pdf_path, sl_dir + "sl")
+    timed(results, name, "page_kinds(sl)", sl_pages_count, u.page_kinds, sl_pdf_path)
+    timed(results, name, "oids_from_sl", sl_pages_count, u.oids_from_sl, sl_pdf_path, sl_dir + "oids_from_sl")
+    if sl_pages:
+        timed(results, name, "tnos_from_sl", sl_pages_count, u.tnos_from_sl, sl_pages, sl_pdf_path)
+
+def previous_run(run_id):
+    # the results of the last run before run_id, as {(pair, stage): result}
+
+
+    runs = dict()
+    try:
+        with open(BENCH_RESULTS_PATH, "rt") as f:
+            for line in f:
+                r = json.loads(line)
+                runs.setdefault(r["run"], dict())[(r["pair"], r["stage"])] = r
+    except (OSError, ValueError):
+        return dict()
+
+    earlier = sorted(r for r in runs.keys() if r < run_id)
+    return runs[earlier[-1]] if earlier else dict()
+
+def report(results, previous):
+    print("\n%-16s %-24s %10s %10s %10s %9s  %s" % ("pair", "stage", "wall (s)", "pages/s", "rss (MB)", "accuracy", "vs previous run"))
+    for r in results:
+        before = previous.get((r["pair"], r["stage"]))
+        change = ""
+        if before and before.get("wall_time") and not r["error"]:
+            ratio = r["wall_time"] / before["wall_time"]
+            change = ("%.2fx" % ratio) + ("  <-- REGRESSION" if ratio > REGRESSION_THRESHOLD else "")
+        if before and before.get("accuracy") is not None and r.get("accuracy") is not None and r["accuracy"] < before["accuracy"]:
+            change += "  <-- ACCURACY DROPPED from " + str(before["accuracy"])
+
+        print("%-16s %-24s %10s %10s %10s %9s  %s" % (
+            r["pair"], r["stage"], r["wall_time"], r["pages_per_sec"] or "",
+            max(r["peak_rss_mb"], r["peak_children_rss_mb"]),
+            "" if r.get("accuracy") is None else r["accuracy"],
+            ("FAILED: " + r["error"]) if r["error"] else change
+        ))
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the amazon print pipeline against the pdfs in resources/")
+    parser.add_argument("--pairs", nargs="*", help="only these pairs, e.g. 1 4 for resources/1ps.pdf + 1sl.pdf and 4ps.pdf + 4sl.pdf")
+    parser.add_argument("--no-job", action="store_true", help="don't run do_amazon_print_job end to end, only the stages")
+    parser.add_argument("--no-lone-sls", action="store_true", help="skip brokensl.pdf and lone_sls/")
+    parser.add_argument("--ocr-cache", action="store_true", help="keep using the OCR cache, off by default so every run OCRs for real")
+    args = parser.parse_args()
+
+    u.PRINT_BACKEND = "fake"
+    u.PRINT_TO_PHYSICAL_PRINTER = True
+    u.PRINT_TO_VIRTUAL_PRINTER = False
+    u.FAKE_PRINTER_TARGET = u.append_slash_if_needed(BENCH_WORKING_DIR) + "fake_printer_target/"
+    u.JOBS_TARGET = u.append_slash_if_needed(BENCH_WORKING_DIR) + "jobs/"
+    u.USE_OCR_CACHE = args.ocr_cache
+
+    if os.path.isdir(BENCH_WORKING_DIR):
+        shutil.rmtree(BENCH_WORKING_DIR)
+    os.makedirs(BENCH_WORKING_DIR)
+
+    run_id = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+    results = list()
+    for name, ps_pdf_path, sl_pdf_path in pairs_in_resources(args.pairs):
+        bench_pair(results, name, ps_pdf_path, sl_pdf_path, run_job=not args.no_job)
+    if not args.no_lone_sls and not args.pairs:
+        for name, sl_pdf_path in lone_sls_in_resources():
+            bench_lone_sl(results, name, sl_pdf_path)
+
+    revision = git_revision()
+    with open(BENCH_RESULTS_PATH, "at") as f:
+        for r in results:
+            r["run"], r["revision"] = run_id, revision
+            f.write(json.dumps(r) + "\n")
+
+    report(results, previous_run(run_id))
+    u.log("Benchmark results appended to: " + BENCH_RESULTS_PATH)
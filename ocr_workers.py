@@ -0,0 +1,488 @@
+import utilities as u
+import concurrent.futures
+import collections
+import http.server
+import urllib.request
+import subprocess
+import itertools
+import threading
+import argparse
+import tempfile
+import shutil
+import hashlib
+import base64
+import socket
+import json
+import time
+import sys
+import io
+import os
+
+# Purpose of this script: It spreads the OCR and the rasterizing of the amazon system's pages over
+# several processes and hosts. The process running the print jobs (amazon.py or amazon_service.py)
+# runs an OCRCoordinator when u.OCR_COORDINATOR_ADDRESS is set, and any number of workers, on this
+# host or others, pull tasks from it:
+#
+#   python ocr_workers.py worker --coordinator http://<host>:8711 --threads 4 --processes 2
+#
+# Workers only ever talk to the coordinator, so they can come and go while jobs are running. A task
+# leased to a worker that stops sending heartbeats, or that hasn't finished it within its lease, is
+# handed to another worker; one that has failed MAX_TASK_ATTEMPTS times, or that is still waiting
+# when there are no workers left, fails, and utilities.py then does the work itself.
+#
+# Endpoints, all JSON, for the workers:
+#   POST /lease      {"worker": "...", "wait": seconds}    -> {"task_id", "kind", "args"}, or {} if nothing came up in time
+#   POST /result     {"worker": "...", "task_id": "...", "result": ...} or {..., "error": "..."}
+#   POST /heartbeat  {"worker": "..."}
+#   GET  /blobs/<sha1>                                      -> the pdf a "rasterize" task is about
+#   GET  /status
+#
+# There's no authentication, only run it on a network where everything may read the pdfs.
+
+###############################################################################################
+# Script Options:
+
+TASK_LEASE_SECONDS                        = 60   # a task not finished this long after it was leased is handed to another worker
+WORKER_TIMEOUT                            = 15   # a worker not heard from in this long is considered dead and its tasks are handed to others
+HEARTBEAT_SECONDS                         = 5    # keep it well below WORKER_TIMEOUT
+LEASE_WAIT_SECONDS                        = 20   # how long a lease request waits for a task before the worker asks again
+MAX_TASK_ATTEMPTS                         = 3
+WORKER_PDF_CACHE                          = 8    # pdfs a worker keeps around for the next "rasterize" tasks of the same pdf
+###############################################################################################
+
+
+class OCRCoordinator(http.server.ThreadingHTTPServer):
+    # Hands out tasks to the workers that ask for them and resolves their futures with the results.
+    # ocr() and rasterize() block the calling thread until their task(s) are done, like the local backends do.
+
+    daemon_threads = True
+
+    def __init__(self, address):
+        super().__init__(address, OCRCoordinatorRequestHandler)
+        self.cv = threading.Condition()
+        self.pending = collections.deque() # task_ids waiting for a worker
+        self.tasks = dict()                # task_id -> task, until it's done
+        self.blobs = dict()                # sha1 -> [bytes, number of tasks that need it]
+        self.workers = dict()              # worker -> when it was last heard from
+        self.task_ids = itertools.count(1)
+        self.stopped = False
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        threading.Thread(target=self.reap, daemon=True).start()
+        return self
+
+    def stop(self):
+        with self.cv:
+            self.stopped = True
+            for task in list(self.tasks.values()):
+                self.fail(task, "the coordinator stopped")
+            self.cv.notify_all()
+        self.shutdown()
+        self.server_close()
+
+    def live_workers(self):
+        now = time.time()
+        with self.cv:
+            return [ w for w, seen in self.workers.items() if now - seen < WORKER_TIMEOUT ]
+
+    def ocr(self, img, config):
+        buf = io.BytesIO()
+        img.save(buf, format="PNG")
+        return self.submit("ocr", {"png": base64.b64encode(buf.getvalue()).decode(), "config": config}).result()
+
+    def rasterize(self, path_to_pdf, dpi, pages, mode, pages_per_task):
+        '''
+        The pages (first, last) of the pdf as decoded images, in page order. Every pages_per_task
+        of them are a task of their own so that several workers can work on the same pdf.
+        '''
+
+        with open(path_to_pdf, "rb") as f:
+            pdf = f.read()
+
+        first, last = pages
+        futures = [
+            self.submit("rasterize", {"dpi": dpi, "range": [p, min(p + pages_per_task - 1, last)], "mode": mode}, blob=pdf)
+            for p in range(first, last + 1, pages_per_task)
+        ]
+
+        images = []
+        try:
+            for future in futures:
+                for png in future.result():
+                    img = u.Image.open(io.BytesIO(base64.b64decode(png)))
+                    img.load()
+                    images.append(img)
+        except Exception:
+            self.cancel(futures) # the pdf can't be rasterized anyway, so the other chunks needn't be either
+            raise
+        return images
+
+    def submit(self, kind, args, blob=None):
+        future = concurrent.futures.Future()
+        with self.cv:
+            if self.stopped:
+                raise RuntimeError("the coordinator stopped")
+
+            sha1 = None
+            if blob is not None:
+                sha1 = hashlib.sha1(blob).hexdigest()
+                self.blobs.setdefault(sha1, [blob, 0])[1] += 1
+                args = dict(args, blob=sha1)
+
+            task_id = str(next(self.task_ids))
+            self.tasks[task_id] = {"task_id": task_id, "kind": kind, "args": args, "blob": sha1, "future": future,
+                                   "attempts": 0, "worker": None, "deadline": None, "submitted": time.time()}
+            self.pending.append(task_id)
+            self.cv.notify_all()
+        return future
+
+    def lease(self, worker, wait):
+        # the next pending task for the worker, waits up to `wait` seconds for one to come up
+
+        deadline = time.time() + wait
+        with self.cv:
+            self.workers[worker] = time.time()
+            while True:
+                while self.pending and self.pending[0] not in self.tasks: # done by an earlier worker after it was handed out again
+                    self.pending.popleft()
+                if self.stopped:
+                    return None
+                if self.pending:
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self.cv.wait(remaining)
+
+            task = self.tasks[self.pending.popleft()]
+            task["attempts"] += 1
+            task["worker"] = worker
+            task["deadline"] = time.time() + TASK_LEASE_SECONDS
+            return {"task_id": task["task_id"], "kind": task["kind"], "args": task["args"]}
+
+    def finish(self, worker, task_id, result=None, error=None):
+        with self.cv:
+            self.workers[worker] = time.time()
+            task = self.tasks.get(task_id)
+            if task is None: # it was handed out again and the other worker was quicker
+                return
+
+            if error is not None:
+                if task["worker"] != worker: # it was handed out again already, to a worker that may still succeed
+                    return
+                u.log("Worker " + worker + " failed task " + task_id + " (" + task["kind"] + "): " + error)
+                self.requeue(task, error)
+                return
+
+            self.close(task)
+            task["future"].set_result(result)
+
+    def cancel(self, futures):
+        # closes the tasks of the futures that aren't done yet, a worker that's still on one has its result ignored
+
+        with self.cv:
+            for task in [ t for t in self.tasks.values() if t["future"] in futures ]:
+                self.close(task)
+                task["future"].cancel()
+
+    def unlease(self, worker, task_id):
+        with self.cv:
+            task = self.tasks.get(task_id)
+            if task is not None and task["worker"] == worker:
+                task["attempts"] -= 1
+                task["worker"] = None
+                task["deadline"] = None
+                self.pending.appendleft(task_id)
+                self.cv.notify_all()
+
+    def heartbeat(self, worker):
+        with self.cv:
+            if worker not in self.workers:
+                u.log("OCR worker joined: " + worker)
+            self.workers[worker] = time.time()
+
+    def reap(self):
+        # hands the tasks of dead and stuck workers to others, fails what's still waiting if no workers are left
+
+        while not self.stopped:
+            time.sleep(1)
+            now = time.time()
+            with self.cv:
+                dead = { w for w, seen in self.workers.items() if now - seen > WORKER_TIMEOUT }
+                for worker in dead:
+                    u.log("OCR worker " + worker + " hasn't been heard from in " + str(WORKER_TIMEOUT) + "s, handing its tasks to the others")
+                    del self.workers[worker]
+
+                for task in list(self.tasks.values()):
+                    if task["worker"] in dead:
+                        self.requeue(task, "worker " + task["worker"] + " died")
+                    elif task["worker"] is not None and now > task["deadline"]:
+                        self.requeue(task, "worker " + task["worker"] + " didn't finish it within " + str(TASK_LEASE_SECONDS) + "s")
+
+                if not self.workers:
+                    for task in [ self.tasks[t] for t in self.pending if t in self.tasks ]:
+                        if now - task["submitted"] > WORKER_TIMEOUT:
+                            self.fail(task, "there are no workers")
+
+    def requeue(self, task, reason):
+        # call with self.cv held
+
+        if task["attempts"] >= MAX_TASK_ATTEMPTS:
+            return self.fail(task, reason + ", after " + str(task["attempts"]) + " attempts")
+
+        task["worker"] = None
+        task["deadline"] = None
+        self.pending.appendleft(task["task_id"]) # it has waited long enough already
+        self.cv.notify_all()
+
+    def fail(self, task, reason):
+        # call with self.cv held
+
+        self.close(task)
+        task["future"].set_exception(RuntimeError("task " + task["task_id"] + " (" + task["kind"] + ") failed: " + reason))
+
+    def close(self, task):
+        # call with self.cv held
+
+        del self.tasks[task["task_id"]]
+        if task["blob"] is not None:
+            blob = self.blobs[task["blob"]]
+            blob[1] -= 1
+            if blob[1] == 0:
+                del self.blobs[task["blob"]]
+
+    def blob(self, sha1):
+        with self.cv:
+            blob = self.blobs.get(sha1)
+            return blob[0] if blob else None
+
+    def status(self):
+        now = time.time()
+        with self.cv:
+            return {
+                "type": "status",
+                "workers": { w: round(now - seen, 1) for w, seen in self.workers.items() }, # seconds since last heard from
+                "pending_tasks": sum(1 for t in self.pending if t in self.tasks),
+                "leased_tasks": sum(1 for t in self.tasks.values() if t["worker"] is not None),
+                "blobs": len(self.blobs),
+            }
+
+
+class OCRCoordinatorRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/status":
+            return self.send_json(200, self.server.status())
+
+        if self.path.startswith("/blobs/"):
+            blob = self.server.blob(self.path[len("/blobs/"):])
+            if blob is None:
+                return self.send_json(404, {"type": "error", "error": "no such blob, its tasks are done"})
+            self.send_response(200)
+            self.send_header("Content-Type", "application/pdf")
+            self.send_header("Content-Length", str(len(blob)))
+            self.end_headers()
+            self.wfile.write(blob)
+            return
+
+        self.send_json(404, {"type": "error", "error": "no such endpoint: " + self.path})
+
+    def do_POST(self):
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            worker = str(request["worker"])
+        except (ValueError, KeyError) as e:
+            return self.send_json(400, {"type": "error", "error": "bad request: " + repr(e)})
+
+        if self.path == "/lease":
+            task = self.server.lease(worker, min(float(request.get("wait", 0)), LEASE_WAIT_SECONDS))
+            try:
+                self.send_json(200, task or {})
+            except OSError: # the worker hung up while it was waiting, someone else gets the task
+                if task:
+                    self.server.unlease(worker, task["task_id"])
+        elif self.path == "/result":
+            self.server.finish(worker, str(request.get("task_id")), request.get("result"), request.get("error"))
+            self.send_json(200, {})
+        elif self.path == "/heartbeat":
+            self.server.heartbeat(worker)
+            self.send_json(200, {})
+        else:
+            self.send_json(404, {"type": "error", "error": "no such endpoint: " + self.path})
+
+    def send_json(self, status, obj):
+        body = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # a request every few seconds from every worker thread, the coordinator logs what matters itself
+
+
+def start_coordinator(address=None):
+    # starts a coordinator on address (u.OCR_COORDINATOR_ADDRESS by default) and has utilities.py use it
+
+    address = tuple(address or u.OCR_COORDINATOR_ADDRESS)
+    coordinator = OCRCoordinator(address).start()
+    u.use_ocr_coordinator(coordinator)
+    u.log("OCR coordinator listening on " + address[0] + ":" + str(address[1]) + ", waiting for workers")
+    return coordinator
+
+def stop_coordinator(coordinator):
+    u.use_ocr_coordinator(None)
+    coordinator.stop()
+
+###############################################################################################
+# Worker side.
+
+class OCRWorker:
+    # Pulls tasks from the coordinator on `threads` threads until it's stopped, riding out the
+    # coordinator being restarted or unreachable for a while.
+
+    def __init__(self, coordinator_url, threads, name=None):
+        self.url = coordinator_url.rstrip("/")
+        self.threads = threads
+        self.name = name or socket.gethostname() + "-" + str(os.getpid())
+        self.stopped = threading.Event()
+        self.pdf_dir = tempfile.mkdtemp(prefix="ocr_worker_")
+        self.pdfs = collections.OrderedDict() # sha1 -> path, the most recently used last
+        self.pdfs_lock = threading.Lock()
+
+    def run(self):
+        u.log("OCR worker " + self.name + " working for " + self.url + " on " + str(self.threads) + " thread(s) with the " + u.ocr_backend_name() + " backend")
+        threads = [ threading.Thread(target=self.work, daemon=True) for _ in range(self.threads) ]
+        threads.append(threading.Thread(target=self.send_heartbeats, daemon=True))
+        for t in threads:
+            t.start()
+
+        try:
+            while not self.stopped.wait(1):
+                pass
+        except KeyboardInterrupt:
+            u.log("Closing all threads, please wait...")
+        finally:
+            self.stopped.set()
+            shutil.rmtree(self.pdf_dir, ignore_errors=True)
+
+    def work(self):
+        u.keep_tesserocr_engine() # these threads live as long as the worker
+        backoff = 1
+        while not self.stopped.is_set():
+            try:
+                task = self.call("/lease", {"wait": LEASE_WAIT_SECONDS}, timeout=LEASE_WAIT_SECONDS + 10)
+                backoff = 1
+            except (OSError, ValueError) as e:
+                u.log("Couldn't reach the coordinator at " + self.url + ", retrying in " + str(backoff) + "s: " + repr(e))
+                self.stopped.wait(backoff)
+                backoff = min(2 * backoff, 30)
+                continue
+
+            if not task:
+                continue
+
+            try:
+                reply = {"result": self.execute(task)}
+            except Exception as e:
+                reply = {"error": repr(e)}
+
+            try:
+                self.call("/result", dict(reply, task_id=task["task_id"]), timeout=60)
+            except (OSError, ValueError) as e: # the task will be handed out again once its lease runs out
+                u.log("Couldn't return task " + task["task_id"] + " to the coordinator: " + repr(e))
+
+    def execute(self, task):
+        args = task["args"]
+        if task["kind"] == "ocr":
+            img = u.Image.open(io.BytesIO(base64.b64decode(args["png"])))
+            return u.str_from_img(img, config=args["config"])
+
+        if task["kind"] == "rasterize":
+            pages = u.pdf_to_images_in_memory(self.pdf(args["blob"]), dpi=args["dpi"], page_range=tuple(args["range"]), mode=args["mode"])
+            pngs = []
+            for page_num in sorted(pages):
+                buf = io.BytesIO()
+                pages[page_num].save(buf, format="PNG") # keeps the mode, so "1" pages arrive as "1" pages
+                pages[page_num].close()
+                pngs.append(base64.b64encode(buf.getvalue()).decode())
+            return pngs
+
+        raise ValueError("unknown task kind: " + str(task["kind"]))
+
+    def pdf(self, sha1):
+        # the path to the pdf of a "rasterize" task, downloaded from the coordinator the first time
+
+        with self.pdfs_lock:
+            if sha1 in self.pdfs:
+                self.pdfs.move_to_end(sha1)
+                return self.pdfs[sha1]
+
+        with urllib.request.urlopen(self.url + "/blobs/" + sha1, timeout=60) as response:
+            blob = response.read()
+        if hashlib.sha1(blob).hexdigest() != sha1:
+            raise ValueError("the pdf " + sha1 + " arrived damaged")
+
+        path = self.pdf_dir + os.sep + sha1 + ".pdf"
+        with open(path, "wb") as f:
+            f.write(blob)
+
+        with self.pdfs_lock:
+            self.pdfs[sha1] = path
+            while len(self.pdfs) > WORKER_PDF_CACHE:
+                _, old = self.pdfs.popitem(last=False)
+                if os.path.exists(old):
+                    os.remove(old)
+        return path
+
+    def send_heartbeats(self):
+        while not self.stopped.wait(HEARTBEAT_SECONDS):
+            try:
+                self.call("/heartbeat", {}, timeout=HEARTBEAT_SECONDS)
+            except (OSError, ValueError):
+                pass # work() logs it
+
+    def call(self, endpoint, obj, timeout):
+        request = urllib.request.Request(self.url + endpoint, data=json.dumps(dict(obj, worker=self.name)).encode(), headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return json.loads(response.read() or b"{}")
+
+
+def run_workers(coordinator_url, threads, processes):
+    # runs `processes` workers, each in a process of its own so they don't share the GIL, and restarts the ones that die
+
+    if processes <= 1:
+        return OCRWorker(coordinator_url, threads).run()
+
+    command = [sys.executable, os.path.abspath(__file__), "worker", "--coordinator", coordinator_url, "--threads", str(threads)]
+    children = [ subprocess.Popen(command) for _ in range(processes) ]
+    try:
+        while True:
+            time.sleep(5)
+            for i, child in enumerate(children):
+                if child.poll() is not None:
+                    u.log("OCR worker process " + str(child.pid) + " exited with " + str(child.returncode) + ", restarting it")
+                    children[i] = subprocess.Popen(command)
+    except KeyboardInterrupt:
+        u.log("Closing all workers, please wait...")
+    finally:
+        for child in children:
+            child.terminate()
+        for child in children:
+            child.wait()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run OCR workers for the coordinator of a running amazon system.")
+    parser.add_argument("command", choices=["worker", "status"])
+    parser.add_argument("--coordinator", required=True, help="the coordinator's URL, e.g. http://printstation:8711")
+    parser.add_argument("--threads", type=int, default=u.OCR_WORKERS, help="tasks worked on at the same time by each worker process")
+    parser.add_argument("--processes", type=int, default=1, help="worker processes to run on this host")
+    args = parser.parse_args()
+
+    if args.command == "worker":
+        run_workers(args.coordinator, args.threads, args.processes)
+    else:
+        with urllib.request.urlopen(args.coordinator.rstrip("/") + "/status", timeout=10) as response:
+            print(json.dumps(json.loads(response.read()), indent=4))
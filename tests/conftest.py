@@ -0,0 +1,7 @@
+import sys
+import os
+
+# the modules live at the top of the repo, not in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+RESOURCES_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + os.sep + "resources" + os.sep
@@ -0,0 +1,145 @@
+import utilities as u
+import threading
+import amazon
+import pytest
+import time
+import os
+
+
+class FakeJobQueue:
+    def __init__(self):
+        self.submitted = list()
+
+    def submit(self, ps_pdf_path, sl_pdf_path, speculative_job, sl_oids=None):
+        self.submitted.append((os.path.basename(ps_pdf_path), os.path.basename(sl_pdf_path), sl_oids))
+
+    def stop(self):
+        pass
+
+@pytest.fixture
+def pairer(monkeypatch, tmp_path):
+    # every pdf's speculative job identifies it as whatever RESULTS has for its name, once its "identify" event is set
+
+    results = dict()
+    jobs    = dict()
+    alerts  = list()
+
+    def start_speculative_job(pdf_path, delay=0):
+        name = os.path.basename(pdf_path)
+        job  = {"pdf_path": pdf_path, "dir": str(tmp_path / "spec"), "cancelled": threading.Event(), "result": None, "identify": threading.Event()}
+        def work():
+            job["identify"].wait(5)
+            if not job["cancelled"].is_set():
+                job["result"] = results[name]
+        job["thread"] = threading.Thread(target=work, daemon=True)
+        job["thread"].start()
+        jobs.setdefault(name, list()).append(job)
+        return job
+
+    def cancel_speculative_job(job):
+        job["cancelled"].set()
+        job["identify"].set()
+        job["thread"].join()
+        job["result"] = None
+
+    monkeypatch.setattr(u, "start_speculative_job", start_speculative_job)
+    monkeypatch.setattr(u, "cancel_speculative_job", cancel_speculative_job)
+    monkeypatch.setattr(u, "display_alert", lambda msg, blocking=True: alerts.append(msg))
+    monkeypatch.setattr(amazon, "MIN_OID_OVERLAP_TO_PAIR", 0.5)
+
+    pairer = amazon.AmazonPairer(FakeJobQueue())
+    pairer.results, pairer.jobs, pairer.alerts, pairer.dir = results, jobs, alerts, tmp_path
+    return pairer
+
+def ps(*oids):
+    return {"is_ps": True, "oids": dict(enumerate(oids, 1)), "sl_oids": None}
+
+def sl(*oids):
+    return {"is_ps": False, "oids": None, "sl_oids": dict(enumerate(oids, 1))}
+
+def receive(pairer, name, result):
+    pairer.results[name] = result
+    (pairer.dir / name).write_bytes(b"%PDF")
+    pairer.add(str(pairer.dir / name))
+
+def identify(pairer, name):
+    job = pairer.jobs[name][-1]
+    job["identify"].set()
+    job["thread"].join()
+    path = str(pairer.dir / name)
+    wait_until(lambda: pairer.pending.get(path, {"identified": "paired up already"})["identified"])
+
+def wait_until(condition):
+    deadline = time.time() + 5
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    assert condition()
+
+A, B, C, D = "111-1111111-1111111", "222-2222222-2222222", "333-3333333-3333333", "444-4444444-4444444"
+
+def test_pairs_by_overlap(pairer):
+    receive(pairer, "ps1.pdf", ps(A, B))
+    receive(pairer, "ps2.pdf", ps(C, D))
+    receive(pairer, "sl2.pdf", sl(D, C)) # in another order than the ps_pdf, and before the ps_pdfs are identified
+    receive(pairer, "sl1.pdf", sl(A, B))
+    for name in ("sl2.pdf", "sl1.pdf", "ps1.pdf"):
+        identify(pairer, name)
+    wait_until(lambda: len(pairer.job_queue.submitted) == 1)
+    assert pairer.job_queue.submitted == [("ps1.pdf", "sl1.pdf", {1: A, 2: B})]
+
+    identify(pairer, "ps2.pdf")
+    wait_until(lambda: len(pairer.job_queue.submitted) == 2)
+    assert pairer.job_queue.submitted[1] == ("ps2.pdf", "sl2.pdf", {1: D, 2: C})
+    assert pairer.pending == {}
+
+def test_too_little_overlap_is_not_paired(pairer):
+    receive(pairer, "ps.pdf", ps(A, B, C))
+    receive(pairer, "sl.pdf", sl(A, D, "555-5555555-5555555"))
+    identify(pairer, "ps.pdf")
+    identify(pairer, "sl.pdf")
+
+    assert pairer.job_queue.submitted == []
+    assert sorted(os.path.basename(p) for p in pairer.pending) == ["ps.pdf", "sl.pdf"]
+
+    receive(pairer, "sl2.pdf", sl(A, B, D))
+    identify(pairer, "sl2.pdf")
+    wait_until(lambda: pairer.job_queue.submitted == [("ps.pdf", "sl2.pdf", {1: A, 2: B, 3: D})])
+
+def test_resent_pdf_replaces_the_pending_one(pairer):
+    receive(pairer, "ps.pdf", ps(A, B))
+    receive(pairer, "ps.pdf", ps(C, D))
+    wait_until(lambda: pairer.jobs["ps.pdf"][0]["cancelled"].is_set())
+    assert len(pairer.pending) == 1
+
+    receive(pairer, "sl.pdf", sl(C, D))
+    identify(pairer, "sl.pdf")
+    identify(pairer, "ps.pdf")
+    wait_until(lambda: pairer.job_queue.submitted == [("ps.pdf", "sl.pdf", {1: C, 2: D})])
+
+def test_not_a_pdf_is_ignored(pairer):
+    receive(pairer, ".ps.pdf", ps(A))
+    receive(pairer, "ps.txt", ps(A))
+    os.mkdir(pairer.dir / "dir.pdf")
+    pairer.add(str(pairer.dir / "dir.pdf"))
+    assert pairer.pending == {} and pairer.jobs == {}
+
+def test_expiry_counts_from_identification(pairer, monkeypatch):
+    monkeypatch.setattr(amazon, "WAIT_TIME_FOR_2ND_PDF", 0.2)
+
+    receive(pairer, "ps.pdf", ps(A, B))
+    receive(pairer, "sl.pdf", sl(C, D))
+    identify(pairer, "sl.pdf")
+    time.sleep(0.3)
+
+    # ps.pdf has been pending for long enough but it's still being identified
+    pairer.expire()
+    assert [ os.path.basename(p) for p in pairer.pending ] == ["ps.pdf"]
+    assert not (pairer.dir / "sl.pdf").exists()
+    assert len(pairer.alerts) == 1 and "sl.pdf" in pairer.alerts[0]
+
+    identify(pairer, "ps.pdf")
+    pairer.expire()
+    assert [ os.path.basename(p) for p in pairer.pending ] == ["ps.pdf"]
+    time.sleep(0.3)
+    pairer.expire()
+    assert pairer.pending == {} and not (pairer.dir / "ps.pdf").exists()
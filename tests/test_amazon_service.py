@@ -0,0 +1,107 @@
+import amazon_service as s
+import utilities as u
+import urllib.request
+import urllib.error
+import threading
+import amazon
+import pytest
+import json
+import os
+
+
+class FakePairer:
+    def __init__(self):
+        self.pending = dict()
+        self.added = list()
+
+    def add(self, path_to_pdf):
+        self.added.append(path_to_pdf)
+
+    def stop(self):
+        pass
+
+@pytest.fixture
+def service(monkeypatch, tmp_path):
+    monkeypatch.setattr(u, "JOBS_TARGET", str(tmp_path / "jobs") + "/")
+    monkeypatch.setattr(s, "SERVICE_OUTPUT_TARGET", str(tmp_path / "service_output") + "/")
+    monkeypatch.setattr(amazon, "AMAZON_VP_DESTINATION_FOLDER", str(tmp_path / "vp") + "/")
+    os.makedirs(tmp_path / "vp")
+
+    server = s.AmazonService(("127.0.0.1", 0))
+    server.pairer = FakePairer()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    server.url = "http://127.0.0.1:" + str(server.server_address[1])
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def http_error(fn, *args):
+    with pytest.raises(urllib.error.HTTPError) as e:
+        fn(*args)
+    return e.value.code
+
+def test_pairs_are_streamed_order_by_order(service, monkeypatch, tmp_path):
+    second_order = threading.Event()
+
+    def do_amazon_print_job(pdfA, pdfB, speculative_job=None, work_dir=None, on_order=None, for_real=None, sl_oids=None):
+        assert open(pdfA, "rb").read() == b"ps" and open(pdfB, "rb").read() == b"sl"
+        assert for_real is False
+        for n in (1, 2):
+            for name in ("PP", "LL"):
+                with open(work_dir + name + str(n) + ".pdf", "wb") as f:
+                    f.write(name.encode())
+            order = {"order_id": str(n), "tracking_number": "tno" + str(n), "match_confidence": 1.0,
+                     "ps_path": work_dir + "PP" + str(n) + ".pdf", "combined_ps_and_sl_path": work_dir + "LL" + str(n) + ".pdf"}
+            on_order(order)
+            assert second_order.wait(5) # the first order must reach the client while the job is still running
+    monkeypatch.setattr(u, "do_amazon_print_job", do_amazon_print_job)
+
+    (tmp_path / "ps.pdf").write_bytes(b"ps")
+    results = s.submit_pair(str(tmp_path / "ps.pdf"), b"sl", print_them=False, url=service.url, timeout=10)
+
+    first = next(results)
+    assert first["type"] == "order" and first["order_id"] == "1" and first["tracking_number"] == "tno1"
+    assert open(first["combined_ps_and_sl_path"], "rb").read() == b"LL"
+    second_order.set()
+
+    rest = list(results)
+    assert [ r["type"] for r in rest ] == ["order", "done"]
+    assert rest[0]["order_id"] == "2"
+    assert os.path.dirname(rest[0]["ps_path"]) + "/" == rest[1]["output_dir"]
+
+def test_failed_pair(service, monkeypatch):
+    def do_amazon_print_job(*args, **kwargs):
+        raise ValueError("no oids")
+    monkeypatch.setattr(u, "do_amazon_print_job", do_amazon_print_job)
+
+    results = list(s.submit_pair(b"ps", b"sl", print_them=False, url=service.url, timeout=10))
+    assert results == [{"type": "error", "error": "ValueError('no oids')", "printed_order_ids": []}]
+
+    assert http_error(s.post, service.url + "/pairs", {"pdfs": [{"path": "a"}]}, 10) == 400
+
+def test_pdfs_only_from_the_watched_folder(service, tmp_path):
+    (tmp_path / "vp" / "a.pdf").write_bytes(b"pdf")
+    (tmp_path / "b.pdf").write_bytes(b"pdf")
+    os.symlink(tmp_path / "b.pdf", tmp_path / "vp" / "link.pdf")
+
+    assert json.loads(s.submit_pdf(str(tmp_path / "vp" / "a.pdf"), url=service.url)) == {"type": "queued", "pdf": "a.pdf"}
+    assert http_error(s.submit_pdf, str(tmp_path / "b.pdf"), service.url) == 403
+    assert http_error(s.submit_pdf, str(tmp_path / "vp" / ".." / "b.pdf"), service.url) == 403
+    assert http_error(s.submit_pdf, str(tmp_path / "vp" / "link.pdf"), service.url) == 403
+    assert http_error(s.submit_pdf, str(tmp_path / "vp" / "none.pdf"), service.url) == 400
+
+    assert service.pairer.added == [os.path.realpath(tmp_path / "vp" / "a.pdf")]
+
+def test_posts_must_be_json(service, tmp_path):
+    (tmp_path / "vp" / "a.pdf").write_bytes(b"pdf")
+    body = json.dumps({"path": str(tmp_path / "vp" / "a.pdf")}).encode()
+
+    for content_type in ("text/plain", "application/x-www-form-urlencoded"):
+        request = urllib.request.Request(service.url + "/pdfs", data=body, headers={"Content-Type": content_type})
+        assert http_error(urllib.request.urlopen, request) == 415
+    assert service.pairer.added == []
+
+def test_status(service):
+    with urllib.request.urlopen(service.url + "/status") as response:
+        status = json.loads(response.read())
+    assert status["type"] == "status" and status["running_jobs"] == 0
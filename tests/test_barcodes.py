@@ -0,0 +1,50 @@
+import utilities as u
+import itertools
+import barcode
+
+
+UPS   = "1Z09AY330392784049"
+FEDEX = "9622080430006094377900393378131941"
+USPS  = u.FNC1 + "42085142" + u.FNC1 + "9305520111404895586169"
+
+def modules(data):
+    # the bars (1) and spaces (0) of data's Code128 barcode, start and stop symbols included
+    return barcode.get("code128", data).build()[0]
+
+def widths(data, scale=1):
+    return [ scale * len(list(g)) for _, g in itertools.groupby(modules(data)) ]
+
+def scanline(data, scale=3):
+    # a grayscale pixel row across the barcode, between quiet zones
+    line = bytearray(b"\xff" * 40)
+    for m in modules(data):
+        line += (b"\x10" if m == "1" else b"\xf0") * scale
+    line += b"\xff" * 40
+    return bytes(line)
+
+def test_decode_code128():
+    for data in (UPS, FEDEX, "Hello, World!"):
+        assert u.decode_code128(widths(data)) == (data, len(widths(data)))
+        assert u.decode_code128(widths(data, scale=4)) == (data, len(widths(data)))
+
+    assert u.decode_code128(widths(USPS))[0] == USPS
+
+def test_decode_code128_rejects_bad_checksums():
+    bad = widths(UPS)
+    bad[7], bad[8] = bad[8], bad[7] # swaps a bar and a space of the first data symbol
+    assert u.decode_code128(bad) == (None, 0)
+    assert u.decode_code128(widths(UPS)[:30]) == (None, 0)
+
+def test_code128_from_scanline():
+    assert u.code128_from_scanline(scanline(UPS)) == [UPS]
+    assert u.code128_from_scanline(scanline(UPS)[::-1]) == [UPS] # the label was upside down
+    assert u.code128_from_scanline(scanline(UPS) + scanline(FEDEX, scale=2)) == [UPS, FEDEX]
+    assert u.code128_from_scanline(b"\xff" * 200) == []
+
+def test_tno_from_barcode_data():
+    assert u.tno_from_barcode_data(UPS) == UPS
+    assert u.tno_from_barcode_data(FEDEX) == "393378131941"
+    assert u.tno_from_barcode_data(USPS) == "9305520111404895586169"
+    assert u.tno_from_barcode_data("9305520111404895586169") == "9305520111404895586169"
+    assert u.tno_from_barcode_data(u.FNC1 + "420851421234") is None # just the zip
+    assert u.tno_from_barcode_data("111-1111111-1111111") is None
@@ -0,0 +1,19 @@
+import benchmark
+
+
+def test_accuracy():
+    assert benchmark.accuracy({1: "a", 2: "x", 3: "c"}, ["a", "b", "c"]) == 0.6667
+    assert benchmark.accuracy(None, ["a"]) is None
+    assert benchmark.accuracy({}, []) is None
+
+def test_unordered_accuracy():
+    expected = ["a", "b", "c", "d"]
+
+    # the SL oids come in a different order than the PS ones, that's not a mistake
+    assert benchmark.unordered_accuracy({1: "d", 2: "c", 3: "b", 4: "a"}, expected) == 1.0
+    assert benchmark.accuracy({1: "d", 2: "c", 3: "b", 4: "a"}, expected) == 0.0
+
+    assert benchmark.unordered_accuracy({1: "d", 2: "x", 3: "b", 4: "a"}, expected) == 0.75
+    # an oid read twice only counts once
+    assert benchmark.unordered_accuracy({1: "a", 2: "a", 3: "a", 4: "a"}, expected) == 0.25
+    assert benchmark.unordered_accuracy(None, expected) is None
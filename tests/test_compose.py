@@ -0,0 +1,21 @@
+from conftest import RESOURCES_DIR
+import utilities as u
+import os
+
+
+def test_orders_sharing_an_order_id_get_files_of_their_own(tmp_path):
+    # e.g. an order that ships in two boxes, two PS pages and two labels with the same order_ID
+    orders = [
+        {"order_id": "111-1111111-1111111", "tracking_number": tno, "ps_source": (RESOURCES_DIR + "1ps.pdf", p), 
+         "sl_source": (RESOURCES_DIR + "1sl.pdf", p), "ps_page": None, "sl_page": None, "match_confidence": 1.0}
+        for p, tno in ((1, "1Z09AY330392784049"), (2, "1Z09AY330392784050"))
+    ]
+    os.makedirs(tmp_path / "ps")
+    os.makedirs(tmp_path / "combined")
+    for order in orders:
+        u.compose_order_pdf(order, str(tmp_path / "ps"), str(tmp_path / "combined"))
+
+    assert os.path.basename(orders[0]["ps_path"]) == "1-111-1111111-1111111.pdf"
+    assert len({ o["ps_path"] for o in orders } | { o["combined_ps_and_sl_path"] for o in orders }) == 4
+    assert all( os.path.exists(o[k]) for o in orders for k in ("ps_path", "combined_ps_and_sl_path") )
+    assert open(orders[0]["ps_path"], "rb").read() != open(orders[1]["ps_path"], "rb").read()
@@ -0,0 +1,57 @@
+import utilities as u
+import pytest
+
+
+@pytest.fixture
+def ocr_cache(monkeypatch, tmp_path):
+    monkeypatch.setattr(u, "OCR_CACHE_PATH", str(tmp_path / "ocr_cache.sqlite3"))
+    monkeypatch.setattr(u, "METRICS_PATH", str(tmp_path / "metrics.jsonl"))
+    monkeypatch.setattr(u, "_ocr_cache_db", None)
+    monkeypatch.setattr(u, "_ocr_cache_bytes", 0)
+    monkeypatch.setattr(u, "ocr_cache_stats", {"hits": 0, "misses": 0, "evictions": 0})
+    yield
+    u._ocr_cache_db.close()
+
+def test_get_and_put(ocr_cache):
+    assert u.ocr_cache_get("a") is None
+    u.ocr_cache_put("a", "text")
+    assert u.ocr_cache_get("a") == "text"
+
+    u.ocr_cache_put("a", "longer text") # replacing counts only the new size
+    assert u._ocr_cache_bytes == len("longer text")
+    assert u.ocr_cache_stats == {"hits": 1, "misses": 1, "evictions": 0}
+
+def test_evicts_least_recently_used(ocr_cache, monkeypatch):
+    monkeypatch.setattr(u, "OCR_CACHE_MAX_BYTES", 25)
+
+    u.ocr_cache_put("a", "a" * 10)
+    u.ocr_cache_put("b", "b" * 10)
+    assert u.ocr_cache_get("a") # "b" is now the least recently used
+    u.ocr_cache_put("c", "c" * 10)
+
+    assert u.ocr_cache_get("b") is None
+    assert u.ocr_cache_get("a") and u.ocr_cache_get("c")
+    assert u._ocr_cache_bytes == 20
+    assert u.ocr_cache_stats["evictions"] == 1
+
+def test_running_total_survives_reopening(ocr_cache, monkeypatch):
+    u.ocr_cache_put("a", "a" * 10)
+    u.ocr_cache_put("b", "b" * 10)
+    u._ocr_cache_db.close()
+    monkeypatch.setattr(u, "_ocr_cache_db", None)
+    monkeypatch.setattr(u, "_ocr_cache_bytes", 0)
+
+    u.ocr_cache()
+    assert u._ocr_cache_bytes == 20
+
+def test_summary_is_per_job(ocr_cache):
+    u.ocr_cache_get("a")
+    with u.job_metrics("A.pdf", "B.pdf") as job:
+        assert u.ocr_cache_summary() == "OCR cache: hits=0, misses=0, evictions=0"
+        u.ocr_cache_put("a", "text")
+        u.ocr_cache_get("a")
+        u.ocr_cache_get("b")
+        assert u.ocr_cache_summary() == "OCR cache: hits=1, misses=1, evictions=0"
+
+    assert job["counters"] == {"ocr_cache_hits": 1, "ocr_cache_misses": 1}
+    assert u.ocr_cache_summary() == "OCR cache since start: hits=1, misses=2, evictions=0"
@@ -0,0 +1,106 @@
+import ocr_workers as o
+import urllib.request
+import threading
+import pytest
+import json
+import time
+
+
+@pytest.fixture
+def coordinator():
+    coordinator = o.OCRCoordinator(("127.0.0.1", 0)).start()
+    coordinator.url = "http://127.0.0.1:" + str(coordinator.server_address[1])
+    yield coordinator
+    coordinator.stop()
+
+def post(url, obj):
+    request = urllib.request.Request(url, data=json.dumps(obj).encode(), headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return json.loads(response.read())
+
+def test_lease_and_finish_over_http(coordinator):
+    future = coordinator.submit("ocr", {"config": "--psm 6"})
+
+    task = post(coordinator.url + "/lease", {"worker": "w1", "wait": 1})
+    assert task == {"task_id": "1", "kind": "ocr", "args": {"config": "--psm 6"}}
+    assert post(coordinator.url + "/lease", {"worker": "w2", "wait": 0}) == {}
+
+    post(coordinator.url + "/result", {"worker": "w1", "task_id": "1", "result": "text"})
+    assert future.result(timeout=1) == "text"
+    assert coordinator.status()["pending_tasks"] == 0 and coordinator.tasks == {}
+
+def test_failed_task_is_requeued_until_max_attempts(coordinator, monkeypatch):
+    monkeypatch.setattr(o, "MAX_TASK_ATTEMPTS", 2)
+    future = coordinator.submit("ocr", {})
+
+    task = coordinator.lease("w1", 0)
+    coordinator.finish("w1", task["task_id"], error="boom")
+    assert not future.done()
+
+    task = coordinator.lease("w2", 0)
+    assert task is not None
+    coordinator.finish("w2", task["task_id"], error="boom again")
+    with pytest.raises(RuntimeError, match="after 2 attempts"):
+        future.result(timeout=1)
+
+def test_stale_workers_error_is_ignored(coordinator):
+    future = coordinator.submit("ocr", {})
+
+    task = coordinator.lease("w1", 0)
+    with coordinator.cv:
+        coordinator.requeue(coordinator.tasks[task["task_id"]], "w1 took too long")
+    assert coordinator.lease("w2", 0)["task_id"] == task["task_id"]
+
+    # w1 reports back late, w2 keeps its lease and its attempt
+    coordinator.finish("w1", task["task_id"], error="boom")
+    assert coordinator.tasks[task["task_id"]]["worker"] == "w2"
+    assert coordinator.tasks[task["task_id"]]["attempts"] == 2
+    assert coordinator.lease("w1", 0) is None
+
+    coordinator.finish("w2", task["task_id"], result="text")
+    assert future.result(timeout=1) == "text"
+
+def test_failed_chunk_cancels_the_others(coordinator, monkeypatch, tmp_path):
+    monkeypatch.setattr(o, "MAX_TASK_ATTEMPTS", 1)
+    pdf = tmp_path / "a.pdf"
+    pdf.write_bytes(b"%PDF")
+
+    errors = list()
+    def rasterize():
+        try:
+            coordinator.rasterize(str(pdf), 100, (1, 6), "L", 2)
+        except RuntimeError as e:
+            errors.append(e)
+    t = threading.Thread(target=rasterize)
+    t.start()
+
+    first  = coordinator.lease("w1", 5)
+    second = coordinator.lease("w2", 0)
+    assert first["args"]["range"] == [1, 2] and second["args"]["range"] == [3, 4]
+    coordinator.finish("w1", first["task_id"], error="not a pdf")
+    t.join(5)
+
+    assert len(errors) == 1
+    assert coordinator.tasks == {} and coordinator.blobs == {}
+    assert coordinator.lease("w3", 0) is None
+    coordinator.finish("w2", second["task_id"], result=[]) # too late, ignored
+
+def test_reap(coordinator, monkeypatch):
+    monkeypatch.setattr(o, "WORKER_TIMEOUT", 0.5)
+
+    leased  = coordinator.submit("ocr", {})
+    task    = coordinator.lease("w1", 0)
+    waiting = coordinator.submit("ocr", {})
+
+    # w1 dies: its task goes back to the front of the queue, and with no workers left both then fail
+    time.sleep(1.6)
+    with coordinator.cv:
+        assert "w1" not in coordinator.workers
+    deadline = time.time() + 5
+    while not (leased.done() and waiting.done()) and time.time() < deadline:
+        time.sleep(0.1)
+    with pytest.raises(RuntimeError, match="there are no workers"):
+        leased.result(timeout=0)
+    with pytest.raises(RuntimeError, match="there are no workers"):
+        waiting.result(timeout=0)
+    assert task["task_id"] not in coordinator.tasks
@@ -0,0 +1,66 @@
+import utilities as u
+import pytest
+
+
+SL_OIDS = {
+    1: "111-1111111-1111111",
+    2: "222-2222222-2222222",
+    3: "111-1111111-1111111", # the same order twice, e.g. two boxes
+    4: "333-4444444-5555555",
+}
+
+def test_oid_distance():
+    assert u.oid_distance("111-1111111-1111111", "111-1111111-1111111") == 0
+    assert u.oid_distance("111-1111111-1111111", "111-1111111-111111l") == pytest.approx(u.OID_CONFUSION_COST)
+    assert u.oid_distance("111-1111111-1111111", "111-1111111- 1111111") == pytest.approx(u.OID_STRAY_CHAR_COST)
+    assert u.oid_distance("111-1111111-1111111", "111-1111111-1111117") == 1
+    assert u.oid_distance("abc", "") == 3
+
+def test_match_sl_page_exact():
+    index = u.sl_oid_index(SL_OIDS)
+
+    # OCR's usual slips still match exactly
+    assert u.match_sl_page(index, "222 -2222222-222222Z", 1) == (2, 1.0)
+    assert u.match_sl_page(index, "333-4444444-555555S", 1) == (4, 1.0)
+
+def test_match_sl_page_excludes_matched_pages():
+    index = u.sl_oid_index(SL_OIDS)
+
+    # the sl page nearest to the ps page goes first, then the other one with that oid
+    assert u.match_sl_page(index, "111-1111111-1111111", 3) == (3, 1.0)
+    assert u.match_sl_page(index, "111-1111111-1111111", 3) == (1, 1.0)
+    with pytest.raises(ValueError):
+        u.match_sl_page(index, "111-1111111-1111111", 3)
+
+def test_match_sl_page_fuzzy(monkeypatch):
+    monkeypatch.setattr(u, "FUZZY_OID_MATCHING", True)
+    index = u.sl_oid_index(SL_OIDS)
+
+    sl_page_num, confidence = u.match_sl_page(index, "333-4444444-5555556", 1)
+    assert sl_page_num == 4
+    assert 0.9 < confidence < 1
+
+    # the nearest unmatched oid is too far off
+    with pytest.raises(ValueError):
+        u.match_sl_page(index, "999-9999999-9999999", 1)
+
+    monkeypatch.setattr(u, "FUZZY_OID_MATCHING", False)
+    with pytest.raises(ValueError):
+        u.match_sl_page(u.sl_oid_index(SL_OIDS), "333-4444444-5555556", 1)
+
+def test_oids_overlap():
+    assert u.oids_overlap({1: "111-1111111-1111111", 2: "222-2222222-2222222"}, SL_OIDS) == 1.0
+    assert u.oids_overlap({1: "111-1111111-1111111", 2: "999-9999999-9999999"}, SL_OIDS) == 0.5
+    assert u.oids_overlap({}, SL_OIDS) == 0.0
+
+def test_confident_orders(monkeypatch):
+    alerts = []
+    monkeypatch.setattr(u, "display_alert", lambda msg, blocking=True: alerts.append(msg))
+    monkeypatch.setattr(u, "MIN_MATCH_CONFIDENCE", 0.9)
+
+    def order(order_id, confidence):
+        return {"order_id": order_id, "ps_source": ("ps.pdf", 1), "sl_source": ("sl.pdf", 1), "match_confidence": confidence}
+
+    orders = [ order("111-1111111-1111111", 1.0), order("222-2222222-2222222", 0.5), order("333-4444444-5555555", 0.9) ]
+    assert [ o["order_id"] for o in u.confident_orders(orders) ] == ["111-1111111-1111111", "333-4444444-5555555"]
+    assert len(alerts) == 1 and "222-2222222-2222222" in alerts[0]
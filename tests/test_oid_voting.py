@@ -0,0 +1,33 @@
+import utilities as u
+import json
+
+
+def test_oid_vote_deficit(monkeypatch):
+    monkeypatch.setattr(u, "OID_VOTE_MARGIN", 2)
+
+    assert u.oid_vote_deficit({}) == 2
+    assert u.oid_vote_deficit({"111-1111111-1111111": 1}) == 1
+    assert u.oid_vote_deficit({"111-1111111-1111111": 2}) == 0
+    assert u.oid_vote_deficit({"111-1111111-1111111": 3, "111-1111111-1111117": 2}) == 1
+    assert u.oid_vote_deficit({"111-1111111-1111111": 4, "111-1111111-1111117": 2}) == 0
+
+def test_ordered_oid_vote_dpis(monkeypatch, tmp_path):
+    stats_path = tmp_path / "oid_vote_stats.json"
+    monkeypatch.setattr(u, "OID_VOTE_STATS_PATH", str(stats_path))
+    monkeypatch.setattr(u, "OID_VOTE_DPIS", [200, 300, 400])
+
+    # no history, cheapest first
+    assert u.ordered_oid_vote_dpis() == [200, 300, 400]
+
+    stats_path.write_text(json.dumps({"200": [1, 10], "400": [10, 10]}))
+    assert u.ordered_oid_vote_dpis() == [400, 300, 200]
+
+def test_record_oid_vote(monkeypatch, tmp_path):
+    monkeypatch.setattr(u, "OID_VOTE_STATS_PATH", str(tmp_path / "oid_vote_stats.json"))
+    monkeypatch.setattr(u, "OID_VOTE_DPIS", [200, 300])
+
+    final = {1: "111-1111111-1111111", 2: "222-2222222-2222222"}
+    u.record_oid_vote({200: {1: "111-1111111-1111111"}, 300: dict(final)}, final)
+
+    assert u.load_oid_vote_stats() == {"200": [1, 2], "300": [2, 2]}
+    assert u.ordered_oid_vote_dpis() == [300, 200]
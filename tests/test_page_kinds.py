@@ -0,0 +1,36 @@
+from conftest import RESOURCES_DIR
+from PIL import Image, ImageDraw
+import utilities as u
+import pytest
+import shutil
+
+
+def thumbnail(*boxes):
+    # a white letter-sized thumbnail with the given (left, top, right, bottom) boxes in black
+    img  = Image.new("L", (85, 110), 255)
+    draw = ImageDraw.Draw(img)
+    for box in boxes:
+        draw.rectangle(box, fill=0)
+    return img
+
+def test_label():
+    assert u.page_kind_from_thumbnail(thumbnail((10, 10, 40, 40))) == "label"
+
+def test_packing_slip():
+    # a few table rules across the page
+    assert u.page_kind_from_thumbnail(thumbnail((5, 30, 80, 30), (5, 60, 80, 60), (5, 90, 80, 90))) == "ps"
+
+def test_oid_summary():
+    assert u.page_kind_from_thumbnail(thumbnail((10, 10, 10, 90))) == "oid_summary"
+    assert u.page_kind_from_thumbnail(thumbnail()) == "oid_summary"
+
+def test_unknown():
+    # too much ink for a summary page, too little for a label and no rules
+    assert u.page_kind_from_thumbnail(thumbnail((10, 10, 12, 90))) == "unknown"
+
+@pytest.mark.skipif(shutil.which("pdftoppm") is None, reason="needs poppler's pdftoppm")
+def test_page_kinds_of_resources(monkeypatch):
+    monkeypatch.setattr(u, "USE_PDF_TEXT_LAYER", False)
+    kinds = u.page_kinds(RESOURCES_DIR + "2sl.pdf")
+    assert kinds[1] == "label"
+    assert kinds[max(kinds)] == "oid_summary"
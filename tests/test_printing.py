@@ -0,0 +1,53 @@
+import utilities as u
+import threading
+import pytest
+import os
+
+
+def test_fake_printer_backend(monkeypatch, tmp_path):
+    monkeypatch.setattr(u, "PRINT_BACKEND", "fake")
+    monkeypatch.setattr(u, "FAKE_PRINTER_TARGET", str(tmp_path / "fake_printer_target"))
+    monkeypatch.setattr(u, "PRINT_TO_VIRTUAL_PRINTER", False)
+    monkeypatch.setattr(u, "PHYSICAL_PRINTER_NAME", "printer")
+
+    pdf = tmp_path / "order.pdf"
+    pdf.write_bytes(b"%PDF-1.4 not really")
+
+    # the same file printed at the same time must not overwrite itself
+    threads = [ threading.Thread(target=u.print_to_LL, args=(str(pdf), True, True)) for _ in range(8) ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    u.print_to_PP(str(pdf), for_real=True)
+
+    printed = os.listdir(tmp_path / "fake_printer_target" / "printer")
+    assert len(printed) == 9
+    assert sum( 1 for name in printed if name.endswith("_BRInputSlot=Tray2_orientation-requested=4_order.pdf") ) == 8
+    assert sum( 1 for name in printed if name.endswith("_BRInputSlot=Tray1_order.pdf") ) == 1
+    assert all( (tmp_path / "fake_printer_target" / "printer" / name).read_bytes() == pdf.read_bytes() for name in printed )
+
+def test_job_that_fails_after_printing_names_what_it_printed(monkeypatch, tmp_path):
+    monkeypatch.setattr(u, "METRICS_PATH", str(tmp_path / "metrics.jsonl"))
+    monkeypatch.setattr(u, "BATCH_PRINT_JOBS", False)
+    monkeypatch.setattr(u, "PRINT_TO_VIRTUAL_PRINTER", False)
+
+    def order(order_id):
+        return {"order_id": order_id, "ps_path": "ps.pdf", "combined_ps_and_sl_path": "ll.pdf", "match_confidence": 1.0}
+
+    def job(pdfA, pdfB, speculative_job, work_dir, sl_oids):
+        u.print_orders([order("111-1111111-1111111"), order("222-2222222-2222222")], None, None)
+        raise ValueError("page 3 has no oid")
+    monkeypatch.setattr(u, "_do_amazon_print_job", job)
+
+    with pytest.raises(u.PartlyPrintedError) as e:
+        u.do_amazon_print_job("A.pdf", "B.pdf", for_real=False)
+    assert e.value.printed_order_ids == ["111-1111111-1111111", "222-2222222-2222222"]
+    assert isinstance(e.value.__cause__, ValueError)
+
+    def job(pdfA, pdfB, speculative_job, work_dir, sl_oids):
+        raise ValueError("page 1 has no oid")
+    monkeypatch.setattr(u, "_do_amazon_print_job", job)
+
+    with pytest.raises(ValueError):
+        u.do_amazon_print_job("A.pdf", "B.pdf", for_real=False)
@@ -0,0 +1,40 @@
+from conftest import RESOURCES_DIR
+import utilities as u
+
+
+def test_tno_from_sl_text():
+    assert u.tno_from_sl_text("FedEx\nTRK# 3933 7813 1941\n") == "393378131941"
+    assert u.tno_from_sl_text("UPS GROUND\nTRACKING #: 1Z O9A Y33 03 9278 4049\n") == "1Z09AY330392784049"
+    assert u.tno_from_sl_text("TRACKING #: 1Z 09A Y33 03 9278 4049") == "1Z09AY330392784049"
+    assert u.tno_from_sl_text("USPS TRACKING # EP\n\nil il\n\n9305 5201 1140 4895 5861 69") == "9305520111404895586169"
+    assert u.tno_from_sl_text("no tracking number here") is None
+
+def test_pdf_pages_text(monkeypatch):
+    text = u.pdf_pages_text(RESOURCES_DIR + "2sl.pdf")
+    assert sorted(text.keys()) == list(range(1, len(text) + 1))
+    assert "114-9393994-2615410" in "".join(text.values())
+
+    assert u.pdf_pages_text(RESOURCES_DIR + "no_such.pdf") == dict()
+
+    monkeypatch.setattr(u, "USE_PDF_TEXT_LAYER", False)
+    assert u.pdf_pages_text(RESOURCES_DIR + "2sl.pdf") == dict()
+
+def test_oids_from_sl_text_layer():
+    oids = u.oids_from_sl_text_layer(RESOURCES_DIR + "2sl.pdf")
+    assert len(oids) == 25
+    assert oids[1]  == "114-9393994-2615410"
+    assert oids[25] == "111-0073126-3943474"
+
+    # a packing slip pdf has no oid summary pages
+    assert u.oids_from_sl_text_layer(RESOURCES_DIR + "1ps.pdf") is None
+
+def test_oids_from_ps_ocr_drops_spaces(monkeypatch):
+    ocr_text = "Order ID: 111-4979156-8561 860\nThank you for buying"
+    monkeypatch.setattr(u, "str_from_region", lambda page, box, psm: ocr_text)
+    monkeypatch.setattr(u, "all_pages_text", lambda pages: { p: ocr_text for p in pages })
+
+    monkeypatch.setattr(u, "USE_ROI_OCR", True)
+    assert u.oids_from_ps({1: "page 1"}) == {1: "111-4979156-8561860"}
+
+    monkeypatch.setattr(u, "USE_ROI_OCR", False)
+    assert u.oids_from_ps({1: "page 1"}) == {1: "111-4979156-8561860"}
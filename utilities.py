@@ -1,10 +1,32 @@
 from pytesseract import image_to_string
 from pdf2image import convert_from_path
-from PyPDF2 import PdfFileWriter, PdfFileReader
+from PyPDF2 import PdfFileWriter, PdfFileReader, PdfFileMerger
+from PyPDF2.pdf import PageObject
+from PyPDF2.generic import DictionaryObject, DecodedStreamObject, NameObject, NumberObject
 from PIL import Image 
+try:
+    import tesserocr # optional, see OCR_BACKEND
+except ImportError:
+    tesserocr = None
+import functools
+import itertools
+import hashlib
+import sqlite3
 import datetime
+import json
 import barcode
+from barcode.charsets import code128 as code128_charset
+from concurrent.futures import ThreadPoolExecutor
+import subprocess
+import collections
+import collections.abc
+import contextvars
+import contextlib
+import threading
+import queue
+import tempfile
 import random
+import shutil
 import glob
 import time
 import re
@@ -17,9 +39,48 @@ PRINT_TO_PHYSICAL_PRINTER           = True
 PRINT_TO_VIRTUAL_PRINTER            = False
 PHYSICAL_PRINTER_NAME               = "Ecomm_Fulfillment___Inventory_Cage" # as determined from running 'lpstat -a' in the terminal
 VIRTUAL_PRINTER_NAME                = "q"
+BATCH_PRINT_JOBS                    = True  # one multi-page print job per tray instead of one per page
+PRINT_BACKEND                       = "lpr" # one of PRINT_BACKENDS, "fake" saves what would be printed to FAKE_PRINTER_TARGET instead
+FAKE_PRINTER_TARGET                 = os.getcwd() + os.sep + "fake_printer_target/"
+VECTOR_OUTPUT                       = False # compose the printed pages out of the original pdf pages with vector barcodes instead of out of rasterized pages, pages then only get rasterized if they have to be OCR'd
+LL_PRINTER_ROTATES                  = False # if True, the combined PS+SL page is printed with a landscape orientation instead of being rotated by us
 SPLIT_PS_PDF_TARGET                 = os.getcwd() + os.sep + "split_ps_pdf_target/"
 SPLIT_SL_PDF_TARGET                 = os.getcwd() + os.sep + "split_sl_pdf_target/"
 COMBINED_IMGS_TARGET                = os.getcwd() + os.sep + "combined_pages/"
+SPECULATIVE_TARGET                  = os.getcwd() + os.sep + "speculative_target/"
+JOBS_TARGET                         = os.getcwd() + os.sep + "jobs/" # each job given a work_dir gets its own scratch dir in here
+CHUNK_PAGES                         = 0     # if > 0, a job goes through the PS this many pages at a time, from rasterizing to printing, so memory and disk use stay flat however big the pdfs are
+STREAM_PAGES                        = False # resolve, compose and print one order at a time instead of one phase at a time, see stream_orders()
+STREAM_BUFFER                       = 4     # max composed orders waiting to be printed while streaming
+STREAM_PRINT_BATCH                  = 5     # while streaming, print jobs are submitted for this many orders at a time
+EXPORT_METRICS                      = True
+METRICS_PATH                        = os.getcwd() + os.sep + "amazon_metrics.jsonl" # one json object per line, a "span" per timed stage/call and a "job" summary per job
+FUZZY_OID_MATCHING                  = True  # match a PS to the SL whose oid is nearest to its own instead of requiring OCR to get them identical
+MAX_OID_MATCH_DISTANCE              = 3.0   # no match if even the nearest SL oid is further than this, see oid_distance()
+MIN_MATCH_CONFIDENCE                = 0.9   # orders whose PS matched their SL with less confidence than this aren't printed, an alert names them instead
+FILE_WRITE_TIMEOUT                  = 10    # max seconds to wait for a pdf to be fully written before processing it anyway
+FILE_STABLE_FOR                     = 0.2   # a pdf ending in %%EOF whose size hasn't changed for this many seconds is considered fully written
+KEEP_JOB_DIRS                       = False # keep a job's scratch dir around after it's done, for debugging
+ADAPTIVE_OID_VOTE                   = True  # if False, every one of OID_VOTE_DPIS votes on every SL order_ID
+OID_VOTE_DPIS                       = range(150, 601, 50)
+OID_VOTE_MARGIN                     = 2     # stop voting once the leading oid of every page is this many votes ahead
+OID_VOTE_STATS_PATH                 = os.getcwd() + os.sep + "oid_vote_stats.json"
+USE_PAGE_CLASSIFIER                 = True  # tell packing slips, labels and oid summary pages apart from thumbnails instead of OCR-ing them, see page_kinds()
+THUMBNAIL_DPI                       = 24
+USE_BARCODE_TNOS                    = True  # read the tnos from the labels' own barcodes, OCR only the labels where none could be decoded
+USE_PDF_TEXT_LAYER                  = True  # read oids and tnos from the pdfs' embedded text where possible, OCR only the rest
+OCR_RENDER_PROFILE                  = {"dpi": 200, "mode": "L"} # how pages are rasterized for OCR and classification, "mode" is one of "RGB", "L" (grayscale) or "1" (bilevel)
+PRINT_RENDER_PROFILE                = {"dpi": 200, "mode": "1"} # how printed pages are rendered, set "dpi" to the printers' native resolution (pages are then rasterized a second time for printing if it differs from OCR_RENDER_PROFILE's)
+IN_MEMORY_PAGES                     = True  # keep rasterized pages as decoded images in memory, only files that get printed are written to disk
+OCR_WORKERS                         = max(1, (os.cpu_count() or 1) - 1) # max pages OCR'd at the same time, keep it below the core count so the watcher stays responsive
+USE_OCR_CACHE                       = True
+OCR_CACHE_PATH                      = os.getcwd() + os.sep + "ocr_cache.sqlite3"
+OCR_CACHE_MAX_BYTES                 = 50 * 1024 * 1024 # least recently used results are evicted past this much cached text
+OCR_CONFIG                          = "" # extra tesseract options, part of the cache key
+OCR_BACKEND                         = "tesserocr" # one of OCR_BACKENDS. "tesserocr" keeps a tesseract engine loaded per OCR thread, falls back to "pytesseract" (a tesseract process per call) if tesserocr isn't installed. "distributed" hands the pages to ocr_workers.py workers, see OCR_COORDINATOR_ADDRESS
+OCR_COORDINATOR_ADDRESS             = None  # e.g. ("0.0.0.0", 8711) to have `python ocr_workers.py worker` processes, on this or other hosts, OCR (with OCR_BACKEND = "distributed") and rasterize pages. Raise OCR_WORKERS to about the number of worker threads
+DISTRIBUTED_RASTERIZING             = True  # while there are workers, rasterize in chunks of RASTERIZE_TASK_PAGES pages on them
+RASTERIZE_TASK_PAGES                = 4
 ###############################################################################################
 ###############################################################################################
 ###############################################################################################
@@ -35,83 +96,863 @@ COMBINED_IMGS_TARGET                = os.getcwd() + os.sep + "combined_pages/"
 OID_LOOKS_LIKE_THIS = r"(\s*\d){3}-(\s*\d){7}-(\s*\d){7}"
 PS_PAGES_MATCH_THIS = r"[Oo][Rr][Dd][Ee][Rr][\s]*[Ii][Dd]:[\s]*" + OID_LOOKS_LIKE_THIS
 
-PS_IMG_W, PS_IMG_H = 1700, 2200 # change them if you set something other than the default dpi for PS imgs
+PS_IMG_W, PS_IMG_H = 1700, 2200 # a PS page at 200 dpi, the barcodes pasted on a PS are sized for this and scaled to the page's actual size
+
+# Regions of a page that are OCR'd on their own before falling back to OCR-ing the whole page,
+# as (left, top, right, bottom) fractions of the page's width and height, each with the tesseract
+# page segmentation mode that suits it (6: a single block of text, 7: a single line of text).
+USE_ROI_OCR = True
+PS_OID_ROIS = [
+    ((0.00, 0.00, 1.00, 0.20), 6), # the header, "Order ID: 111-4979156-8561860"
+]
+SL_TNO_ROIS = [
+    ((0.00, 0.40, 0.75, 0.65), 6), # "TRK# 3933 7813 1941"
+    ((0.00, 0.35, 1.00, 0.60), 6), # "TRACKING #: 1Z 09A Y33 03 9278 4049"
+    ((0.00, 0.55, 1.00, 0.85), 6), # "USPS TRACKING # EP" with the number a few lines under it
+]
+# What page_kinds() goes by when a page's text layer doesn't tell: a label is a lot of ink (its 
+# barcodes and big print), a PS has a few horizontal rules across it and an oid summary page is 
+# hardly any ink, just a list of oids. Measured on THUMBNAIL_DPI grayscale thumbnails of the pdfs 
+# in resources/: labels have 0.088-0.145 ink, slips 0.028-0.038 and 4+ rules, summaries < 0.015 ink.
+LABEL_MIN_INK       = 0.06 # fraction of dark pixels
+PS_MIN_RULES        = 2    # rows with a dark run across at least a quarter of the page
+OID_SUMMARY_MAX_INK = 0.02 # a page that is none of the three is "unknown"
+
+BARCODE_SCANLINES = 60 # a label is read for barcodes along this many evenly spaced lines, see tno_from_sl_barcodes()
 ###############################################################################################
 ###############################################################################################
 ###############################################################################################
 
-def do_amazon_print_job(pdfA, pdfB):
+_current_job = contextvars.ContextVar("current_job", default=None)
+_job_settings = contextvars.ContextVar("job_settings", default=dict()) # see do_amazon_print_job()
+_metrics_lock = threading.Lock()
+
+@contextlib.contextmanager
+def job_metrics(pdfA, pdfB):
+    '''
+    Everything timed with span()/measured() and counted with count() inside this block (and in 
+    the threads it hands work to through in_job_context()) is attributed to one job. When the 
+    block exits its spans and then a "job" summary are written to METRICS_PATH in one go: its 
+    total time, the time spent in and number of calls to every stage, and the counters.
+    '''
+
+    job = {
+        "job": datetime.datetime.now().strftime("%Y%m%d-%H%M%S-") + str(random.randint(0, 99999)),
+        "pdfs": [os.path.basename(pdfA), os.path.basename(pdfB)],
+        "started": time.time(),
+        "stages": dict(),
+        "counters": dict(),
+        "spans": list(), # written on their own, not as part of the summary
+    }
+    token = _current_job.set(job)
+    ok = False
+    try:
+        yield job
+        ok = True
+    finally:
+        _current_job.reset(token)
+        
+        summary = dict(job)
+        del summary["spans"]
+        summary["type"]    = "job"
+        summary["seconds"] = round(time.time() - job["started"], 4)
+        summary["ok"]      = ok
+        with _metrics_lock:
+            spans = list(job["spans"])
+        write_metrics(spans + [summary])
+        log("Job " + job["job"] + " took " + str(summary["seconds"]) + "s: " + ", ".join(
+            stage + " " + str(round(v["seconds"], 2)) + "s" for stage, v in job["stages"].items()
+        ))
+
+@contextlib.contextmanager
+def span(stage):
+    # time the block as `stage`, see job_metrics(). Outside of a job nothing is recorded.
+
+
+    start = time.time()
+    try:
+        yield
+    finally:
+        seconds = time.time() - start
+        job = _current_job.get()
+        if job is not None:
+            with _metrics_lock:
+                totals = job["stages"].setdefault(stage, {"calls": 0, "seconds": 0.0})
+                totals["calls"]   += 1
+                totals["seconds"] += seconds
+                if EXPORT_METRICS:
+                    job["spans"].append({"type": "span", "job": job["job"], "stage": stage, "started": start, "seconds": round(seconds, 4)})
+
+def measured(stage):
+    # decorator, time every call of the function as `stage`
+
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def count(counter, n=1):
+    job = _current_job.get()
+    if job is not None:
+        with _metrics_lock:
+            job["counters"][counter] = job["counters"].get(counter, 0) + n
+
+def in_job_context(fn):
+    # wrap fn so that it records metrics to the caller's job in whichever thread it ends up running
+
+
+    ctx = contextvars.copy_context()
+    
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        return ctx.copy().run(fn, *args, **kwargs)
+    return wrapper
+
+def write_metrics(metrics):
+    if not EXPORT_METRICS:
+        return
+
+    lines = "".join( json.dumps(metric) + "\n" for metric in metrics )
+    try:
+        with _metrics_lock:
+            with open(METRICS_PATH, "at") as f:
+                f.write(lines)
+    except OSError as e:
+        log("Couldn't write metrics to " + METRICS_PATH + ": " + str(e))
+
+def do_amazon_print_job(pdfA, pdfB, speculative_job=None, work_dir=None, on_order=None, for_real=None, sl_oids=None):
+    '''
+    Process a pdf-pair and print it, recording metrics for the whole job, see job_metrics().
+    The other arguments are those of _do_amazon_print_job().
+
+    on_order: called with every order (see get_orders_info()) as soon as it's been printed, while 
+              its "ps_path" and "combined_ps_and_sl_path" still exist
+    for_real: whether to print to the physical printer, PRINT_TO_PHYSICAL_PRINTER if None
+
+    Raises PartlyPrintedError if the job fails after some of its orders have been printed already.
+    '''
+
+    settings = { "on_order": on_order, "for_real": for_real, "printed": list() } # print_orders() adds the order_IDs it printed
+    token = _job_settings.set(settings)
+    try:
+        with job_metrics(pdfA, pdfB):
+            _do_amazon_print_job(pdfA, pdfB, speculative_job, work_dir, sl_oids)
+    except Exception as e:
+        if not settings["printed"]:
+            raise
+        raise PartlyPrintedError(settings["printed"], e) from e
+    finally:
+        _job_settings.reset(token)
+
+class PartlyPrintedError(Exception):
+    # a job failed after it had printed some of its orders, sending the pdf-pair again would print those twice
+
+    def __init__(self, printed_order_ids, cause):
+        self.printed_order_ids = list(printed_order_ids)
+        super().__init__("failed after printing " + str(len(self.printed_order_ids)) + " order(s) (" + ", ".join(self.printed_order_ids) + "): " + repr(cause))
+
+def _do_amazon_print_job(pdfA, pdfB, speculative_job=None, work_dir=None, sl_oids=None):
+    '''
+    speculative_job: the job returned by start_speculative_job(pdfA), if any. Whatever work it 
+                     managed to finish on pdfA is reused instead of being done again here.
+    work_dir       : a dir only this job uses (see make_job_dir()), so that several jobs can run 
+                     at the same time. It is deleted once the job is done unless KEEP_JOB_DIRS. 
+                     If None, the shared SPLIT_PS_PDF_TARGET etc. are used and emptied first.
+    sl_oids        : the oids of whichever of the pdfs is the sl_pdf, as oids_from_sl() returns 
+                     them, if they're already known, e.g. from the sl_pdf's own speculative job.
+    '''
+
     log("Proccessing: \n\t>>> '" + pdfA + "' \nand \n\t>>> '" + pdfB + "'") 
-    time.sleep(3)
+    with span("wait_for_pdfs"):
+        wait_for_pdf_to_be_written(pdfA)
+        wait_for_pdf_to_be_written(pdfB)
+
+    if work_dir:
+        split_ps_pdf_target = append_slash_if_needed(work_dir) + "split_ps_pdf_target/"
+        split_sl_pdf_target = append_slash_if_needed(work_dir) + "split_sl_pdf_target/"
+        combined_imgs_target = append_slash_if_needed(work_dir) + "combined_pages/"
+        oids_from_sl_working_dir = append_slash_if_needed(work_dir) + "oids_from_sl/"
+    else:
+        split_ps_pdf_target = SPLIT_PS_PDF_TARGET
+        split_sl_pdf_target = SPLIT_SL_PDF_TARGET
+        combined_imgs_target = COMBINED_IMGS_TARGET
+        oids_from_sl_working_dir = None
+
+    empty_or_make_new(split_ps_pdf_target)
+    empty_or_make_new(split_sl_pdf_target)
+    empty_or_make_new(combined_imgs_target)
+
+    try:
+        spec = finish_speculative_job(speculative_job, pdfA) if speculative_job else None
+
+        if STREAM_PAGES:
+            stream_print_job(pdfA, pdfB, spec, split_ps_pdf_target, split_sl_pdf_target, combined_imgs_target, oids_from_sl_working_dir, sl_oids)
+            return
+        
+        if CHUNK_PAGES > 0:
+            chunked_print_job(pdfA, pdfB, spec, split_ps_pdf_target, split_sl_pdf_target, combined_imgs_target, oids_from_sl_working_dir, sl_oids)
+            return
+
+        if spec:
+            pdfA_path_from_page_num = spec["path_from_page_num"]
+        elif VECTOR_OUTPUT:
+            pdfA_path_from_page_num = LazyPages(pdfA, split_ps_pdf_target)
+        else:
+            pdfA_path_from_page_num = pdf_to_pages(pdfA, split_ps_pdf_target)
+        if VECTOR_OUTPUT:
+            pdfB_path_from_page_num = LazyPages(pdfB, split_sl_pdf_target)
+        else:
+            pdfB_path_from_page_num = pdf_to_pages(pdfB, split_sl_pdf_target)
+
+        first_page_of_pdfA = functools.partial(pdfA_path_from_page_num.__getitem__, 1)
+        with span("classify"):
+            pdfA_is_ps = spec["is_ps"] if spec else is_ps_page(first_page_of_pdfA, pdfA)
+        if pdfA_is_ps:
+            ps_path_from_page_num = pdfA_path_from_page_num
+            sl_path_from_page_num = pdfB_path_from_page_num
+        else:
+            ps_path_from_page_num = pdfB_path_from_page_num
+            sl_path_from_page_num = pdfA_path_from_page_num
+
+        ps_oids = spec["oids"] if spec and pdfA_is_ps else None
+
+        sl_pdf_path = pdfB if pdfA_is_ps else pdfA
+        ps_pdf_path = pdfA if pdfA_is_ps else pdfB
+        orders_info = get_orders_info(
+            ps_path_from_page_num, sl_path_from_page_num, sl_pdf_path, 
+            ps_oids=ps_oids, ps_pdf_path=ps_pdf_path, oids_from_sl_working_dir=oids_from_sl_working_dir, sl_oids=sl_oids
+        )
+        count("orders", len(orders_info))
+    
+        for order in orders_info.values():
+            compose_order(order, split_ps_pdf_target, combined_imgs_target)
+
+        if orders_info:
+            print_orders([ orders_info[p] for p in sorted(orders_info.keys()) ], split_ps_pdf_target, combined_imgs_target)
+    finally:
+        discard_speculative_job_files(speculative_job)
+        forget_pdf_readers(pdfA, pdfB)
+        if work_dir and not KEEP_JOB_DIRS:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if USE_OCR_CACHE:
+        log(ocr_cache_summary())
+
+def chunked_print_job(pdfA, pdfB, spec, split_ps_pdf_target, split_sl_pdf_target, combined_imgs_target, oids_from_sl_working_dir, sl_oids=None):
+    '''
+    The CHUNK_PAGES version of do_amazon_print_job(): the orders are resolved, composed and 
+    printed CHUNK_PAGES PS pages at a time, rasterizing only that chunk of the PS and the SL pages 
+    it matches, and everything of a chunk is dropped (and deleted from disk) once it's printed.
+    '''
+
+    known = dict(spec["path_from_page_num"]) if spec else pdf_to_pages(pdfA, split_ps_pdf_target, page_range=(1, 1))
 
-    empty_or_make_new(SPLIT_PS_PDF_TARGET)
-    empty_or_make_new(SPLIT_SL_PDF_TARGET)
-    empty_or_make_new(COMBINED_IMGS_TARGET)
+    pdfA_is_ps = spec["is_ps"] if spec else is_ps_page(known[1], pdfA)
+    ps_pdf_path, sl_pdf_path = (pdfA, pdfB) if pdfA_is_ps else (pdfB, pdfA)
+    if not pdfA_is_ps:
+        known = dict()
+    ps_oids = spec["oids"] if spec and pdfA_is_ps else None
 
-    pdfA_path_from_page_num = pdf_to_images2(pdfA, SPLIT_PS_PDF_TARGET)
-    pdfB_path_from_page_num = pdf_to_images2(pdfB, SPLIT_SL_PDF_TARGET)
+    sl_oids  = sl_oids or oids_from_sl(sl_pdf_path, oids_from_sl_working_dir)
+    sl_index = sl_oid_index(sl_oids)
 
-    first_page_of_pdfA = pdfA_path_from_page_num[1]
-    if is_ps_page(first_page_of_pdfA):
-        ps_path_from_page_num = pdfA_path_from_page_num
-        sl_path_from_page_num = pdfB_path_from_page_num
+    ps_pages_count = pdf_page_count(ps_pdf_path)
+    for first in range(1, ps_pages_count + 1, CHUNK_PAGES):
+        last = min(ps_pages_count, first + CHUNK_PAGES - 1)
+        log("Processing PS pages " + str(first) + " to " + str(last) + " of " + str(ps_pages_count))
+
+        ps_pages = { p: known.pop(p) for p in range(first, last + 1) if p in known }
+        if len(ps_pages) < last - first + 1:
+            ps_pages.update(pdf_to_pages(ps_pdf_path, split_ps_pdf_target, page_range=(first, last)))
+
+        chunk_oids = { p: ps_oids[p] for p in ps_pages } if ps_oids else oids_from_ps(ps_pages, ps_pdf_path)
+        matches = { p: match_sl_page(sl_index, chunk_oids[p], p) for p in sorted(chunk_oids.keys()) }
+
+        needed = sorted(set( sl_page_num for sl_page_num, _ in matches.values() ))
+        if needed and needed[-1] - needed[0] < 2 * CHUNK_PAGES: # the labels usually come in the same order as the slips
+            sl_pages = pdf_to_pages(sl_pdf_path, split_sl_pdf_target, page_range=(needed[0], needed[-1]))
+        else:
+            sl_pages = dict()
+            for n in needed:
+                sl_pages.update(pdf_to_pages(sl_pdf_path, split_sl_pdf_target, page_range=(n, n)))
+        sl_pages = { n: sl_pages[n] for n in needed }
+        sl_tnos  = tnos_from_sl(sl_pages, sl_pdf_path)
+
+        orders = list()
+        for p, (sl_page_num, confidence) in sorted(matches.items()):
+            order = {
+                "ps_page": ps_pages[p],
+                "sl_page": sl_pages[sl_page_num],
+                "ps_source": (ps_pdf_path, p),
+                "sl_source": (sl_pdf_path, sl_page_num),
+                "order_id": sl_index["oids"][sl_page_num], # the label's, chunk_oids[p] may be a misreading of it
+                "tracking_number": sl_tnos[sl_page_num],
+                "match_confidence": confidence,
+            }
+            count("orders")
+            log("PS-SL matches " + str(p) + ": order_id: " + order["order_id"] + ", tracking_number: " + order["tracking_number"])
+            
+            compose_order(order, split_ps_pdf_target, combined_imgs_target)
+            order["ps_page"] = order["sl_page"] = None
+            orders.append(order)
+
+        if orders:
+            print_orders(orders, split_ps_pdf_target, combined_imgs_target)
+
+        del ps_pages, sl_pages, orders
+        for d in (split_ps_pdf_target, split_sl_pdf_target, combined_imgs_target):
+            empty_dir(d)
+
+def stream_print_job(pdfA, pdfB, spec, split_ps_pdf_target, split_sl_pdf_target, combined_imgs_target, oids_from_sl_working_dir, sl_oids=None):
+    # the STREAM_PAGES version of do_amazon_print_job(), pages are only rasterized when they're needed
+
+
+    pdfA_page = lazy_pages(pdfA, split_ps_pdf_target, spec["path_from_page_num"] if spec else None)
+    pdfB_page = lazy_pages(pdfB, split_sl_pdf_target)
+
+    pdfA_is_ps = spec["is_ps"] if spec else is_ps_page(pdfA_page(1, keep=True), pdfA)
+    if pdfA_is_ps:
+        stream_orders(pdfA, pdfB, pdfA_page, pdfB_page, spec["oids"] if spec else None, split_ps_pdf_target, combined_imgs_target, oids_from_sl_working_dir, sl_oids)
     else:
-        ps_path_from_page_num = pdfB_path_from_page_num
-        sl_path_from_page_num = pdfA_path_from_page_num
+        stream_orders(pdfB, pdfA, pdfB_page, pdfA_page, None, split_ps_pdf_target, combined_imgs_target, oids_from_sl_working_dir, sl_oids)
+
+def lazy_pages(path_to_pdf, output_dir, known=None):
+    '''
+    Returns a function page(page_num, keep=False) which rasterizes (see pdf_to_pages()) and 
+    returns one page of the pdf at a time. Pages in `known`, a dict like the ones pdf_to_pages() 
+    returns, and pages fetched with keep=True are handed out from memory (once more, unless keep).
+    '''
+
+    known = dict(known or dict())
+    lock  = threading.Lock()
+
+    def page(page_num, keep=False):
+        with lock:
+            if page_num in known:
+                return known[page_num] if keep else known.pop(page_num)
+
+        p = pdf_to_pages(path_to_pdf, output_dir, page_range=(page_num, page_num))[page_num]
+        if keep:
+            with lock:
+                known[page_num] = p
+        return p
+
+    return page
+
+class LazyPages(collections.abc.Mapping):
+    '''
+    A dict like the ones pdf_to_pages() returns, for all pages of the pdf, that only rasterizes a 
+    page once it's looked up. For when most pages are expected to never be needed, e.g. when 
+    their text layer has what's needed and they're composed at the pdf level, see VECTOR_OUTPUT.
+    '''
+
+    def __init__(self, path_to_pdf, output_dir):
+        self.path_to_pdf = path_to_pdf
+        self.output_dir  = output_dir
+        self.page_count  = pdf_page_count(path_to_pdf)
+        self.pages       = dict()
+        self.lock        = threading.Lock()
+
+    def __getitem__(self, page_num):
+        if not 1 <= page_num <= self.page_count:
+            raise KeyError(page_num)
+        
+        with self.lock:
+            if page_num not in self.pages:
+                self.pages.update(pdf_to_pages(self.path_to_pdf, self.output_dir, page_range=(page_num, page_num)))
+            return self.pages[page_num]
+
+    def __iter__(self):
+        return iter(range(1, self.page_count + 1))
+
+    def __len__(self):
+        return self.page_count
+
+def stream_orders(ps_pdf_path, sl_pdf_path, ps_page, sl_page, ps_oids, split_ps_pdf_target, combined_imgs_target, oids_from_sl_working_dir, sl_oids=None):
+    '''
+    Resolve (oid, matching sl page and tno), compose and print the orders one PS page at a time, 
+    in page order, as a pipeline: 
+        resolvers (OCR_WORKERS PS pages ahead) -> compose -> at most STREAM_BUFFER orders -> printer
+    so that the first labels get printed while later pages are still being worked on, and only a 
+    bounded number of pages is ever in memory or on disk.
+
+    ps_page, sl_page: functions that return a page given its page number, see lazy_pages()
+    ps_oids         : the oids of the PS pages, if already known
+    sl_oids         : the oids of the SL pages, if already known
+    '''
+
+    sl_oids = sl_oids or oids_from_sl(sl_pdf_path, oids_from_sl_working_dir)
+    sl_index = sl_oid_index(sl_oids)
+
+    def resolve(ps_page_num):
+        page = ps_page(ps_page_num)
+        oid  = ps_oids[ps_page_num] if ps_oids else oids_from_ps({ps_page_num: page}, ps_pdf_path)[ps_page_num]
+        
+        sl_page_num, confidence = match_sl_page(sl_index, oid, ps_page_num)
+        label = sl_page(sl_page_num)
+        tno = tnos_from_sl({sl_page_num: label}, sl_pdf_path)[sl_page_num]
+        
+        return {
+            "ps_page": page,
+            "sl_page": label,
+            "ps_source": (ps_pdf_path, ps_page_num),
+            "sl_source": (sl_pdf_path, sl_page_num),
+            "order_id": sl_index["oids"][sl_page_num], # the label's, oid may be a misreading of it
+            "tracking_number": tno,
+            "match_confidence": confidence,
+        }
 
-    sl_pdf_path = pdfB if sl_path_from_page_num == pdfB_path_from_page_num else pdfA
-    orders_info = get_orders_info(ps_path_from_page_num, sl_path_from_page_num, sl_pdf_path)
+    composed = queue.Queue(maxsize=STREAM_BUFFER)
+    printer_errors = list()
+
+    def printer():
+        batch = list()
+        while True:
+            order = composed.get()
+            if order is not None:
+                batch.append(order)
+            if batch and (order is None or len(batch) >= STREAM_PRINT_BATCH):
+                try:
+                    print_orders(batch, split_ps_pdf_target, combined_imgs_target)
+                except Exception as e:
+                    printer_errors.append(e)
+                batch = list()
+            if order is None:
+                return
+
+    printer_thread = threading.Thread(target=in_job_context(printer), name="stream-printer", daemon=True)
+    printer_thread.start()
+
+    try:
+        ps_page_nums = range(1, pdf_page_count(ps_pdf_path) + 1)
+        in_flight = collections.deque()
+        with ThreadPoolExecutor(max_workers=OCR_WORKERS, thread_name_prefix="resolve") as resolvers:
+            for ps_page_num in ps_page_nums:
+                in_flight.append((ps_page_num, resolvers.submit(in_job_context(resolve), ps_page_num)))
+                if len(in_flight) >= OCR_WORKERS:
+                    compose_and_queue(*in_flight.popleft(), composed, split_ps_pdf_target, combined_imgs_target)
+            
+            while in_flight:
+                compose_and_queue(*in_flight.popleft(), composed, split_ps_pdf_target, combined_imgs_target)
+    finally:
+        composed.put(None)
+        printer_thread.join()
+
+    if printer_errors:
+        raise printer_errors[0]
+
+def compose_and_queue(ps_page_num, resolved, composed, split_ps_pdf_target, combined_imgs_target):
+    order = resolved.result()
+    count("orders")
+    log("PS-SL matches " + str(ps_page_num) + ": order_id: " + order["order_id"] + ", tracking_number: " + order["tracking_number"])
+
+    compose_order(order, split_ps_pdf_target, combined_imgs_target)
+    order["ps_page"] = order["sl_page"] = None # done with the decoded pages
     
-    for order in orders_info.values():
-        paste_barcodes_on_ps(order["order_id"], order["tracking_number"], order["ps_path"])
+    composed.put(order)
+
+@measured("print_orders")
+def print_orders(orders, split_ps_pdf_target, combined_imgs_target):
+    # print the composed orders in the given order, as one job per tray if BATCH_PRINT_JOBS, then hand them to the job's on_order
+
+
+    orders = confident_orders(orders)
+    if not orders:
+        return
+
+    settings = _job_settings.get()
+    for_real = PRINT_TO_PHYSICAL_PRINTER if settings.get("for_real") is None else settings["for_real"]
+
+    if BATCH_PRINT_JOBS:
+        name = order_file_name(orders[0]) + ".pdf" # unique per batch
+        spool = pdfs_to_pdf if VECTOR_OUTPUT else pages_to_pdf
+        print_to_LL(spool([o["combined_ps_and_sl_path"] for o in orders], append_slash_if_needed(combined_imgs_target) + "LL-" + name), for_real=for_real, landscape=LL_PRINTER_ROTATES)
+        print_to_PP(spool([o["ps_path"] for o in orders], append_slash_if_needed(split_ps_pdf_target) + "PP-" + name), for_real=for_real)
+    else:
+        for order in orders:
+            print_to_LL(order["combined_ps_and_sl_path"], for_real=for_real, landscape=LL_PRINTER_ROTATES)
+            print_to_PP(order["ps_path"], for_real=for_real)
+
+    if "printed" in settings:
+        settings["printed"].extend(o["order_id"] for o in orders)
+    if settings.get("on_order"):
+        for order in orders:
+            settings["on_order"](order)
+
+def confident_orders(orders):
+    # the orders whose PS matched their SL with at least MIN_MATCH_CONFIDENCE, the others are alerted about instead of printed
 
-    for order in orders_info.values():
-        combined_ps_and_sl_path = append_slash_if_needed(COMBINED_IMGS_TARGET) + order["order_id"] + ".png"
-        combine_ps_and_sl(order["ps_path"], order["sl_path"], combined_ps_and_sl_path)
-        order["combined_ps_and_sl_path"] = combined_ps_and_sl_path
 
-    for page_num in sorted(orders_info.keys()):
-        order = orders_info[page_num]
-        print_to_LL(order["combined_ps_and_sl_path"], for_real=PRINT_TO_PHYSICAL_PRINTER)
-        print_to_PP(order["ps_path"], for_real=PRINT_TO_PHYSICAL_PRINTER)
+    result = list()
+    for order in orders:
+        if order["match_confidence"] >= MIN_MATCH_CONFIDENCE:
+            result.append(order)
+            continue
 
-def get_orders_info(ps_path_from_page_num, sl_path_from_page_num, sl_pdf_path):
-    sl_oids  = oids_from_sl(sl_pdf_path)
-    ps_oids  = oids_from_ps(ps_path_from_page_num)
-    sl_tnos  = tnos_from_sl(sl_path_from_page_num)
+        count("orders_held_back")
+        msg = "Order " + order["order_id"] + " (packing slip page " + str(order["ps_source"][1]) + ", label page " + str(order["sl_source"][1]) \
+            + ") wasn't printed, its packing slip only matched its label with confidence " + ("%.2f" % order["match_confidence"]) + ". Please check it and print it by hand."
+        log(msg)
+        display_alert(msg, blocking=False)
+
+    return result
+
+def pdf_page_count(path_to_pdf):
+    with open(path_to_pdf, "rb") as f:
+        return PdfFileReader(f, strict=False).getNumPages()
+
+def get_orders_info(ps_path_from_page_num, sl_path_from_page_num, sl_pdf_path, ps_oids=None, ps_pdf_path=None, oids_from_sl_working_dir=None, sl_oids=None):
+    sl_oids  = sl_oids or oids_from_sl(sl_pdf_path, oids_from_sl_working_dir)
+    ps_oids  = ps_oids if ps_oids is not None else oids_from_ps(ps_path_from_page_num, ps_pdf_path)
+    sl_tnos  = tnos_from_sl(sl_path_from_page_num, sl_pdf_path)
     
     # can be sl_oids.keys() too, they should be identical disregarding order, the spec says so 
     # TODO: raise a sensible exception if this is not the case^
     ps_page_nums = ps_oids.keys() 
     
+    sl_index = sl_oid_index(sl_oids)
+
     result = dict()
     for ps_page_num in sorted(ps_page_nums):
         ps_oid = ps_oids[ps_page_num]
-        matching_sl_page_num = k_from_v(sl_oids, ps_oid)
+        matching_sl_page_num, confidence = match_sl_page(sl_index, ps_oid, ps_page_num)
         sl_tno = sl_tnos[matching_sl_page_num]
         result[ps_page_num] = {
-            "ps_path": ps_path_from_page_num[ps_page_num], 
-            "sl_path": sl_path_from_page_num[matching_sl_page_num], 
-            "order_id": ps_oid, 
-            "tracking_number": sl_tno
+            "ps_page": None if VECTOR_OUTPUT else ps_path_from_page_num[ps_page_num], # composing at the pdf level needs no rasterized pages
+            "sl_page": None if VECTOR_OUTPUT else sl_path_from_page_num[matching_sl_page_num], 
+            "ps_source": (ps_pdf_path, ps_page_num),
+            "sl_source": (sl_pdf_path, matching_sl_page_num),
+            "order_id": sl_oids[matching_sl_page_num], # the label's, ps_oid may be a misreading of it
+            "tracking_number": sl_tno,
+            "match_confidence": confidence,
         }
         msg = "PS-SL matches " + str(ps_page_num) + " details:" \
-            + "\n        ps_path: " + os.path.basename(result[ps_page_num]["ps_path"]) \
-            + "\n        sl_path: " + os.path.basename(result[ps_page_num]["sl_path"]) \
+            + "\n        ps_page: " + str(ps_page_num) \
+            + "\n        sl_page: " + str(matching_sl_page_num) \
             + "\n       order_id: " + result[ps_page_num]["order_id"] \
-            + "\ntracking_number: " + result[ps_page_num]["tracking_number"]
+            + "\ntracking_number: " + result[ps_page_num]["tracking_number"] \
+            + "\n     confidence: " + ("%.2f" % confidence)
         log(msg)
 
     return result
 
-def pdf_to_images2(path_to_pdf, output_dir, dpi=200, range=None):
+# characters OCR mixes up with each other, substituting one for the other costs OID_CONFUSION_COST
+OID_CONFUSIONS = [ set("0Oo"), set("1lI|i"), set("5Ss"), set("8B"), set("2Z"), set("6b"), set("9g") ]
+OID_CONFUSION_COST = 0.3
+OID_STRAY_CHARS = " /.,'" # inserting or deleting one of these costs OID_STRAY_CHAR_COST
+OID_STRAY_CHAR_COST = 0.1
+
+def sl_oid_index(sl_oids):
+    '''
+    Index the sl oids (a dict from sl page number to oid, see oids_from_sl()) for match_sl_page().
+    Exact matches are a dict lookup, only the oids that don't match exactly are compared with 
+    every sl oid.
+    '''
+
+    exact = dict()
+    for sl_page_num in sorted(sl_oids.keys()):
+        exact.setdefault(normalized_oid(sl_oids[sl_page_num]), list()).append(sl_page_num)
+
+    return {"oids": sl_oids, "exact": exact, "matched": set(), "lock": threading.Lock()}
+
+def match_sl_page(sl_index, ps_oid, ps_page_num):
+    '''
+    The sl page number for the ps oid and a confidence for that match, from 1 (identical oids) 
+    down towards 0. Without FUZZY_OID_MATCHING only oids that are identical after normalized_oid() 
+    match.
+
+    Only sl pages that haven't been matched yet are candidates, every label goes with one slip. 
+    The nearest sl oid by oid_distance() wins, ties go to the sl page whose number is closest to 
+    ps_page_num, as the labels usually come in the same order as the slips.
+
+    Raises ValueError if there's no unmatched sl oid within MAX_OID_MATCH_DISTANCE, or if the sl 
+    pages with an identical oid have all been matched already.
+    '''
+
+    sl_oids = sl_index["oids"]
+    with sl_index["lock"]:
+        identical  = sl_index["exact"].get(normalized_oid(ps_oid), list())
+        candidates = [ p for p in identical if p not in sl_index["matched"] ]
+        distance   = 0.0
+        if identical and not candidates:
+            raise ValueError("the SL page(s) " + str(identical) + " with the order_ID " + str(ps_oid) + " already went with other PS pages")
+        
+        if not candidates and FUZZY_OID_MATCHING:
+            distances = { p: oid_distance(ps_oid, oid) for p, oid in sl_oids.items() if p not in sl_index["matched"] }
+            if distances:
+                distance   = min(distances.values())
+                candidates = [ p for p, d in distances.items() if d == distance ]
+        
+        if not candidates or distance > MAX_OID_MATCH_DISTANCE:
+            raise ValueError("could not find the given value: " + str(ps_oid) + " in the given dict: " + str(sl_oids))
+
+        sl_page_num = min(candidates, key=lambda p: abs(p - ps_page_num))
+        sl_index["matched"].add(sl_page_num)
+
+    confidence = max(0.0, 1 - distance / max(1, len(normalized_oid(ps_oid))))
+    if distance > 0:
+        count("fuzzy_oid_matches")
+        log("Matched PS oid " + ps_oid + " to SL oid " + sl_oids[sl_page_num] + " with confidence " + ("%.2f" % confidence))
+    return sl_page_num, confidence
+
+def oids_overlap(ps_oids, sl_oids):
+    '''
+    The fraction of the ps oids that match one of the sl oids (both dicts from page number to oid) 
+    by match_sl_page(), 0 if either has none. Tells which sl_pdf goes with which ps_pdf.
+    '''
+
+    if not ps_oids or not sl_oids:
+        return 0.0
+
+    sl_index = sl_oid_index(sl_oids)
+    matched = 0
+    for ps_page_num in sorted(ps_oids.keys()):
+        try:
+            match_sl_page(sl_index, ps_oids[ps_page_num], ps_page_num)
+            matched += 1
+        except ValueError:
+            pass
+
+    return matched / len(ps_oids)
+
+def normalized_oid(oid):
+    # the oid without whitespace and with the letters OCR most often reads instead of digits replaced
+
+
+    oid = "".join(c for c in oid if c not in OID_STRAY_CHARS)
+    for confusable in OID_CONFUSIONS:
+        digits = [c for c in confusable if c.isdigit()]
+        for c in confusable:
+            oid = oid.replace(c, digits[0]) if digits else oid
+    return oid
+
+def oid_distance(a, b):
+    # a weighted edit distance between two oids that makes OCR's typical slips cheap, see OID_CONFUSIONS
+
+
+    previous = [0.0]
+    for c in b:
+        previous.append(previous[-1] + (OID_STRAY_CHAR_COST if c in OID_STRAY_CHARS else 1))
+
+    for ca in a:
+        current = [previous[0] + (OID_STRAY_CHAR_COST if ca in OID_STRAY_CHARS else 1)]
+        for j in range(1, len(b) + 1):
+            cb = b[j - 1]
+            if ca == cb:
+                substitution = 0.0
+            elif any(ca in s and cb in s for s in OID_CONFUSIONS):
+                substitution = OID_CONFUSION_COST
+            else:
+                substitution = 1.0
+            
+            current.append(min(
+                previous[j - 1] + substitution,
+                previous[j] + (OID_STRAY_CHAR_COST if ca in OID_STRAY_CHARS else 1), # delete ca
+                current[j - 1] + (OID_STRAY_CHAR_COST if cb in OID_STRAY_CHARS else 1), # insert cb
+            ))
+        previous = current
+
+    return previous[-1]
+
+def start_speculative_job(pdf_path, delay=0):
+    '''
+    Start working on the 1st pdf of a pair in a background thread while the 2nd pdf is yet to 
+    arrive: check whether it is the ps_pdf and, if it is, rasterize it into its own dir in 
+    SPECULATIVE_TARGET and extract its order_IDs (with CHUNK_PAGES or STREAM_PAGES only the 
+    order_IDs are kept, not the pages). If it is the sl_pdf only its order_IDs are 
+    extracted, into result["sl_oids"], and the result is only good for telling which ps_pdf it 
+    goes with, see finish_speculative_job(). 
+
+    delay: max seconds to wait for the pdf to be fully written before starting, see wait_for_pdf_to_be_written()
+
+    Returns the job, pass it to do_amazon_print_job() once the pair is complete or to 
+    cancel_speculative_job() if the pair times out.
+    '''
+
+    os.makedirs(SPECULATIVE_TARGET, exist_ok=True)
+    job = {
+        "pdf_path": pdf_path, # kept up to date by speculative_job_pdf_moved()
+        "dir": tempfile.mkdtemp(dir=SPECULATIVE_TARGET),
+        "cancelled": threading.Event(),
+        "result": None,
+        "error": None,
+    }
+
+    def work():
+        wait_for_pdf_to_be_written(job["pdf_path"], timeout=delay, cancelled=job["cancelled"])
+        if job["cancelled"].is_set():
+            return
+
+        try:
+            path_from_page_num = pdf_to_pages(job["pdf_path"], job["dir"], page_range=(1, 1))
+            if job["cancelled"].is_set():
+                return
+
+            is_ps = is_ps_page(path_from_page_num[1], job["pdf_path"])
+
+            oids = dict()
+            sl_oids = None
+            if is_ps:
+                # with CHUNK_PAGES or STREAM_PAGES the job only ever holds a few PS pages at a time, so 
+                # the PS is gone through a window at a time here too and only its oids are kept
+                pages_count = pdf_page_count(job["pdf_path"])
+                keep_pages  = CHUNK_PAGES <= 0 and not STREAM_PAGES
+                window      = pages_count if keep_pages else (CHUNK_PAGES if CHUNK_PAGES > 0 else OCR_WORKERS)
+
+                for first in range(1, pages_count + 1, window):
+                    last  = min(pages_count, first + window - 1)
+                    pages = { 1: path_from_page_num[1] } if first == 1 else dict()
+                    if last >= max(first, 2):
+                        pages.update(pdf_to_pages(job["pdf_path"], job["dir"], page_range=(max(first, 2), last)))
+
+                    # OCR_WORKERS pages at a time so that they're OCR'd in parallel, and cancelling doesn't have to wait for all of them
+                    page_nums = sorted(pages.keys())
+                    for i in range(0, len(page_nums), OCR_WORKERS):
+                        if job["cancelled"].is_set():
+                            return
+                        oids.update(oids_from_ps({ p: pages[p] for p in page_nums[i:i+OCR_WORKERS] }, job["pdf_path"]))
+
+                    if keep_pages:
+                        path_from_page_num.update(pages)
+                    else:
+                        drop_pages(pages)
+                if not keep_pages:
+                    path_from_page_num = dict()
+            else:
+                path_from_page_num = None # an sl is only ever the 2nd pdf of a job, its pages aren't kept around
+                sl_oids = oids_from_sl(job["pdf_path"], append_slash_if_needed(job["dir"]) + "oids_from_sl/")
+
+            job["result"] = {
+                "path_from_page_num": path_from_page_num,
+                "is_ps": is_ps,
+                "oids": oids if is_ps else None,
+                "sl_oids": sl_oids,
+            }
+            log("Speculative processing done: " + os.path.basename(pdf_path))
+        except Exception as e:
+            job["error"] = e
+            log("Speculative processing failed, it will be redone normally: " + str(e))
+
+    log("Started speculative processing of: " + pdf_path)
+    job["thread"] = threading.Thread(target=work, daemon=True)
+    job["thread"].start()
+
+    return job
+
+def finish_speculative_job(job, pdf_path):
+    '''
+    Wait for the speculative job to finish and return its result, or None if it can't be used 
+    (it was for some other pdf, it failed, it got cancelled or it was for an sl_pdf).
+    '''
+
+    if job["pdf_path"] != pdf_path:
+        cancel_speculative_job(job)
+        return None
+
+    job["thread"].join()
+    result = None if job["cancelled"].is_set() else job["result"]
+    if result is not None and not result["is_ps"]:
+        result = None
+    if result is None:
+        count("speculative_fallbacks")
+    return result
+
+def cancel_speculative_job(job):
+    # throw away whatever the speculative job did, safe to call more than once
+
+
+    if job is None:
+        return
+
+    job["cancelled"].set()
+    job["thread"].join()
+    job["result"] = None
+    
+    discard_speculative_job_files(job)
+    log("Discarded speculative processing of: " + os.path.basename(job["pdf_path"]))
+
+def discard_speculative_job_files(job):
+    if job is not None:
+        shutil.rmtree(job["dir"], ignore_errors=True)
+
+def speculative_job_pdf_moved(job, new_pdf_path):
+    # tell the job its pdf has been moved, e.g. into a job dir. If the job happens to be opening 
+    # the pdf right then it fails and its work is redone normally.
+
+
+    if job is not None:
+        job["pdf_path"] = new_pdf_path
+
+def make_job_dir():
+    # a new, empty scratch dir in JOBS_TARGET for do_amazon_print_job(work_dir=...)
+
+
+    os.makedirs(JOBS_TARGET, exist_ok=True)
+    return append_slash_if_needed(tempfile.mkdtemp(prefix=datetime.datetime.now().strftime("%Y%m%d-%H%M%S-"), dir=JOBS_TARGET))
+
+@measured("rasterize")
+def pdf_to_pages(path_to_pdf, output_dir, dpi=None, page_range=None, profile=None):
+    '''
+    Rasterize the pdf into a dict from page number to page. With IN_MEMORY_PAGES the pages are 
+    decoded PIL images and output_dir is not touched, otherwise they are paths to PNGs written 
+    to output_dir by pdf_to_images2(). Everything that takes a page accepts either.
+
+    The pages are rendered with `profile`, OCR_RENDER_PROFILE by default, at `dpi` if given.
+    '''
+
+    profile = profile or OCR_RENDER_PROFILE
+    dpi     = dpi or profile["dpi"]
+
+    if IN_MEMORY_PAGES:
+        pages = pdf_to_images_in_memory(path_to_pdf, dpi=dpi, page_range=page_range, mode=profile["mode"])
+    else:
+        pages = pdf_to_images2(path_to_pdf, output_dir, dpi=dpi, page_range=page_range, mode=profile["mode"])
+
+    count("pages_rasterized", len(pages))
+    return pages
+
+def pdf_to_images_in_memory(path_to_pdf, dpi=200, page_range=None, mode="RGB"):
+    log("Started converting pdf to in-memory images.\n\t>>> Source PDF: " + path_to_pdf)
+
+    first_page = page_range[0] if bool(page_range) else 1
+    images = distributed_rasterize(path_to_pdf, dpi, page_range, mode)
+    if images is None:
+        images = convert_from_path(
+            pdf_path=path_to_pdf,
+            dpi=dpi,
+            first_page=first_page,
+            last_page=(page_range[1] if bool(page_range) else None),
+            fmt="ppm", # pdftoppm's raw output, so nothing gets encoded on the way in
+            grayscale=(mode != "RGB"),
+            thread_count=OCR_WORKERS,
+        )
+
+    dict_of_all_pages = dict()
+    for i in range(len(images)):
+        page_num = first_page + i
+        img = to_bilevel(images[i]) if mode == "1" and images[i].mode != "1" else images[i]
+        img.info["page_name"] = os.path.basename(path_to_pdf) + "-" + str(page_num)
+        img.info["source"]    = (path_to_pdf, page_num) # so it can be rendered again, see page_for_print()
+        img.info["dpi"]       = (dpi, dpi)
+        dict_of_all_pages[page_num] = img
+
+    log("Done converting pdf to images.")
+
+    return dict_of_all_pages
+
+def pdf_to_images2(path_to_pdf, output_dir, dpi=200, page_range=None, mode="RGB"):
     log("Started converting pdf to images.\n\t>>> Source PDF: " + path_to_pdf + "\n\t>>> Desti. dir: " + output_dir)
 
     file_name = str(random.randint(1, 9999999999999999999999))
     
     output_dir = append_slash_if_needed(output_dir)
-    r = " -f " + str(range[0]) + " -l " + str(range[1]) + " " if bool(range) else " "
-    command = "pdftoppm" + r + "-r " + str(dpi) + " -png " + path_to_pdf + " " + output_dir + file_name  #consult man pages for pdftoppm for help
+    r = " -f " + str(page_range[0]) + " -l " + str(page_range[1]) + " " if bool(page_range) else " "
+    color = { "RGB": "", "L": "-gray ", "1": "-mono " }[mode]
+    command = "pdftoppm" + r + "-r " + str(dpi) + " " + color + "-png " + path_to_pdf + " " + output_dir + file_name  #consult man pages for pdftoppm for help
     os.system(command)
     
 
@@ -135,19 +976,55 @@ def pdf_to_images2(path_to_pdf, output_dir, dpi=200, range=None):
 ############################## PS RELATED FUNCTIONS #####################################
 #########################################################################################
 
-def oids_from_ps(path_from_page_num):
+@measured("oids_from_ps")
+def oids_from_ps(path_from_page_num, ps_pdf_path=None):
+    '''
+    ps_pdf_path: if given, the oids are read from the pdf's text layer where possible and only 
+                 the pages without a usable text layer are OCR'd
+    '''
+
     result = dict()
-    for pnum, path in path_from_page_num.items():
-        img_text = image_to_string(Image.open(path))
+    
+    needs_ocr = dict()
+    text_layer = pdf_pages_text(ps_pdf_path) if ps_pdf_path else dict()
+    for pnum in path_from_page_num.keys(): # a page is only looked up if it has to be OCR'd, see LazyPages
+        m = re.search(PS_PAGES_MATCH_THIS, text_layer.get(pnum, ""))
+        if m:
+            order_id_string = "".join(re.split(r"\s+", m.group()))[-19:]
+            result[pnum] = order_id_string
+            log("Extracted an order_ID from a  PS's text layer: " + order_id_string)
+        else:
+            needs_ocr[pnum] = path_from_page_num[pnum]
+
+    if USE_ROI_OCR:
+        page_nums = list(needs_ocr.keys())
+        for pnum, order_id_string in zip(page_nums, ocr_map(oid_from_ps_rois, [needs_ocr[p] for p in page_nums])):
+            if order_id_string:
+                result[pnum] = order_id_string
+                del needs_ocr[pnum]
+                log("Extracted an order_ID from a  PS's header: " + order_id_string)
+
+    for pnum, img_text in sorted(all_pages_text(needs_ocr).items()):
         m = re.search(PS_PAGES_MATCH_THIS, img_text)
         order_id_string = img_text[ m.start() : m.end() ]
-        order_id_string = order_id_string[-19:]
+        order_id_string = "".join(re.split(r"\s+", order_id_string))[-19:]
         result[pnum] = order_id_string
         
         log("Extracted an order_ID from a  PS: " + order_id_string)
 
     return result
 
+def oid_from_ps_rois(ps_page):
+    # the oid OCR'd from one of the PS_OID_ROIS of the page, None if none of them has it
+
+
+    for box, psm in PS_OID_ROIS:
+        m = re.search(PS_PAGES_MATCH_THIS, str_from_region(ps_page, box, psm))
+        if m:
+            return "".join(re.split(r"\s+", m.group()))[-19:] # OID_LOOKS_LIKE_THIS lets OCR put spaces in it
+
+    return None
+
 #########################################################################################
 ############################## PS RELATED FUNCTIONS END #################################
 #########################################################################################
@@ -158,12 +1035,9 @@ def oids_from_ps(path_from_page_num):
 ############################## SL RELATED FUNCTIONS #####################################
 #########################################################################################
 
-def oids_from_sl(sl_pdf_path):
-    def extr_oids_from_oid_pages(oid_pages_paths_list):
-        oid_pages_text_list = list()
-        for page_path in oid_pages_paths_list:
-            oid_pages_text_list.append(str_from_img(page_path))
-        
+@measured("oids_from_sl")
+def oids_from_sl(sl_pdf_path, working_dir=None):
+    def extr_oids_from_oid_pages(oid_pages_text_list):
         oid_pages_text = "\n".join(oid_pages_text_list)
         oid_pages_lines = [line for line in oid_pages_text.split('\n') if line.strip() != ''] #removes blank lines
         oid_pages_lines.pop(0) #first line is always something we don't need
@@ -189,111 +1063,442 @@ def oids_from_sl(sl_pdf_path):
         return result
 
 
-    WORKING_DIR = "temp3310123blahblahblahblehblehbleh/" # slash at end is important
+    oids = oids_from_sl_text_layer(sl_pdf_path)
+    if oids:
+        return oids
+
+    WORKING_DIR = append_slash_if_needed(working_dir) if working_dir else "temp3310123blahblahblahblehblehbleh/" # slash at end is important
     
-    os.system("rm -r " + WORKING_DIR)
-    os.mkdir(WORKING_DIR)
+    if not IN_MEMORY_PAGES: # only pages rasterized to disk go through it, see pdf_to_pages()
+        shutil.rmtree(WORKING_DIR, ignore_errors=True)
+        os.mkdir(WORKING_DIR)
     
-    sl_path_from_page_num = pdf_to_images2(sl_pdf_path, WORKING_DIR, dpi=150)
-    total_pages_count     = len(sl_path_from_page_num)
-    reverse_paths         = [ sl_path_from_page_num[p] for p in sorted(sl_path_from_page_num.keys(), reverse=True) ]
+    total_pages_count = pdf_page_count(sl_pdf_path)
     
 
+    # the trailing oid summary pages as classified, or if that found none or ran into a page it 
+    # couldn't tell, rasterize and OCR from the end, OCR_WORKERS pages at a time, until the first 
+    # non-oid page
+    kinds = page_kinds(sl_pdf_path)
     oid_pages_count = 0
-    for path in reverse_paths:
-        last_page_text = str_from_img(path)
-        if is_oid_page_text(last_page_text):
-            oid_pages_count += 1
-        else:
+    for p in range(total_pages_count, 0, -1):
+        if kinds.get(p) != "oid_summary":
+            if kinds.get(p) not in ("label", "ps"):
+                oid_pages_count = 0
+            break
+        oid_pages_count += 1
+
+    reached_non_oid_page = oid_pages_count > 0
+    for last in range(total_pages_count, 0, -OCR_WORKERS):
+        if reached_non_oid_page:
             break
         
-    dpi_list = list()
-    for dpi in range(150, 601, 50):
-        dpi_dir = WORKING_DIR + str(dpi) + "/"
-        os.mkdir(dpi_dir)
+        first = max(1, last - OCR_WORKERS + 1)
+        sl_path_from_page_num = pdf_to_pages(sl_pdf_path, WORKING_DIR, dpi=150, page_range=(first, last))
+        reverse_paths = [ sl_path_from_page_num[p] for p in sorted(sl_path_from_page_num.keys(), reverse=True) ]
         
-        oid_page_num_range = (total_pages_count - oid_pages_count + 1), total_pages_count
-        d = pdf_to_images2(sl_pdf_path, dpi_dir, dpi=dpi, range=oid_page_num_range)
+        for last_page_text in ocr_map(str_from_img, reverse_paths):
+            if is_oid_page_text(last_page_text):
+                oid_pages_count += 1
+            else:
+                reached_non_oid_page = True
+                break
         
-        dpi_list.append(list(d.values()))
-
+    oid_page_num_range = (total_pages_count - oid_pages_count + 1), total_pages_count
     
-    dpi_list2 = list()
-    for oid_pages in dpi_list:
-        dpi_list2.append(extr_oids_from_oid_pages(oid_pages))
-
+    def oids_at_dpi(dpi):
+        dpi_dir = WORKING_DIR + str(dpi) + "/"
+        if not IN_MEMORY_PAGES:
+            os.mkdir(dpi_dir)
+        
+        d = pdf_to_pages(sl_pdf_path, dpi_dir, dpi=dpi, page_range=oid_page_num_range)
+        oid_pages = [d[p] for p in sorted(d.keys())]
+        
+        return extr_oids_from_oid_pages(list(ocr_map(str_from_img, oid_pages)))
+
+    # Vote on every page's oid with one render of the oid pages per dpi. With ADAPTIVE_OID_VOTE the 
+    # dpis that agreed most with past votes go first, in parallel rounds, and the vote stops as soon 
+    # as every page's leading oid is OID_VOTE_MARGIN votes ahead of the runner-up.
+    oid_page_nums   = range(1, total_pages_count - oid_pages_count + 1)
+    pending_dpis    = ordered_oid_vote_dpis() if ADAPTIVE_OID_VOTE else list(OID_VOTE_DPIS)
+    batch_size      = OID_VOTE_MARGIN if ADAPTIVE_OID_VOTE else len(pending_dpis)
+    oids_from_dpi   = dict()
+    page_to_frequencies = { p: dict() for p in oid_page_nums }
+
+    with ThreadPoolExecutor(max_workers=len(OID_VOTE_DPIS), thread_name_prefix="oid_vote") as renderers:
+        while pending_dpis and batch_size > 0:
+            batch, pending_dpis = pending_dpis[:batch_size], pending_dpis[batch_size:]
+            count("oid_vote_rounds")
+            count("oid_vote_renders", len(batch))
+            
+            for dpi, d in zip(batch, renderers.map(in_job_context(oids_at_dpi), batch)):
+                oids_from_dpi[dpi] = d
+                for p in oid_page_nums:
+                    if p in d:
+                        frequencies = page_to_frequencies[p]
+                        frequencies[d[p]] = frequencies.get(d[p], 0) + 1
+
+            batch_size = max(oid_vote_deficit(page_to_frequencies[p]) for p in oid_page_nums) if oid_page_nums else 0
     
-    page_to_frequencies = dict()
-    for p in range(1, total_pages_count - oid_pages_count + 1):
-        frequencies = dict()
-        for d in dpi_list2:
-            recognized = d[p]
-            if recognized in frequencies.keys():
-                frequencies[recognized] += 1
-            else:
-                frequencies[recognized] = 1
-
-        page_to_frequencies[p] = frequencies 
+    log("Voted on the SL order_IDs with " + str(len(oids_from_dpi)) + " of " + str(len(OID_VOTE_DPIS)) + " dpis: " + str(sorted(oids_from_dpi.keys())))
     
 
     result = dict()
-    for p in range(1, total_pages_count - oid_pages_count + 1):
+    for p in oid_page_nums:
         frequencies = page_to_frequencies[p]
         most_frequent_oid = k_from_v(frequencies, max(frequencies.values()))
         result[p] = str(most_frequent_oid)
 
+    record_oid_vote(oids_from_dpi, result)
+
     # for k, v in result.items():
     #     print(k, "->", v)
 
 
-    os.system("rm -r " + WORKING_DIR)
+    if not IN_MEMORY_PAGES:
+        shutil.rmtree(WORKING_DIR, ignore_errors=True)
 
     return result
     
 
-def tnos_from_sl(sl_path_from_page_num):
-    def extr_tno_from_sl(sl_page_text):
-        # sample intended match: "TRK# 3933 7813 1941"
-        match1 = re.search(pattern=r"TRK.{1,4}[\d]{4}[\s]{0,2}[\d]{4}[\s]{0,2}[\d]{4}", string=sl_page_text)
-        
-        # sample intended match: "TRACKING #: 1Z O9A Y33 03 9278 4049"
-        # sample intended match: "TRACKING #: 1Z 09A Y33 03 9278 4049", notice that the OCR can mistakenly recognize 0 as O and vice versa
-        match2 = re.search(pattern=r"TRACKING[\s]{0,2}#:[\s]{0,2}[\w]{2}[\s]{0,2}[\w]{3}[\s]{0,2}[\w]{3}[\s]{0,2}[\w]{2}[\s]{0,2}[\d]{4}[\s]{0,2}[\d]{4}", string=sl_page_text)
+def oids_from_sl_text_layer(sl_pdf_path):
+    '''
+    The oids on the trailing oid summary pages of the sl_pdf read straight from its text layer, 
+    numbered in the same way as oids_from_sl() numbers them. Returns None if the text layer is 
+    missing or doesn't have exactly one oid for each of the other pages.
+    '''
 
-        # sample intended match: "USPS TRACKING # EP\n\n9305 5201 1140 4895 5861 69"
-        # sample intended match: "USPS TRACKING # EP\n\nil il\n\n9305 5201 1140 4895 5861 69"
-        match3 = re.search(pattern=r"USPS[\s]{0,2}TRACKING[\s]{0,2}#.*(\s*\d){22}", string=sl_page_text, flags=re.S)
-        
-        if match1:
-            tno = sl_page_text[ match1.start() : match1.end() ]
-            tno = "".join(re.split(r"\s+", tno)) # removes all whitespace matched by \s
-            tno = tno[-12:]
-        elif match2:
-            tno = sl_page_text[ match2.start() : match2.end() ]
-            tno = "".join(re.split(r"\s+", tno))
-            tno = tno[-18:]
-            tno = tno.replace("1ZO9A", "1Z09A")
-        elif match3:
-            tno = sl_page_text[ match3.start() : match3.end() ]
-            m = re.search(pattern=r"(\s*\d){22}", string=tno)
-            tno = tno[ m.start() : m.end() ] 
-            tno = "".join(re.split(r"\s+", tno))
-            
-        
-        log("Extracted a  tno      from an SL: " + tno)
-        return tno    
-        
-        raise Exception("Couldn't extract the tracking number from the following shipping label: \
-                        \n--------------------\n" + sl_page_text + "\n--------------------\n")
+    text_layer = pdf_pages_text(sl_pdf_path)
+    if not text_layer:
+        return None
+
+    oid_pages_text_list = list()
+    for pnum in sorted(text_layer.keys(), reverse=True):
+        if not is_oid_page_text(text_layer[pnum]):
+            break
+        oid_pages_text_list.insert(0, text_layer[pnum])
+
+    label_pages_count = len(text_layer) - len(oid_pages_text_list)
+    oids = [ "".join(re.split(r"\s+", m.group())) for m in re.finditer(OID_LOOKS_LIKE_THIS, "\n".join(oid_pages_text_list)) ]
+    if label_pages_count == 0 or len(oids) != label_pages_count:
+        return None
 
     result = dict()
-    for pno, thetext in all_pages_text(sl_path_from_page_num).items():
+    for i in range(len(oids)):
+        result[i + 1] = oids[i]
+        log("Extracted an order_ID from an SL's text layer: " + oids[i])
+
+    return result
+
+def oid_vote_deficit(frequencies):
+    # how many more votes a page needs before its leading oid is OID_VOTE_MARGIN votes ahead
+
+
+    counts = sorted(frequencies.values(), reverse=True) + [0, 0]
+    return max(0, OID_VOTE_MARGIN - (counts[0] - counts[1]))
+
+def ordered_oid_vote_dpis():
+    # OID_VOTE_DPIS, the ones that agreed most often with the final vote first, cheaper ones first on ties
+
+
+    stats = load_oid_vote_stats()
+
+    def agreement_rate(dpi):
+        agreed, voted = stats.get(str(dpi), (0, 0))
+        return (agreed + 1) / (voted + 2) # smoothed, so dpis without a history sit in the middle
+
+    return sorted(OID_VOTE_DPIS, key=lambda dpi: (-agreement_rate(dpi), dpi))
+
+def load_oid_vote_stats():
+    try:
+        with open(OID_VOTE_STATS_PATH, "rt") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return dict()
+
+def record_oid_vote(oids_from_dpi, final_oids):
+    # remember how well each dpi that voted agreed with the outcome, see ordered_oid_vote_dpis()
+
+
+    with _oid_vote_stats_lock:
+        _record_oid_vote(oids_from_dpi, final_oids)
+
+_oid_vote_stats_lock = threading.Lock()
+
+def _record_oid_vote(oids_from_dpi, final_oids):
+    stats = load_oid_vote_stats()
+    for dpi, oids in oids_from_dpi.items():
+        agreed, voted = stats.get(str(dpi), (0, 0))
+        for p, oid in final_oids.items():
+            agreed += int(oids.get(p) == oid)
+            voted  += 1
+        stats[str(dpi)] = (agreed, voted)
+
+    try:
+        with open(OID_VOTE_STATS_PATH, "wt") as f:
+            json.dump(stats, f)
+    except OSError as e:
+        log("Couldn't save the oid vote stats: " + str(e))
+    
+@measured("tnos_from_sl")
+def tnos_from_sl(sl_path_from_page_num, sl_pdf_path=None):
+    '''
+    sl_pdf_path: if given, the tnos are read from the pdf's text layer where possible and only 
+                 the pages without a usable text layer are OCR'd, skipping the ones page_kinds() 
+                 says are oid summary pages (never the ones it can't tell)
+    '''
+
+    result = dict()
+    
+    needs_ocr = dict()
+    text_layer = pdf_pages_text(sl_pdf_path) if sl_pdf_path else dict()
+    kinds      = page_kinds(sl_pdf_path) if sl_pdf_path else dict()
+    for pno in sl_path_from_page_num.keys(): # a page is only looked up if it has to be OCR'd, see LazyPages
+        if kinds.get(pno) == "oid_summary":
+            continue
+        thetext = text_layer.get(pno, "")
+        tno = tno_from_sl_text(thetext) if not is_oid_page_text(thetext) else None
+        if tno:
+            log("Extracted a  tno      from an SL's text layer: " + tno)
+            result[pno] = tno
+        elif not is_oid_page_text(thetext):
+            needs_ocr[pno] = sl_path_from_page_num[pno]
+        
+    if USE_BARCODE_TNOS:
+        page_nums = list(needs_ocr.keys())
+        for pno, tno in zip(page_nums, ocr_map(tno_from_sl_barcodes, [needs_ocr[p] for p in page_nums])):
+            if tno:
+                result[pno] = tno
+                del needs_ocr[pno]
+                log("Extracted a  tno      from an SL's barcode: " + tno)
+        count("tnos_from_barcodes", len(page_nums) - len(needs_ocr))
+
+    if USE_ROI_OCR:
+        page_nums = list(needs_ocr.keys())
+        for pno, tno in zip(page_nums, ocr_map(tno_from_sl_rois, [needs_ocr[p] for p in page_nums])):
+            if tno:
+                result[pno] = tno
+                del needs_ocr[pno]
+                log("Extracted a  tno      from an SL's tracking number region: " + tno)
+
+    for pno, thetext in all_pages_text(needs_ocr).items():
         if not is_oid_page_text(thetext):
-            result[pno] = extr_tno_from_sl(thetext)
+            tno = tno_from_sl_text(thetext)
+            if tno is None:
+                count("tno_extraction_failures")
+                raise Exception("Couldn't extract the tracking number from the following shipping label: \
+                                \n--------------------\n" + thetext + "\n--------------------\n")
+            
+            log("Extracted a  tno      from an SL: " + tno)
+            result[pno] = tno
 
     return result
+
+def tno_from_sl_rois(sl_page):
+    # the tno OCR'd from one of the SL_TNO_ROIS of the page, None if none of them has it
+
+
+    for box, psm in SL_TNO_ROIS:
+        tno = tno_from_sl_text(str_from_region(sl_page, box, psm))
+        if tno:
+            return tno
+
+    return None
+
+# Code128 symbols as the widths of their bars and spaces in modules, e.g. "11011001100" -> (2,1,2,2,2,2)
+def code128_widths(bits):
+    return tuple( len(list(g)) for _, g in itertools.groupby(bits) )
+
+CODE128_VALUE_FROM_WIDTHS = { code128_widths(bits): value for value, bits in enumerate(code128_charset.CODES) }
+CODE128_STOP   = code128_widths(code128_charset.STOP + "11") # the stop symbol ends with a 2 module bar
+CODE128_STARTS = { 103: "A", 104: "B", 105: "C" }
+CODE128_CHARS  = { 
+    "A": { v: c for c, v in code128_charset.A.items() },
+    "B": { v: c for c, v in code128_charset.B.items() },
+}
+FNC1 = "\xf1" # separates GS1 fields
+
+def tno_from_sl_barcodes(sl_page):
+    '''
+    The tno read from one of the Code128 barcodes on the label, None if none of the barcodes that 
+    could be decoded has one, see tno_from_barcode_data(). The page is read along 
+    BARCODE_SCANLINES horizontal lines, each of them the average of a few pixel rows.
+    '''
+
+    img  = open_page(sl_page)
+    gray = img if img.mode == "L" else img.convert("L")
+    
+    try:
+        w, h = gray.size
+        rows = max(1, h // 300) # about a hundredth of an inch tall at 200 dpi
+        seen = set()
+        for i in range(1, BARCODE_SCANLINES):
+            y = i * h // BARCODE_SCANLINES
+            line = gray.crop((0, y, w, y + rows)).resize((w, 1), Image.BOX).tobytes()
+            
+            for data in code128_from_scanline(line):
+                if data not in seen:
+                    seen.add(data)
+                    tno = tno_from_barcode_data(data)
+                    if tno:
+                        return tno
+    finally:
+        if gray is not img:
+            gray.close()
+        close_page(img, sl_page)
+
+    return None
+
+def code128_from_scanline(line):
+    # everything that decodes as a Code128 barcode, checksum included, along the bytes of a grayscale pixel row, either way round
+
+
+    runs = [ (dark, len(list(g))) for dark, g in itertools.groupby(b < 128 for b in line) ]
+
+    found = list()
+    for ordered in (runs, runs[::-1]):
+        widths = [ n for _, n in ordered ]
+        i = 0 if ordered and ordered[0][0] else 1 # barcodes start with a bar
+        while i + 6 <= len(widths):
+            if CODE128_VALUE_FROM_WIDTHS.get(normalized_widths(widths[i:i+6], 11)) in CODE128_STARTS:
+                data, length = decode_code128(widths[i:])
+                if data is not None:
+                    found.append(data)
+                    i += length + 1 # past the quiet zone, onto the next bar
+                    continue
+            i += 2 # the next bar
+
+    return found
+
+def normalized_widths(runs, modules):
+    # the runs, in pixels, as whole module widths (1 to 4) adding up to `modules`, the widest rounding errors corrected
+
+
+    unit = sum(runs) / modules
+    widths = [ min(4, max(1, round(r / unit))) for r in runs ]
     
+    error = sum(widths) - modules
+    while error != 0:
+        step = 1 if error < 0 else -1
+        candidates = [ j for j in range(len(runs)) if 1 <= widths[j] + step <= 4 ]
+        if not candidates:
+            break
+        j = max(candidates, key=lambda j: (runs[j] / unit - widths[j]) * step)
+        widths[j] += step
+        error += step
+
+    return tuple(widths)
+
+def decode_code128(widths):
+    '''
+    Decode the Code128 barcode whose start symbol is at the beginning of `widths`, bar and space 
+    widths in pixels. Returns (data, number of widths it spans), or (None, 0) if it isn't one or 
+    its checksum doesn't add up. FNC1s are kept as FNC1.
+    '''
 
+    values = list()
+    i = 0
+    while True:
+        if i + 7 <= len(widths) and normalized_widths(widths[i:i+7], 13) == CODE128_STOP:
+            break
+        if i + 6 > len(widths):
+            return None, 0
+        value = CODE128_VALUE_FROM_WIDTHS.get(normalized_widths(widths[i:i+6], 11))
+        if value is None or (i > 0 and value in CODE128_STARTS):
+            return None, 0
+        values.append(value)
+        i += 6
+
+    if len(values) < 3:
+        return None, 0
+    checksum = (values[0] + sum( k * v for k, v in enumerate(values[1:-1], 1) )) % 103
+    if checksum != values[-1]:
+        return None, 0
+
+    data  = list()
+    code  = CODE128_STARTS[values[0]]
+    shift = False
+    for v in values[1:-1]:
+        current = ("B" if code == "A" else "A") if shift else code
+        shift = False
+        
+        if current == "C":
+            if v < 100:
+                data.append("%02d" % v)
+            elif v == 102:
+                data.append(FNC1)
+            else:
+                code = { 100: "B", 101: "A" }[v]
+            continue
+
+        c = CODE128_CHARS[current][v]
+        if c == "SHIFT":
+            shift = True
+        elif c in ("TO_A", "TO_B", "TO_C"):
+            code = c[-1]
+        elif c == FNC1:
+            data.append(c)
+        elif len(c) == 1 and c not in "\xf2\xf3\xf4": # FNC2-4 mean nothing here
+            data.append(c)
+
+    return "".join(data), i + 7
+
+def tno_from_barcode_data(data):
+    '''
+    The tno encoded in the decoded barcode data, in the form tno_from_sl_text() gives it, None 
+    if it's some other barcode:
+        UPS  : "1Z09AY330392784049"
+        FedEx: "9622080430006094377900393378131941", the last 12 digits
+        USPS : "42085142" FNC1 "9305520111404895586169", the (up to) 22 digits after the zip
+    '''
+
+    data = data.strip(FNC1)
+    
+    m = re.fullmatch(r"1Z[0-9A-Z]{16}", data)
+    if m:
+        return data
+    
+    if re.fullmatch(r"96\d{32}", data):
+        return data[-12:]
+
+    m = re.fullmatch(r"(420\d{5}(\d{4})?" + FNC1 + r"?)?(9\d{21})", data)
+    if m:
+        return m.group(3)
+
+    return None
+
+def tno_from_sl_text(sl_page_text):
+    # returns the tracking number in the given shipping label text or None if there isn't one
+
+
+    # sample intended match: "TRK# 3933 7813 1941"
+    match1 = re.search(pattern=r"TRK.{1,4}[\d]{4}[\s]{0,2}[\d]{4}[\s]{0,2}[\d]{4}", string=sl_page_text)
+    
+    # sample intended match: "TRACKING #: 1Z O9A Y33 03 9278 4049"
+    # sample intended match: "TRACKING #: 1Z 09A Y33 03 9278 4049", notice that the OCR can mistakenly recognize 0 as O and vice versa
+    match2 = re.search(pattern=r"TRACKING[\s]{0,2}#:[\s]{0,2}[\w]{2}[\s]{0,2}[\w]{3}[\s]{0,2}[\w]{3}[\s]{0,2}[\w]{2}[\s]{0,2}[\d]{4}[\s]{0,2}[\d]{4}", string=sl_page_text)
+
+    # sample intended match: "USPS TRACKING # EP\n\n9305 5201 1140 4895 5861 69"
+    # sample intended match: "USPS TRACKING # EP\n\nil il\n\n9305 5201 1140 4895 5861 69"
+    match3 = re.search(pattern=r"USPS[\s]{0,2}TRACKING[\s]{0,2}#.*(\s*\d){22}", string=sl_page_text, flags=re.S)
+    
+    tno = None
+    if match1:
+        tno = sl_page_text[ match1.start() : match1.end() ]
+        tno = "".join(re.split(r"\s+", tno)) # removes all whitespace matched by \s
+        tno = tno[-12:]
+    elif match2:
+        tno = sl_page_text[ match2.start() : match2.end() ]
+        tno = "".join(re.split(r"\s+", tno))
+        tno = tno[-18:]
+        tno = tno.replace("1ZO9A", "1Z09A")
+    elif match3:
+        tno = sl_page_text[ match3.start() : match3.end() ]
+        m = re.search(pattern=r"(\s*\d){22}", string=tno)
+        tno = tno[ m.start() : m.end() ] 
+        tno = "".join(re.split(r"\s+", tno))
+    
+    return tno
 
 #########################################################################################
 ############################## SL RELATED FUNCTIONS END #################################
@@ -326,12 +1531,163 @@ def tnos_from_sl(sl_path_from_page_num):
 def is_oid_page_text(page_text):
     return re.search(pattern=OID_LOOKS_LIKE_THIS, string=page_text) != None
 
-def is_ps_page(a_page):
-    img_text = str_from_img(a_page)
+def is_ps_page(a_page, pdf_path=None):
+    '''
+    a_page  : path to the image of the 1st page of a pdf, or a function returning it
+    pdf_path: that pdf, if given its text layer and then page_kinds() are checked first and a_page 
+              is only OCR'd if neither can tell a ps from an sl
+    '''
+
+    page_text = pdf_pages_text(pdf_path).get(1, "") if pdf_path else ""
+    if re.search(PS_PAGES_MATCH_THIS, page_text):
+        return True
+    if tno_from_sl_text(page_text):
+        return False
+
+    kind = page_kinds(pdf_path).get(1) if pdf_path else None # the whole pdf, so that later callers find it cached
+    if kind in ("ps", "label"):
+        return kind == "ps"
+
+    img_text = str_from_img(a_page() if callable(a_page) else a_page)
     match = re.search(PS_PAGES_MATCH_THIS, img_text)
 
     return bool(match)
 
+def page_kinds(path_to_pdf):
+    '''
+    What each page of the pdf is, as a dict from page number to "ps", "label", "oid_summary" or 
+    "unknown". A page is classified from its text layer if it has a telling one, and otherwise 
+    from a THUMBNAIL_DPI grayscale thumbnail, see page_kind_from_thumbnail(), which takes a few 
+    milliseconds a page where OCR takes seconds. The result is cached, so is_ps_page(), 
+    oids_from_sl() and tnos_from_sl() share one pass over the pdf.
+
+    Returns an empty dict if USE_PAGE_CLASSIFIER is False or the pdf can't be rendered.
+    '''
+
+    if not USE_PAGE_CLASSIFIER:
+        return dict()
+
+    try:
+        st = os.stat(path_to_pdf)
+        return dict(_page_kinds(path_to_pdf, st.st_mtime, st.st_size))
+    except Exception as e:
+        log("Couldn't classify the pages of: " + path_to_pdf + ", falling back to OCR. (" + str(e) + ")")
+        return dict()
+
+@functools.lru_cache(maxsize=16)
+def _page_kinds(path_to_pdf, mtime, size):
+    # mtime and size are only there so that a changed file isn't served from the cache
+
+
+    with span("classify_pages"):
+        text_layer = pdf_pages_text(path_to_pdf)
+        thumbnails = pdf_to_images_in_memory(path_to_pdf, dpi=THUMBNAIL_DPI, mode="L")
+
+        result = list()
+        for page_num in sorted(thumbnails.keys()):
+            text = text_layer.get(page_num, "")
+            if re.search(PS_PAGES_MATCH_THIS, text):
+                kind = "ps"
+            elif tno_from_sl_text(text):
+                kind = "label"
+            elif is_oid_page_text(text):
+                kind = "oid_summary"
+            else:
+                kind = page_kind_from_thumbnail(thumbnails[page_num])
+            thumbnails[page_num].close()
+            result.append((page_num, kind))
+
+    count("pages_classified", len(result))
+    log("Classified the pages of " + os.path.basename(path_to_pdf) + ": " + ", ".join(
+        kind + " x" + str(len(list(group))) for kind, group in itertools.groupby(kind for _, kind in result)
+    ))
+    return tuple(result)
+
+def page_kind_from_thumbnail(img):
+    # "label", "ps", "oid_summary" or "unknown" for the decoded grayscale thumbnail of a page, see LABEL_MIN_INK
+
+
+    histogram = img.histogram()
+    ink = sum(histogram[:128]) / (img.width * img.height)
+    if ink >= LABEL_MIN_INK:
+        return "label"
+
+    # a dark run across a quarter of the width fully covers at least one of 8 cells of its row
+    cells = img.resize((8, img.height), Image.BOX)
+    px = cells.load()
+    rules = sum( 1 for y in range(img.height) if min(px[x, y] for x in range(8)) < 100 )
+    cells.close()
+
+    if rules >= PS_MIN_RULES:
+        return "ps"
+    return "oid_summary" if ink < OID_SUMMARY_MAX_INK else "unknown"
+
+def pdf_pages_text(path_to_pdf):
+    '''
+    The embedded text layer of each page of the pdf, as a dict from page number (starting at 1) 
+    to text. Pages without one map to "". Returns an empty dict if USE_PDF_TEXT_LAYER is False 
+    or the pdf can't be read.
+    '''
+
+    if not USE_PDF_TEXT_LAYER:
+        return dict()
+
+    try:
+        st = os.stat(path_to_pdf)
+        return dict(_pdf_pages_text(path_to_pdf, st.st_mtime, st.st_size))
+    except Exception as e:
+        log("Couldn't read the text layer of: " + path_to_pdf + ", falling back to OCR. (" + str(e) + ")")
+        return dict()
+
+@functools.lru_cache(maxsize=8)
+def _pdf_pages_text(path_to_pdf, mtime, size):
+    # mtime and size are only there so that a changed file isn't served from the cache
+
+
+    with open(path_to_pdf, "rb") as f:
+        reader = PdfFileReader(f, strict=False)
+        return tuple( (i + 1, reader.getPage(i).extractText() or "") for i in range(reader.getNumPages()) )
+
+def wait_for_pdf_to_be_written(path_to_pdf, timeout=None, cancelled=None):
+    '''
+    Block until the pdf looks fully written: it ends with a "%%EOF" trailer and its size hasn't 
+    changed for FILE_STABLE_FOR seconds. Gives up after `timeout` seconds (FILE_WRITE_TIMEOUT if 
+    None) or as soon as the `cancelled` threading.Event is set.
+
+    Returns True if the pdf looks complete, False otherwise.
+    '''
+
+    timeout  = FILE_WRITE_TIMEOUT if timeout is None else timeout
+    deadline = time.time() + timeout
+    poll     = min(0.05, FILE_STABLE_FOR)
+
+    last_size, stable_since = -1, time.time()
+    while True:
+        try:
+            size = os.path.getsize(path_to_pdf)
+            if size != last_size:
+                last_size, stable_since = size, time.time()
+            elif time.time() - stable_since >= FILE_STABLE_FOR and has_pdf_trailer(path_to_pdf):
+                return True
+        except OSError:
+            pass # not there (yet)
+
+        if time.time() >= deadline:
+            log("Timed out waiting for the pdf to be fully written, going ahead anyway: " + path_to_pdf)
+            return False
+        
+        if cancelled is not None:
+            if cancelled.wait(poll):
+                return False
+        else:
+            time.sleep(poll)
+
+def has_pdf_trailer(path_to_pdf):
+    with open(path_to_pdf, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(0, f.tell() - 1024))
+        return b"%%EOF" in f.read()
+
 def empty_dir(dir_path, *whitelist):
     log("Emptiying dir at: " + dir_path + ( "\nexcept: " + ", ".join(whitelist) if len(whitelist) else "" ))
 
@@ -344,8 +1700,69 @@ def empty_dir(dir_path, *whitelist):
     for file in files:
         os.remove(file)
 
-def str_from_img(img_path):
-    return image_to_string(Image.open(img_path))
+@measured("ocr")
+def str_from_img(img_path, config=OCR_CONFIG):
+    # img_path can also be an already decoded page, see pdf_to_pages()
+
+
+    img = open_page(img_path)
+    try:
+        key = ocr_cache_key(img, config) if USE_OCR_CACHE else None
+        text = ocr_cache_get(key) if key else None
+        count("ocr_calls")
+        if text is None:
+            count("tesseract_runs")
+            text = ocr_backend()(img, config)
+            if key:
+                ocr_cache_put(key, text)
+        return text
+    finally:
+        close_page(img, img_path)
+
+def str_from_region(page, box, psm):
+    '''
+    OCR only a part of the page.
+
+    box: (left, top, right, bottom) as fractions of the page's width and height
+    psm: the tesseract page segmentation mode to use for it
+    '''
+
+    img = open_page(page)
+    try:
+        w, h = img.size
+        region = img.crop((int(box[0] * w), int(box[1] * h), int(box[2] * w), int(box[3] * h)))
+        return str_from_img(region, config=(OCR_CONFIG + " --psm " + str(psm)).strip())
+    finally:
+        close_page(img, page)
+
+def open_page(page):
+    # a page is either the path to an image or an already decoded PIL image
+
+
+    return page if isinstance(page, Image.Image) else Image.open(page)
+
+def close_page(img, page):
+    # close img only if open_page(page) had to open it
+
+
+    if img is not page:
+        img.close()
+
+def drop_pages(path_from_page_num):
+    # free the pages of a dict like the ones pdf_to_pages() returns, deleting the ones that are files
+
+
+    for page in path_from_page_num.values():
+        if isinstance(page, Image.Image):
+            page.close()
+        elif os.path.exists(page):
+            os.remove(page)
+
+def page_name(page):
+    if isinstance(page, Image.Image):
+        return page.info.get("page_name", "<in-memory page>")
+    return os.path.basename(page)
+
 
 def display_alert(msg, blocking):
     # it will be a little better if this is passed rstrings
@@ -386,16 +1803,16 @@ result_path=None
     '''
     Paste an image on top of another image at the required position with a scaling factor.
 
-    back: path to an image
-    front: path to an image which will be pasted on top of back
+    back: path to an image, or a decoded image which is then pasted on in place
+    front: path to an image (or a decoded image) which will be pasted on top of back
     front_pos: position of upper-left corner of front on back
     scale_front_size: scaling factor for front
     result_path: path for new file, if None then back will be overwritten
     '''
 
-    b  = Image.open(back)
-    f1 = Image.open(front1)
-    f2 = Image.open(front2)
+    b  = open_page(back)
+    f1_original = f1 = open_page(front1)
+    f2_original = f2 = open_page(front2)
 
     front1_size = (
         int(f1.size[0] * scale_front1_size), 
@@ -407,49 +1824,55 @@ result_path=None
     )
 
     
-    f1 = f1.resize(front1_size)
-    f2 = f2.resize(front2_size)
+    if scale_front1_size != 1:
+        f1 = f1.resize(front1_size)
+    if scale_front2_size != 1:
+        f2 = f2.resize(front2_size)
 
     b.paste(f1, front1_pos)
     b.paste(f2, front2_pos)
 
-    if result_path == None:
-        b.save(back, "PNG")
-    else:
+    if result_path != None:
         b.save(result_path, "PNG")
+    elif b is not back:
+        b.save(back, "PNG")
 
-    b.close()
-    f1.close()
-    f2.close()
+    close_page(b, back)
+    for f, f_original, front in ((f1, f1_original, front1), (f2, f2_original, front2)):
+        if f is not f_original:
+            f.close()
+        close_page(f_original, front)
 
 
 def paste_barcodes_on_ps(oid, tno, on, result=None):
     '''
     oid          : the oid from which to generate the upper-right barcode 
     tno          : the tno from which to generate the   bottom    barcode 
-    on           : the path to the image on which the generated barcode will be pasted
+    on           : the page (see pdf_to_pages()) on which the generated barcode will be pasted
     result       : the path to the new image, if None the source image will be overwritten
     '''
 
-    log("Pasting barcodes for oid: " + str(oid) + " and tno: " + str(tno) + " on: " + os.path.basename(on))
+    log("Pasting barcodes for oid: " + str(oid) + " and tno: " + str(tno) + " on: " + page_name(on))
+
+    b = open_page(on)
+    w, h = b.size
+    close_page(b, on)
+    page_scale = w / PS_IMG_W # the page can be rendered at any dpi
 
     oid_pos  = (
-        int(0.61 * PS_IMG_W),
-        int(0.01 * PS_IMG_H)
+        int(0.61 * w),
+        int(0.01 * h)
     )
-    oid_scale_by = 1
+    oid_scale_by = 1 * page_scale
     
     tno_pos = (
-        int(0.33 * PS_IMG_W),
-        int(0.76 * PS_IMG_H)
+        int(0.33 * w),
+        int(0.76 * h)
     )
-    tno_scale_by = 1.8
+    tno_scale_by = 1.8 * page_scale
 
-    b1 = barcode.get("code128", oid, writer=barcode.writer.ImageWriter())
-    oid_barcode = b1.save("1_a_uniquely_named_temp_file_which_won't_conflit_with_anything_else_FDAKJHFIUHIBCHEFDACN")
-    
-    b2 = barcode.get("code128", tno, writer=barcode.writer.ImageWriter())
-    tno_barcode = b2.save("2_a_uniquely_named_temp_file_which_won't_conflit_with_anything_else_FDAKJHFIUHIBCHEFDACN")
+    oid_barcode = barcode_image(oid, scale_by=oid_scale_by)
+    tno_barcode = barcode_image(tno, scale_by=tno_scale_by)
 
     paste(
         back=on,
@@ -457,16 +1880,36 @@ def paste_barcodes_on_ps(oid, tno, on, result=None):
         front2=tno_barcode,
         front1_pos=oid_pos, 
         front2_pos=tno_pos, 
-        scale_front1_size=oid_scale_by,
-        scale_front2_size=tno_scale_by, 
-        result_path=(on if result == None else result)
+        scale_front1_size=1, # already rendered at scale
+        scale_front2_size=1, 
+        result_path=result
     )
 
-    os.remove(oid_barcode)
-    os.remove(tno_barcode)
+    oid_barcode.close()
+    tno_barcode.close()
 
     log("Done")
 
+_barcode_writers = threading.local()
+CODE128 = barcode.get_barcode_class("code128")
+
+def barcode_image(data, scale_by=1):
+    '''
+    A Code128 barcode of `data` as an in-memory image, drawn directly at `scale_by` times the 
+    size python-barcode draws it at by default, text included.
+    '''
+
+    # ImageWriter keeps the image it's drawing on itself, so every thread gets its own
+    writer = getattr(_barcode_writers, "writer", None)
+    if writer is None:
+        writer = _barcode_writers.writer = barcode.writer.ImageWriter()
+
+    options = {
+        "dpi": int(round(300 * scale_by)),     # python-barcode's defaults, scaled
+        "font_size": int(round(10 * scale_by)),
+    }
+    return CODE128(data, writer=writer).render(options)
+
 def empty_or_make_new(dir_path):
     if os.path.exists(dir_path) and os.path.isdir(dir_path):
         empty_dir(dir_path)
@@ -477,57 +1920,431 @@ def empty_or_make_new(dir_path):
 def combine_ps_and_sl(ps_path, sl_path, output):
     '''
     There will be a new image at the path `output` which has the image at `ps_path` on the 
-    left half of it and the image at `sl_path` on the right half of it
+    left half of it and the image at `sl_path` on the right half of it. Both can also be 
+    decoded pages, see pdf_to_pages().
     '''
     
     log(
         "Making a single page \n\tfrom: " \
-        + os.path.basename(ps_path) \
-        + "\n\t and: " + os.path.basename(sl_path) \
+        + page_name(ps_path) \
+        + "\n\t and: " + page_name(sl_path) \
         + "\n\t  at: " + os.path.basename(output)
     )
 
+    ps = open_page(ps_path)
+    sl = open_page(sl_path)
+
+    canvas = combined_image(ps, sl)
+    save_for_print(canvas, output)
+
+    close_page(ps, ps_path)
+    close_page(sl, sl_path)
+    canvas.close()
+
+    log("Done")
+
+def combined_image(ps, sl, rotate=True):
+    # the decoded images ps and sl side by side on one canvas, rotated by 90 degrees if `rotate`
+
+
     IMG2_HORIZONTAL_OFFSET = 50
-    
-    ps = Image.open(ps_path)
-    sl = Image.open(sl_path)
 
     # make height of sl equal to the height of ps while sl maintains its original aspect ratio
     scaling_needed = ps.height / sl.height 
     new_sl_size = int(sl.width*scaling_needed), int(sl.height*scaling_needed)
     sl = sl.resize(new_sl_size)
 
-    canvas = Image.new("RGB", (2*ps.width, ps.height), (255, 255, 255) )
+    if ps.mode == "RGB":
+        canvas = Image.new("RGB", (2*ps.width, ps.height), (255, 255, 255) )
+    else:
+        canvas = Image.new("L", (2*ps.width, ps.height), 255) # sl gets converted to it when pasted
     canvas.paste(ps, (0,0))
     canvas.paste(sl, (ps.width+IMG2_HORIZONTAL_OFFSET,0) )
-    canvas = canvas.transpose(Image.ROTATE_90)
+    sl.close()
 
-    canvas.save(output, "PNG")
+    if rotate:
+        rotated = canvas.transpose(Image.ROTATE_90)
+        canvas.close()
+        canvas = rotated
 
-    ps.close()
-    sl.close()
+    return canvas
+
+@measured("compose_order")
+def compose_order(order, ps_dir, combined_dir):
+    '''
+    Produce both printable images of an order (see get_orders_info()) in one pass, decoding its 
+    ps page and sl page once each: the ps with its barcodes pasted on, saved in ps_dir, and the 
+    combined PS+SL page, saved in combined_dir. Their paths are put in order["ps_path"] and 
+    order["combined_ps_and_sl_path"].
+
+    The combined page is left unrotated if LL_PRINTER_ROTATES. With VECTOR_OUTPUT both are pdfs 
+    made by compose_order_pdf() instead.
+    '''
+
+    if VECTOR_OUTPUT:
+        compose_order_pdf(order, ps_dir, combined_dir)
+        return
+
+    ps_path       = append_slash_if_needed(ps_dir) + order_file_name(order) + ".png"
+    combined_path = append_slash_if_needed(combined_dir) + order_file_name(order) + ".png"
+
+    log("Composing the pages of order: " + order["order_id"])
+
+    ps_page = open_page(order["ps_page"])
+    sl_page = open_page(order["sl_page"])
+    ps = page_for_print(ps_page)
+    sl = page_for_print(sl_page)
+
+    paste_barcodes_on_ps(order["order_id"], order["tracking_number"], ps) # in place, ps is decoded
+    save_for_print(ps, ps_path)
+
+    canvas = combined_image(ps, sl, rotate=not LL_PRINTER_ROTATES)
+    save_for_print(canvas, combined_path)
     canvas.close()
 
+    for img, page in ((ps, ps_page), (sl, sl_page)):
+        if img is not page:
+            img.close()
+    close_page(ps_page, order["ps_page"])
+    close_page(sl_page, order["sl_page"])
+
+    order["ps_path"] = ps_path
+    order["combined_ps_and_sl_path"] = combined_path
+
+    log("Done")
+
+def order_file_name(order):
+    # the name, without an extension, of the order's printed files. The PS page number makes it unique, 
+    # one order_ID can go with several PS pages, e.g. an order that ships in two boxes
+
+
+    return str(order["ps_source"][1]) + "-" + order["order_id"]
+
+def compose_order_pdf(order, ps_dir, combined_dir):
+    '''
+    The VECTOR_OUTPUT version of compose_order(): the same two pages, made as single-page pdfs out 
+    of the original pages of the order's pdfs (order["ps_source"] and order["sl_source"]) with 
+    vector barcodes drawn on, so nothing is rasterized and the labels keep their vector quality.
+    '''
+
+    ps_path       = append_slash_if_needed(ps_dir) + order_file_name(order) + ".pdf"
+    combined_path = append_slash_if_needed(combined_dir) + order_file_name(order) + ".pdf"
+
+    log("Composing the pdf pages of order: " + order["order_id"])
+
+    ps_pdf_path, ps_page_num = order["ps_source"]
+    sl_pdf_path, sl_page_num = order["sl_source"]
+    ps = upright_pdf_page(pdf_reader(ps_pdf_path).getPage(ps_page_num - 1)) # new pages, the cached readers' pages are left as they are
+    sl = upright_pdf_page(pdf_reader(sl_pdf_path).getPage(sl_page_num - 1))
+
+    stamp_barcodes_on_ps_page(order["order_id"], order["tracking_number"], ps) # in place
+    write_pdf_page(ps, ps_path)
+
+    write_pdf_page(combined_pdf_page(ps, sl, rotate=not LL_PRINTER_ROTATES), combined_path)
+
+    order["ps_path"] = ps_path
+    order["combined_ps_and_sl_path"] = combined_path
+
     log("Done")
 
+def stamp_barcodes_on_ps_page(oid, tno, ps):
+    # paste_barcodes_on_ps() for a PyPDF2 page, the barcodes are placed and sized the same way. Only 
+    # for pages of our own, see upright_pdf_page(), as the barcodes are merged into the page itself.
+
+
+    llx, lly, w, h = page_box(ps)
+    page_scale = w / (PS_IMG_W * 72 / 200) # PS_IMG_W is in pixels at 200 dpi
+
+    for data, (x, y), scale_by in ((oid, (0.61, 0.01), 1 * page_scale), (tno, (0.33, 0.76), 1.8 * page_scale)):
+        bc = barcode_pdf_page(data, scale_by)
+        _, _, _, bc_h = page_box(bc)
+        ps.mergeTranslatedPage(bc, llx + x * w, lly + h - y * h - bc_h) # pdf coordinates go up from the bottom
+
+def combined_pdf_page(ps, sl, rotate=True):
+    # combined_image() for PyPDF2 pages, a new page with ps and sl side by side
+
+
+    ps_llx, ps_lly, ps_w, ps_h = page_box(ps)
+    sl_llx, sl_lly, sl_w, sl_h = page_box(sl)
+
+    IMG2_HORIZONTAL_OFFSET = 50 * 72 / 200 # the same 50 pixels at 200 dpi as combined_image()
+    scaling_needed = ps_h / sl_h
+
+    page = PageObject.createBlankPage(None, 2*ps_w, ps_h)
+    page.mergeTranslatedPage(ps, -ps_llx, -ps_lly)
+    page.mergeScaledTranslatedPage(sl, scaling_needed, ps_w + IMG2_HORIZONTAL_OFFSET - sl_llx*scaling_needed, -sl_lly*scaling_needed)
+
+    if rotate:
+        page.rotateClockwise(270) # only sets /Rotate, like Image.ROTATE_90
+    
+    return page
+
+def upright_pdf_page(page):
+    # a new page with what the PyPDF2 page shows, turned as its /Rotate says to show it and with 
+    # the media box at the origin, so nothing composed out of it has to mind either
+
+
+    llx, lly, w, h = page_box(page)
+    rotate = int(page.get("/Rotate", 0) or 0) % 360
+    ctm = {
+        0:   (1, 0, 0, 1, -llx, -lly),
+        90:  (0, -1, 1, 0, -lly, llx + w),
+        180: (-1, 0, 0, -1, llx + w, lly + h),
+        270: (0, 1, -1, 0, lly + h, -llx),
+    }[rotate]
+
+    upright = PageObject.createBlankPage(None, *((h, w) if rotate in (90, 270) else (w, h)))
+    upright.mergeTransformedPage(page, ctm)
+    return upright
+
+def page_box(page):
+    # (left, bottom, width, height) of the PyPDF2 page's media box, in points
+
+
+    box = page.mediaBox
+    return float(box.getLowerLeft_x()), float(box.getLowerLeft_y()), float(box.getWidth()), float(box.getHeight())
+
+def barcode_pdf_page(data, scale_by=1):
+    '''
+    A Code128 barcode of `data` drawn with pdf operators on a page of its own, laid out like 
+    python-barcode lays it out and as big as barcode_image() makes it on a PS page at 200 dpi. 
+    Meant to be merged onto another page.
+    '''
+
+    mm = 72 / 25.4 * scale_by * 300 / 200 # points per python-barcode millimetre, barcode_image() draws at 300 dpi
+    module_width, module_height = 0.2 * mm, 15 * mm # python-barcode's defaults
+    quiet_zone, text_distance   = 6.5 * mm, 5 * mm
+    font_size = 10 * scale_by * 300 / 200
+
+    modules = CODE128(data).build()[0] # "1" for a bar module, "0" for a space
+    width  = 2*quiet_zone + len(modules)*module_width
+    height = 2*mm + module_height + text_distance + font_size
+
+    ops = ["q", "1 g", "0 0 %.2f %.2f re f" % (width, height), "0 g"] # on white, like barcode_image()
+    for m in re.finditer(r"1+", modules):
+        ops.append("%.3f %.3f %.3f %.3f re" % (quiet_zone + m.start()*module_width, height - 1*mm - module_height, len(m.group())*module_width, module_height))
+    ops.append("f")
+
+    text = data.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+    text_x = (width - 0.6*font_size*len(data)) / 2 # Courier glyphs are 0.6 em wide
+    ops.append("BT /BC %.2f Tf %.2f %.2f Td (%s) Tj ET" % (font_size, text_x, 1*mm, text))
+    ops.append("Q")
+
+    contents = DecodedStreamObject()
+    contents.setData("\n".join(ops).encode("latin-1"))
+
+    font = DictionaryObject({
+        NameObject("/Type"): NameObject("/Font"),
+        NameObject("/Subtype"): NameObject("/Type1"),
+        NameObject("/BaseFont"): NameObject("/Courier"),
+    })
+
+    page = PageObject.createBlankPage(None, width, height)
+    page[NameObject("/Contents")]  = contents
+    page[NameObject("/Resources")] = DictionaryObject({ NameObject("/Font"): DictionaryObject({ NameObject("/BC"): font }) })
+    return page
+
+def write_pdf_page(page, pdf_path):
+    writer = PdfFileWriter()
+    writer.addPage(page)
+    with open(pdf_path, "wb") as f:
+        writer.write(f)
+
+_pdf_readers = dict()
+_pdf_readers_lock = threading.Lock()
+
+def pdf_reader(path_to_pdf):
+    '''
+    A PdfFileReader of the pdf, opened once and reused by every order composed out of it until 
+    forget_pdf_readers(). Don't change its pages, compose_order_pdf() only reads them.
+    '''
+
+    with _pdf_readers_lock:
+        if path_to_pdf not in _pdf_readers:
+            f = open(path_to_pdf, "rb")
+            _pdf_readers[path_to_pdf] = (f, PdfFileReader(f, strict=False))
+        return _pdf_readers[path_to_pdf][1]
+
+def forget_pdf_readers(*paths):
+    with _pdf_readers_lock:
+        for path in paths:
+            if path in _pdf_readers:
+                _pdf_readers.pop(path)[0].close()
+
+def page_for_print(img):
+    '''
+    The decoded page `img` as it's composed for printing: at PRINT_RENDER_PROFILE's dpi, in 
+    grayscale unless the profile is "RGB". A page rendered at another dpi is rasterized again 
+    from its pdf if it was rendered in memory, and resampled otherwise. Returns img itself if it 
+    already fits the profile. 
+
+    Bilevel pages are composed in grayscale and only made bilevel when saved, see save_for_print().
+    '''
+
+    dpi  = PRINT_RENDER_PROFILE["dpi"]
+    mode = "RGB" if PRINT_RENDER_PROFILE["mode"] == "RGB" else "L"
+    rendered_at = int(round(img.info.get("dpi", (OCR_RENDER_PROFILE["dpi"],))[0]))
+
+    if rendered_at != dpi and "source" in img.info:
+        path_to_pdf, page_num = img.info["source"]
+        with span("rasterize_for_print"):
+            img = pdf_to_images_in_memory(path_to_pdf, dpi=dpi, page_range=(page_num, page_num), mode=mode)[page_num]
+        count("pages_rasterized_for_print")
+    elif rendered_at != dpi:
+        size = (round(img.width * dpi / rendered_at), round(img.height * dpi / rendered_at))
+        img = (img.convert(mode) if img.mode == "1" else img).resize(size, Image.LANCZOS) # resampling a bilevel image gives jaggies
+        img.info["dpi"] = (dpi, dpi)
+    
+    if img.mode != mode:
+        img = img.convert(mode)
+
+    return img
+
+def to_bilevel(img):
+    # a hard threshold instead of PIL's default dithering, which smears text and barcodes
+
+
+    return img.convert("1", dither=Image.NONE)
+
+def save_for_print(img, path):
+    # save the decoded img at path as a PNG in PRINT_RENDER_PROFILE's mode
+
+
+    out = to_bilevel(img) if PRINT_RENDER_PROFILE["mode"] == "1" and img.mode != "1" else img
+    out.save(path, "PNG", dpi=(PRINT_RENDER_PROFILE["dpi"], PRINT_RENDER_PROFILE["dpi"]))
+    if out is not img:
+        out.close()
+
 def print_to_PP(path_to_file_to_print, for_real=False):
     if for_real:
-        os.system(r"lpr -P " + PHYSICAL_PRINTER_NAME + " -o BRInputSlot=Tray1 " + path_to_file_to_print)
+        submit_print_job(path_to_file_to_print, PHYSICAL_PRINTER_NAME, ["-o", "BRInputSlot=Tray1"])
     
     if PRINT_TO_VIRTUAL_PRINTER:
-        os.system(r"lpr -P " + VIRTUAL_PRINTER_NAME + " " + path_to_file_to_print)
+        submit_print_job(path_to_file_to_print, VIRTUAL_PRINTER_NAME)
     
     log("Sending print job to PP/Tray1 done: " + os.path.basename(path_to_file_to_print))
 
-def print_to_LL(path_to_file_to_print, for_real=True):
+def print_to_LL(path_to_file_to_print, for_real=True, landscape=False):
     if for_real:
-        os.system(r"lpr -P " + PHYSICAL_PRINTER_NAME + " -o BRInputSlot=Tray2 " + path_to_file_to_print)
+        orientation = ["-o", "orientation-requested=4"] if landscape else []
+        submit_print_job(path_to_file_to_print, PHYSICAL_PRINTER_NAME, ["-o", "BRInputSlot=Tray2"] + orientation)
     
     if PRINT_TO_VIRTUAL_PRINTER:
-        os.system(r"lpr -P " + VIRTUAL_PRINTER_NAME + " " + path_to_file_to_print)
+        submit_print_job(path_to_file_to_print, VIRTUAL_PRINTER_NAME)
     
     log("Sending print job to LL/Tray2 done: " + os.path.basename(path_to_file_to_print))
 
+@measured("submit_print_job")
+def submit_print_job(path_to_file_to_print, printer_name, printer_options=()):
+    '''
+    Hand one file to PRINT_BACKENDS[PRINT_BACKEND] and log how long the submission took.
+
+    printer_options: lpr style options, e.g. ["-o", "BRInputSlot=Tray1"]
+    '''
+
+    start = time.time()
+    PRINT_BACKENDS[PRINT_BACKEND](path_to_file_to_print, printer_name, list(printer_options))
+    latency = time.time() - start
+
+    log("Submitted print job to " + printer_name + " in " + ("%.3f" % latency) + "s: " + os.path.basename(path_to_file_to_print))
+    return latency
+
+def lpr_backend(path_to_file_to_print, printer_name, printer_options):
+    completed = subprocess.run(["lpr", "-P", printer_name] + printer_options + [path_to_file_to_print])
+    if completed.returncode != 0:
+        log("lpr exited with " + str(completed.returncode) + " for: " + path_to_file_to_print)
+
+_fake_print_jobs = itertools.count(1)
+
+def fake_printer_backend(path_to_file_to_print, printer_name, printer_options):
+    # "prints" by copying the file to FAKE_PRINTER_TARGET/<printer_name>/, with a job number and the options in the file name
+
+
+    printer_dir = append_slash_if_needed(FAKE_PRINTER_TARGET) + printer_name + "/"
+    os.makedirs(printer_dir, exist_ok=True)
+
+    job_name = str(next(_fake_print_jobs)) + "_" + "_".join(o for o in printer_options if o != "-o")
+    shutil.copy(path_to_file_to_print, printer_dir + job_name.rstrip("_") + "_" + os.path.basename(path_to_file_to_print))
+
+PRINT_BACKENDS = {
+    "lpr": lpr_backend,
+    "fake": fake_printer_backend,
+}
+
+def pages_to_pdf(image_paths, pdf_path, resolution=None):
+    '''
+    Put the images, in order, into a single multi-page pdf at pdf_path and return pdf_path. The 
+    pages are placed at `resolution` dpi, PRINT_RENDER_PROFILE's by default. 
+    
+    Bilevel pages (see save_for_print()) go in as they are, see bilevel_pages_to_pdf(), anything 
+    else as JPEGs.
+    '''
+
+    resolution = resolution or PRINT_RENDER_PROFILE["dpi"]
+
+    log("Spooling " + str(len(image_paths)) + " pages into: " + os.path.basename(pdf_path))
+
+    images = [Image.open(p) for p in image_paths]
+    try:
+        if all(img.mode == "1" for img in images):
+            bilevel_pages_to_pdf(images, pdf_path, resolution)
+        else:
+            images[0].save(pdf_path, "PDF", resolution=resolution, save_all=True, append_images=images[1:], quality=90)
+    finally:
+        for img in images:
+            img.close()
+
+    return pdf_path
+
+def bilevel_pages_to_pdf(images, pdf_path, resolution):
+    # pages_to_pdf() for "1" mode images, each page is its image at 1 bit per pixel and Flate 
+    # compressed: lossless, so the barcodes stay sharp, and about as small as a JPEG. (PIL 
+    # would write them uncompressed, or as CCITT only if it was built with libtiff.)
+
+
+    writer = PdfFileWriter()
+    for img in images:
+        w, h = img.size
+        pixels = DecodedStreamObject()
+        pixels.setData(img.tobytes()) # 8 pixels a byte, every row padded to a whole byte, 0 is black as in DeviceGray
+        pixels = pixels.flateEncode()
+        pixels.update({
+            NameObject("/Type"): NameObject("/XObject"),
+            NameObject("/Subtype"): NameObject("/Image"),
+            NameObject("/Width"): NumberObject(w),
+            NameObject("/Height"): NumberObject(h),
+            NameObject("/ColorSpace"): NameObject("/DeviceGray"),
+            NameObject("/BitsPerComponent"): NumberObject(1),
+        })
+
+        width, height = w * 72 / resolution, h * 72 / resolution
+        contents = DecodedStreamObject()
+        contents.setData(("q %.2f 0 0 %.2f 0 0 cm /Page Do Q" % (width, height)).encode("latin-1"))
+
+        page = PageObject.createBlankPage(None, width, height)
+        page[NameObject("/Contents")]  = contents
+        page[NameObject("/Resources")] = DictionaryObject({ NameObject("/XObject"): DictionaryObject({ NameObject("/Page"): pixels }) })
+        writer.addPage(page)
+
+    with open(pdf_path, "wb") as f:
+        writer.write(f)
+
+def pdfs_to_pdf(pdf_paths, pdf_path):
+    # pages_to_pdf() for pdfs, concatenate them, in order, into pdf_path and return pdf_path
+
+
+    log("Spooling " + str(len(pdf_paths)) + " pdfs into: " + os.path.basename(pdf_path))
+
+    merger = PdfFileMerger(strict=False)
+    try:
+        for p in pdf_paths:
+            merger.append(p)
+        merger.write(pdf_path)
+    finally:
+        merger.close()
+
+    return pdf_path
+
 def pdf_to_images(path_to_pdf, output_dir):
     '''
     Breaks the pdf at path_to_pdf into individual images, each of which contains one page of 
@@ -568,10 +2385,229 @@ def pdf_to_images(path_to_pdf, output_dir):
     return dict_of_paths_to_all_pages
 
 def all_pages_text(path_from_page_num):
-    result = dict()
-    for pnum, path in path_from_page_num.items():
-        result[pnum] = str_from_img(path)
-    return result
+    # OCR all the pages concurrently, see OCR_WORKERS
+
+
+    page_nums = list(path_from_page_num.keys())
+    texts = ocr_map(str_from_img, [path_from_page_num[p] for p in page_nums])
+    return dict(zip(page_nums, texts))
+
+_ocr_pool = None
+_ocr_pool_lock = threading.Lock()
+
+ocr_cache_stats = {"hits": 0, "misses": 0, "evictions": 0} # since the process started, a job's own are its "ocr_cache_*" counters
+_ocr_cache_db = None
+_ocr_cache_bytes = 0 # the total size of the cached texts, kept up to date by ocr_cache_put()
+_ocr_cache_lock = threading.Lock()
+
+def ocr_cache_key(img, config):
+    # a hash of the decoded pixels (so the dpi a page was rendered at is part of it), the tesseract config and the OCR backend
+
+
+    h = hashlib.sha1()
+    h.update((img.mode + str(img.size) + config + ocr_backend_name()).encode())
+    h.update(img.tobytes())
+    return h.hexdigest()
+
+def ocr_cache():
+    # the sqlite connection behind the OCR cache, opened on first use. Only use it while holding _ocr_cache_lock.
+
+
+    global _ocr_cache_db, _ocr_cache_bytes
+    if _ocr_cache_db is None:
+        _ocr_cache_db = sqlite3.connect(OCR_CACHE_PATH, check_same_thread=False)
+        _ocr_cache_db.execute("CREATE TABLE IF NOT EXISTS ocr_cache (key TEXT PRIMARY KEY, text TEXT, size INTEGER, last_used REAL)")
+        _ocr_cache_db.execute("CREATE INDEX IF NOT EXISTS ocr_cache_last_used ON ocr_cache (last_used)")
+        _ocr_cache_bytes = _ocr_cache_db.execute("SELECT COALESCE(SUM(size), 0) FROM ocr_cache").fetchone()[0]
+    return _ocr_cache_db
+
+def ocr_cache_count(stat):
+    ocr_cache_stats[stat] += 1
+    count("ocr_cache_" + stat)
+
+def ocr_cache_get(key):
+    try:
+        with _ocr_cache_lock:
+            db  = ocr_cache()
+            row = db.execute("SELECT text FROM ocr_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                ocr_cache_count("misses")
+                return None
+
+            ocr_cache_count("hits")
+            with db:
+                db.execute("UPDATE ocr_cache SET last_used = ? WHERE key = ?", (time.time(), key))
+            return row[0]
+    except sqlite3.Error as e:
+        log("OCR cache unavailable: " + str(e))
+        return None
+
+def ocr_cache_put(key, text):
+    # the least recently used texts are only looked for once the running total is over OCR_CACHE_MAX_BYTES
+
+
+    global _ocr_cache_bytes
+    size = len(text.encode())
+    try:
+        with _ocr_cache_lock:
+            db = ocr_cache()
+            with db:
+                replaced = db.execute("SELECT size FROM ocr_cache WHERE key = ?", (key,)).fetchone()
+                db.execute("INSERT OR REPLACE INTO ocr_cache VALUES (?, ?, ?, ?)", (key, text, size, time.time()))
+                _ocr_cache_bytes += size - (replaced[0] if replaced else 0)
+                if _ocr_cache_bytes <= OCR_CACHE_MAX_BYTES:
+                    return
+
+                # other processes may share the file, so start from its actual size
+                _ocr_cache_bytes = db.execute("SELECT COALESCE(SUM(size), 0) FROM ocr_cache").fetchone()[0]
+                for old_key, old_size in db.execute("SELECT key, size FROM ocr_cache ORDER BY last_used").fetchall():
+                    if _ocr_cache_bytes <= OCR_CACHE_MAX_BYTES:
+                        break
+                    db.execute("DELETE FROM ocr_cache WHERE key = ?", (old_key,))
+                    _ocr_cache_bytes -= old_size
+                    ocr_cache_count("evictions")
+    except sqlite3.Error as e:
+        log("OCR cache unavailable: " + str(e))
+
+def ocr_cache_summary():
+    # the current job's hits, misses and evictions, or the process's since it started outside of a job
+
+
+    job = _current_job.get()
+    if job is None:
+        return "OCR cache since start: " + ", ".join(k + "=" + str(v) for k, v in ocr_cache_stats.items())
+
+    with _metrics_lock:
+        return "OCR cache: " + ", ".join(k + "=" + str(job["counters"].get("ocr_cache_" + k, 0)) for k in ocr_cache_stats)
+
+def ocr_backend():
+    # the function str_from_img() OCRs with, see OCR_BACKENDS
+
+
+    return OCR_BACKENDS[ocr_backend_name()]
+
+def ocr_backend_name():
+    if OCR_BACKEND == "tesserocr" and tesserocr is None:
+        return "pytesseract"
+    return OCR_BACKEND
+
+def pytesseract_ocr(img, config):
+    # runs a new tesseract process, which loads the language model again, for every call
+
+
+    return image_to_string(img, config=config)
+
+_tesserocr_engines = threading.local()
+
+def keep_tesserocr_engine():
+    # have tesserocr_ocr() keep its engine loaded in the calling thread, only for threads that live as long as the process
+
+
+    _tesserocr_engines.keep = True
+
+def tesserocr_ocr(img, config):
+    '''
+    OCR with a tesseract engine that lives in this thread and only loads its language model the 
+    first time, if the thread is one that keeps it (see keep_tesserocr_engine(), the ocr_pool() 
+    threads do). Any other thread gets an engine for this call only. The image is handed over 
+    in memory.
+
+    Only the "--psm N" part of config is understood, anything else in it makes this call go 
+    through pytesseract_ocr() instead.
+    '''
+
+    args = config.split()
+    if len(args) not in (0, 2) or (args and args[0] != "--psm"):
+        return pytesseract_ocr(img, config)
+
+    keep = getattr(_tesserocr_engines, "keep", False)
+    api = getattr(_tesserocr_engines, "api", None)
+    if api is None:
+        api = tesserocr.PyTessBaseAPI()
+        if keep:
+            _tesserocr_engines.api = api
+            log("Loaded a tesseract engine for thread: " + threading.current_thread().name)
+
+    api.SetPageSegMode(int(args[1]) if args else tesserocr.PSM.AUTO)
+    try:
+        api.SetImage(img)
+        return api.GetUTF8Text()
+    finally:
+        api.Clear()
+        if not keep:
+            api.End()
+
+_ocr_coordinator = None # set by use_ocr_coordinator()
+
+def use_ocr_coordinator(coordinator):
+    '''
+    Have distributed_ocr() and distributed_rasterize() farm their work out through `coordinator` 
+    (an ocr_workers.OCRCoordinator, see ocr_workers.start_coordinator()), or stop it if None.
+    '''
+
+    global _ocr_coordinator
+    _ocr_coordinator = coordinator
+
+def distributed_ocr(img, config):
+    # OCR on one of the coordinator's workers, or with the local backend if there are none or they all failed at it
+
+
+    coordinator = _ocr_coordinator
+    if coordinator is not None and coordinator.live_workers():
+        try:
+            text = coordinator.ocr(img, config)
+            count("distributed_ocr_calls")
+            return text
+        except Exception as e:
+            count("distributed_ocr_fallbacks")
+            log("Distributed OCR failed, doing it here: " + repr(e))
+
+    return OCR_BACKENDS["tesserocr" if tesserocr is not None else "pytesseract"](img, config)
+
+def distributed_rasterize(path_to_pdf, dpi, page_range, mode):
+    '''
+    The pages of the pdf (all of them, or the `page_range`) rasterized on the coordinator's workers as 
+    a list of decoded images, in page order. None if DISTRIBUTED_RASTERIZING is off, there are no 
+    workers or they failed at it, the caller rasterizes the pages itself then.
+    '''
+
+    coordinator = _ocr_coordinator
+    if not DISTRIBUTED_RASTERIZING or coordinator is None or not coordinator.live_workers():
+        return None
+
+    first, last = page_range if bool(page_range) else (1, pdf_page_count(path_to_pdf))
+    try:
+        images = coordinator.rasterize(path_to_pdf, dpi, (first, last), mode, RASTERIZE_TASK_PAGES)
+        count("distributed_rasterize_calls")
+        return images
+    except Exception as e:
+        count("distributed_rasterize_fallbacks")
+        log("Distributed rasterizing failed, doing it here: " + repr(e))
+        return None
+
+OCR_BACKENDS = {
+    "pytesseract": pytesseract_ocr,
+    "tesserocr": tesserocr_ocr,
+    "distributed": distributed_ocr,
+}
+
+def ocr_map(fn, items):
+    # ocr_pool().map(), with every call keeping the caller's job metrics (see in_job_context())
+
+
+    return ocr_pool().map(in_job_context(fn), items)
+
+def ocr_pool():
+    # the executor shared by everything that OCRs, created on first use. Each str_from_img() runs a
+    # tesseract subprocess, so threads are enough to keep OCR_WORKERS cores busy.
+    # Never submit to it from inside one of its own tasks, that can deadlock once it's saturated.
+
+
+    global _ocr_pool
+    with _ocr_pool_lock:
+        if _ocr_pool is None:
+            _ocr_pool = ThreadPoolExecutor(max_workers=OCR_WORKERS, thread_name_prefix="ocr", initializer=keep_tesserocr_engine)
+        return _ocr_pool
 
 def k_from_v(src_dict, v_to_find):
     for k, v in src_dict.items():